@@ -0,0 +1,121 @@
+"""
+Admission control for face recognition requests.
+
+Each web process runs at most ADMISSION_MAX_CONCURRENT recognitions at once.
+Up to ADMISSION_MAX_QUEUE more may wait, each for at most
+ADMISSION_MAX_WAIT_MS. Beyond that a request is shed at once with
+Overloaded: the route answers 503 with Retry-After (estimated from the queue
+and recent service times) and X-Capture-Interval, the interval a kiosk should
+poll at until the burst passes. A kiosk is told to wait rather than adding
+to a queue that would answer it seconds later.
+
+Degrade mode: a request that arrives with ADMISSION_DEGRADE_DEPTH or more
+requests already waiting is admitted as degraded; its frame is downscaled to
+ADMISSION_DEGRADED_MAX_SIDE before detection, which costs a fraction of the
+full-resolution YuNet pass. ADMISSION_DEGRADE_DEPTH=0 turns this off.
+"""
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_WAIT_MS = float(os.getenv("ADMISSION_MAX_WAIT_MS", "2000"))
+ADMISSION_DEGRADE_DEPTH = int(os.getenv("ADMISSION_DEGRADE_DEPTH", "8"))
+ADMISSION_DEGRADED_MAX_SIDE = int(os.getenv("ADMISSION_DEGRADED_MAX_SIDE", "320"))
+
+# scan.html captures every 2 seconds; shed kiosks are never asked to go faster
+NORMAL_CAPTURE_INTERVAL = 2.0
+SERVICE_TIME_WEIGHT = 0.2 # EWMA weight of the newest service time
+
+
+class Overloaded(Exception):
+    """The request was shed; retry after `retry_after` seconds, capture every `capture_interval`"""
+    def __init__(self, message, retry_after, capture_interval):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.capture_interval = capture_interval
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after), "X-Capture-Interval": f"{self.capture_interval:g}"}
+
+
+class AdmissionController:
+    def __init__(
+        self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_queue=ADMISSION_MAX_QUEUE,
+        max_wait_ms=ADMISSION_MAX_WAIT_MS, degrade_depth=ADMISSION_DEGRADE_DEPTH
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait_ms / 1000
+        self.degrade_depth = degrade_depth
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.waiting = 0
+        self.service_time = 0.1 # seconds, EWMA
+        self.admitted = 0
+        self.degraded = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _overloaded(self, message):
+        # Time for the queue ahead to drain at the current service rate
+        backlog = (self.waiting + self.in_flight) * self.service_time / max(self.max_concurrent, 1)
+        retry_after = max(1, math.ceil(backlog))
+        return Overloaded(message, retry_after, max(NORMAL_CAPTURE_INTERVAL, float(retry_after)))
+
+    @asynccontextmanager
+    async def admit(self):
+        """Hold a recognition slot; yields True when the request should run degraded"""
+        degraded = 0 < self.degrade_depth <= self.waiting
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise self._overloaded("Recognition queue is full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise self._overloaded("Recognition queue wait exceeded")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        self.in_flight += 1
+        self.admitted += 1
+        self.degraded += degraded
+        started = time.perf_counter()
+        try:
+            yield degraded
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            elapsed = time.perf_counter() - started
+            self.service_time += SERVICE_TIME_WEIGHT * (elapsed - self.service_time)
+
+    def busy(self, message="Recognition busy, please retry"):
+        """Overloaded for a rejection further down (the worker pool queue), with the same hints"""
+        self.rejected += 1
+        return self._overloaded(message)
+
+    def stats(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "max_wait_ms": self.max_wait * 1000,
+            "degrade_depth": self.degrade_depth,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "service_time_ms": round(self.service_time * 1000, 1),
+            "admitted": self.admitted,
+            "degraded": self.degraded,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,108 @@
+"""
+Cold archive for attendance.
+
+The hot `attendance` table only keeps recent months so its indexes stay small
+and inserts / today-lookups stay fast. Older rows are moved, in batches and
+with their ids, to `attendance_archive`. Queries that may reach past the hot
+window use `attendance_source()`, which unions the archive in only when the
+requested date range starts on or before the newest archived day.
+
+Run periodically (e.g. nightly cron) from the backend folder:
+    python archive.py                       # keep ATTENDANCE_HOT_MONTHS months hot
+    python archive.py --before 2026-01-01
+"""
+import argparse
+import os
+from datetime import date
+
+from sqlalchemy import select, insert, delete, union_all, func
+
+from models import Attendance, AttendanceArchive
+
+HOT_MONTHS = int(os.getenv("ATTENDANCE_HOT_MONTHS", "6"))
+ARCHIVE_BATCH_SIZE = 5000
+
+_COLUMNS = ["id", "student_id", "method", "timestamp", "date", "status", "proof_image_path"]
+
+
+def default_cutoff(today=None, hot_months=HOT_MONTHS):
+    """First day of the oldest month that stays hot"""
+    today = today or date.today()
+    month_index = today.year * 12 + (today.month - 1) - (hot_months - 1)
+    return date(month_index // 12, month_index % 12 + 1, 1).isoformat()
+
+
+def ensure_indexes(engine):
+    """Create indexes added after the tables were first created"""
+    for index in Attendance.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+def archive_before(db, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move attendance rows dated before `cutoff` (YYYY-MM-DD) to the archive. Commits per batch."""
+    moved = 0
+    while True:
+        ids = [row_id for (row_id,) in (
+            db.query(Attendance.id)
+            .filter(Attendance.date < cutoff)
+            .order_by(Attendance.id)
+            .limit(batch_size)
+        )]
+        if not ids:
+            return moved
+
+        hot = Attendance.__table__
+        db.execute(
+            insert(AttendanceArchive).from_select(
+                _COLUMNS, select(*[hot.c[name] for name in _COLUMNS]).where(hot.c.id.in_(ids))
+            )
+        )
+        db.execute(delete(Attendance).where(Attendance.id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+        print(f"   archived {moved} rows")
+
+
+def archive_watermark(db):
+    """Newest archived date, or None when nothing has been archived"""
+    return db.query(func.max(AttendanceArchive.date)).scalar()
+
+
+def attendance_source(db, start=None, end=None):
+    """
+    Selectable with the attendance columns for the date range, named "attendance".
+    Spans the archive only when the range needs it.
+    """
+    def ranged(table):
+        query = select(*[table.c[name] for name in _COLUMNS])
+        if start:
+            query = query.where(table.c.date >= start)
+        if end:
+            query = query.where(table.c.date <= end)
+        return query
+
+    hot = ranged(Attendance.__table__)
+    watermark = archive_watermark(db)
+    if watermark is None or (start is not None and start > watermark):
+        return hot.subquery("attendance")
+    return union_all(hot, ranged(AttendanceArchive.__table__)).subquery("attendance")
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, engine, Base
+
+    parser = argparse.ArgumentParser(description="Move old attendance rows to the archive table")
+    parser.add_argument("--before", help="Archive rows dated before this day (YYYY-MM-DD)")
+    parser.add_argument("--hot-months", type=int, default=HOT_MONTHS)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    ensure_indexes(engine)
+    cutoff = args.before or default_cutoff(hot_months=args.hot_months)
+
+    db = SessionLocal()
+    try:
+        moved = archive_before(db, cutoff)
+        print(f"✅ Archived {moved} attendance rows dated before {cutoff}")
+    finally:
+        db.close()
@@ -0,0 +1,54 @@
+"""
+Benchmark bulk password hashing (pbkdf2_sha256) across process counts.
+
+Hashes the same list of default passwords sequentially and then with the
+password_utils process pool at 1, 2, 4, ... workers up to the CPU count,
+reporting wall time and speed-up over the sequential run.
+
+Usage (from the backend folder):
+    python bench_hashing.py
+    python bench_hashing.py --count 500
+"""
+import argparse
+import os
+import time
+
+import password_utils
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def worker_counts(limit):
+    counts, n = [], 1
+    while n < limit:
+        counts.append(n)
+        n *= 2
+    return counts + [limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200, help="Passwords to hash")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    passwords = [f"S{i:06d}" for i in range(args.count)]
+    sequential = timed(lambda: [password_utils.hash_password(p) for p in passwords])
+    print(f"{args.count} passwords, sequential: {sequential:.2f}s ({args.count / sequential:.0f}/s)\n")
+
+    print(f"{'workers':>8}{'seconds':>10}{'hashes/s':>12}{'speed-up':>10}")
+    for workers in worker_counts(args.max_workers):
+        password_utils.shutdown_pool()
+        password_utils.HASH_WORKERS = workers
+        password_utils.hash_many(passwords[:workers])  # Start the processes outside the timing
+        seconds = timed(lambda: password_utils.hash_many(passwords))
+        print(f"{workers:>8}{seconds:>10.2f}{args.count / seconds:>12.0f}{sequential / seconds:>9.1f}x")
+    password_utils.shutdown_pool()
+
+
+if __name__ == "__main__":
+    main()
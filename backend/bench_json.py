@@ -0,0 +1,79 @@
+"""
+Benchmark JSON serialization of large report payloads.
+
+Compares FastAPI's default path (jsonable_encoder + JSONResponse) with
+FastJSONResponse, and each fast_json backend that is installed.
+
+Usage (from the backend folder):
+    python bench_json.py
+    python bench_json.py --rows 50000 --repeat 5
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import fast_json
+from fast_json import FastJSONResponse
+
+
+def make_report(rows):
+    start = datetime(2026, 1, 5, 8, 0, 0)
+    return [{
+        "Registration No": f"S{i:06d}",
+        "Name": f"Student {i}",
+        "Dept": ("CSE", "ECE", "ME", "CE")[i % 4],
+        "Date": (start + timedelta(days=i % 30)).date(),
+        "Timestamp": start + timedelta(seconds=i * 7),
+        "Time": (start + timedelta(seconds=i * 7)).strftime("%H:%M:%S"),
+        "Method": ("FACE", "QR", "EXCEL")[i % 3],
+        "Confidence": np.float32(0.5 + (i % 50) / 100),
+    } for i in range(rows)]
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    data = make_report(args.rows)
+    print(f"Report payload: {args.rows} rows, fast_json backend: {fast_json.BACKEND}\n")
+
+    # jsonable_encoder rejects NumPy scalars unless told how to convert them
+    numpy_encoder = {np.generic: lambda value: value.item()}
+    cases = [
+        ("jsonable_encoder + JSONResponse", lambda: JSONResponse(jsonable_encoder(data, custom_encoder=numpy_encoder)).body),
+        (f"FastJSONResponse ({fast_json.BACKEND})", lambda: FastJSONResponse(data).body),
+        ("stdlib json + default", lambda: json.dumps(data, default=fast_json._default, separators=(",", ":")).encode()),
+    ]
+    if fast_json.orjson is not None:
+        cases.append(("orjson", lambda: fast_json.orjson.dumps(
+            data, default=fast_json._default, option=fast_json.orjson.OPT_SERIALIZE_NUMPY)))
+    if fast_json.msgspec is not None:
+        encoder = fast_json.msgspec.json.Encoder(enc_hook=fast_json._default)
+        cases.append(("msgspec", lambda: encoder.encode(data)))
+
+    baseline = None
+    print(f"{'method':<38}{'best (ms)':>12}{'rows/s':>14}{'bytes':>12}{'speed-up':>10}")
+    for name, fn in cases:
+        seconds, size = best_of(args.repeat, fn)
+        baseline = baseline or seconds
+        print(f"{name:<38}{seconds * 1000:>12.1f}{args.rows / seconds:>14,.0f}{size:>12,}{baseline / seconds:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Bulk enrollment from a ZIP of student photos (REGISTRATION_NUMBER.jpg).
+
+Members are streamed straight out of the uploaded archive (Starlette's spooled
+upload file) into memory; nothing is extracted to a shared temp folder, so
+concurrent uploads cannot clobber each other. The work is a three-stage
+pipeline that overlaps:
+
+    decode  - a small thread pool reads and decodes members
+    embed   - one thread runs its own YuNet/SFace pair (the model objects are
+              not thread-safe) and JPEG-encodes the photo to keep
+    insert  - the calling thread checks each batch for faces that are already
+              enrolled (or repeated within the archive), bulk-inserts and
+              commits the rest, then writes their photos to data/images/students
+
+Queues between stages are bounded, so peak memory is a few decoded images
+and one batch of JPEGs regardless of archive size. Photos are written only
+after their rows are committed, so an interrupted import leaves no files
+without a student; jobs.py shares insert_batch().
+"""
+import io
+import os
+import queue
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import PurePosixPath
+
+import face_utils
+import gallery
+import qr_utils
+import password_utils
+import bulk_load
+from models import Student
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+MAX_MEMBER_BYTES = int(os.getenv("ENROLL_MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+DECODE_THREADS = int(os.getenv("ENROLL_DECODE_THREADS", "4"))
+MAX_IN_FLIGHT = DECODE_THREADS * 2
+INSERT_BATCH_SIZE = 200
+
+_DONE = object()
+
+
+class EnrollmentError(Exception):
+    """A single member could not be enrolled; the message goes into results["failed"]"""
+
+
+def list_image_members(zf):
+    """[(reg_no, ZipInfo)] for every image member, skipping folders and macOS metadata"""
+    members = []
+    for info in zf.infolist():
+        path = PurePosixPath(info.filename)
+        if info.is_dir() or path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        if "__MACOSX" in path.parts or path.name.startswith("._"):
+            continue
+        members.append((path.stem, info))
+    return members
+
+
+def read_member(zf, info, max_bytes=MAX_MEMBER_BYTES):
+    if info.file_size > max_bytes:
+        raise EnrollmentError(f"Image too large ({info.file_size // 1024} KB)")
+    with zf.open(info) as member:
+        data = member.read(max_bytes + 1)  # Don't trust the header size alone
+    if len(data) > max_bytes:
+        raise EnrollmentError("Image too large")
+    return data
+
+
+def decode_member(zf, info, max_bytes=MAX_MEMBER_BYTES):
+    image_array = face_utils.decode_image(io.BytesIO(read_member(zf, info, max_bytes)))
+    if image_array is None:
+        raise EnrollmentError("Invalid Image")
+    return image_array
+
+
+def load_models():
+    """Private model pair for a background thread, or None to report the load error per member"""
+    try:
+        return face_utils.create_models()
+    except Exception as e:
+        print(f"❌ Error loading models: {e}")
+        return None
+
+
+def embed(image_array, models=None):
+    encoding, error = face_utils.get_face_embedding(image_array, models)
+    if error:
+        raise EnrollmentError(error)
+    return encoding
+
+
+def encode_photo(image_array):
+    """JPEG bytes of a photo to keep; written once its student is committed"""
+    data = face_utils.encode_jpeg(image_array)
+    if data is None:
+        raise EnrollmentError("Could not encode image")
+    return data
+
+
+def student_image_path(reg_no):
+    return f"/images/students/{reg_no}_{int(datetime.now().timestamp())}.jpg"
+
+
+def write_student_images(images, images_dir):
+    """Write committed students' photos, {image path: JPEG bytes}"""
+    for image_path, data in images.items():
+        try:
+            (images_dir / PurePosixPath(image_path).name).write_bytes(data)
+        except OSError as e:
+            print(f"⚠️ Could not save {image_path}: {e}")
+
+
+def new_student_row(reg_no, encoding, image_path, password_hash):
+    """Student Record (Default Name = Reg No, Dept = General)"""
+    qr_token = qr_utils.generate_qr_token()
+    return {
+        "registration_number": reg_no,
+        "name": reg_no, # Default name is ID, admin can update later
+        "department": "General",
+        "year": "1",
+        "face_encoding": encoding,
+        "face_image_path": image_path,
+        "password_hash": password_hash,
+        "qr_token": qr_token,
+        "qr_payload": f"ATTENDANCE:{reg_no}:{qr_token}",
+        "is_verified": 1
+    }
+
+
+def insert_batch(db, duplicates, batch, hash_passwords):
+    """
+    Bulk-insert a batch of embedded students [(reg_no, encoding, jpeg)] except
+    near-duplicates of enrolled faces (or flag them, ENROLL_DUPLICATE_MODE=flag).
+    hash_passwords(positions) gives the password hashes of the kept entries.
+    The caller commits, then writes the returned photos with write_student_images().
+    Returns ([(status, note)] per entry, status "enrolled", "flagged" or "duplicate"; {image path: jpeg}).
+    """
+    matches = duplicates.check_batch([reg_no for reg_no, _, _ in batch], [encoding for _, encoding, _ in batch])
+    outcomes, kept = [], []
+    for position, match in enumerate(matches):
+        note = gallery.describe(db, match) if match else None
+        if match and gallery.DUPLICATE_MODE != "flag":
+            outcomes.append(("duplicate", note))
+            continue
+        outcomes.append(("flagged" if match else "enrolled", note))
+        kept.append(position)
+
+    rows, images = [], {}
+    for position, password_hash in zip(kept, hash_passwords(kept)):
+        reg_no, encoding, jpeg = batch[position]
+        image_path = student_image_path(reg_no)
+        rows.append(new_student_row(reg_no, encoding, image_path, password_hash))
+        images[image_path] = jpeg
+    bulk_load.copy_students(db, rows)
+    gallery.record_added(db, [row["registration_number"] for row in rows])
+    return outcomes, images
+
+
+def existing_registrations(db, reg_nos):
+    reg_nos = list(reg_nos)
+    if not reg_nos:
+        return set()
+    return {
+        reg_no for (reg_no,) in db.query(Student.registration_number)
+        .filter(Student.registration_number.in_(reg_nos))
+    }
+
+
+def enroll_zip(fileobj, db, images_dir, defer_passwords=False):
+    """
+    Enroll every new student in the archive. Blocking; run it in a worker thread.
+    Returns {"success": [...], "failed": [...], "skipped": [...], "flagged": [...]}
+    Near-duplicate faces are rejected into "failed", or enrolled and listed in
+    "flagged" when ENROLL_DUPLICATE_MODE=flag. Each batch of INSERT_BATCH_SIZE
+    students is committed as it is inserted.
+    """
+    results = {"success": [], "failed": [], "skipped": [], "flagged": []}
+    gallery.face_gallery.refresh(db)
+    duplicates = gallery.DuplicateChecker(gallery.face_gallery)
+
+    with zipfile.ZipFile(fileobj) as zf:
+        members = list_image_members(zf)
+        existing = existing_registrations(db, {reg_no for reg_no, _ in members})
+
+        todo, seen = [], set()
+        for reg_no, info in members:
+            if reg_no in existing or reg_no in seen:
+                results["skipped"].append(reg_no)
+                continue
+            seen.add(reg_no)
+            todo.append((reg_no, info))
+
+        # Default passwords (= ID) hash in other processes while the pipeline runs
+        pending_hashes = None
+        if not defer_passwords:
+            pending_hashes = password_utils.hash_many_async([reg_no for reg_no, _ in todo])
+
+        embedded = queue.Queue(maxsize=INSERT_BATCH_SIZE)
+        cancelled = threading.Event()
+
+        def hand_off(item):
+            while not cancelled.is_set():
+                try:
+                    embedded.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def embed_one(index, future, models):
+            reg_no = todo[index][0]
+            try:
+                image_array = future.result()
+                encoding = embed(image_array, models)
+                hand_off((index, reg_no, encoding, encode_photo(image_array), None))
+            except EnrollmentError as e:
+                hand_off((index, reg_no, None, None, str(e)))
+            except Exception as e:
+                hand_off((index, reg_no, None, None, f"Processing error: {e}"))
+
+        def embed_stage(decoder):
+            # Embeds in archive order while the next members decode; at most
+            # MAX_IN_FLIGHT decoded images are held at once
+            in_flight = deque()
+            try:
+                models = load_models() if todo else None
+                for index, (_, info) in enumerate(todo):
+                    if cancelled.is_set():
+                        return
+                    if len(in_flight) >= MAX_IN_FLIGHT:
+                        embed_one(*in_flight.popleft(), models)
+                    in_flight.append((index, decoder.submit(decode_member, zf, info)))
+                while in_flight and not cancelled.is_set():
+                    embed_one(*in_flight.popleft(), models)
+            finally:
+                hand_off(_DONE)
+
+        with ThreadPoolExecutor(DECODE_THREADS) as decoder:
+            embedder = threading.Thread(target=embed_stage, args=(decoder,), daemon=True)
+            embedder.start()
+
+            def commit_batch(batch):
+                if not batch:
+                    return
+
+                def hash_passwords(kept):
+                    if pending_hashes is None:
+                        return [password_utils.DEFERRED_PASSWORD_HASH] * len(kept)
+                    return [pending_hashes.get(batch[position][0]) for position in kept]
+
+                # One matrix product per batch against the gallery and the upload so far
+                outcomes, images = insert_batch(db, duplicates, [entry[1:] for entry in batch], hash_passwords)
+                db.commit()
+                write_student_images(images, images_dir)
+                for (_, reg_no, _, _), (status, note) in zip(batch, outcomes):
+                    if status == "duplicate":
+                        results["failed"].append(f"{reg_no} ({note})")
+                        continue
+                    if status == "flagged":
+                        results["flagged"].append(f"{reg_no} ({note})")
+                    results["success"].append(reg_no)
+
+            batch = []
+            try:
+                while True:
+                    item = embedded.get()
+                    if item is _DONE:
+                        break
+                    index, reg_no, encoding, jpeg, error = item
+                    if error:
+                        results["failed"].append(f"{reg_no} ({error})")
+                        continue
+
+                    batch.append((index, reg_no, encoding, jpeg))
+                    if len(batch) >= INSERT_BATCH_SIZE:
+                        commit_batch(batch)
+                        batch = []
+            finally:
+                cancelled.set()
+                embedder.join()
+
+        commit_batch(batch)
+        gallery.face_gallery.refresh(db)
+
+    return results
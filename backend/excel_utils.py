@@ -1,5 +1,6 @@
 import pandas as pd
 import io
+from openpyxl import Workbook
 
 def process_attendance_excel(file_content):
     """
@@ -35,13 +36,17 @@ def process_attendance_excel(file_content):
     except Exception as e:
         return None, f"Error processing file: {str(e)}"
 
-def generate_report_excel(data):
+def write_report_excel(columns, rows):
     """
-    Generate Excel bytes from list of dictionaries
+    Excel bytes from an iterable of row dicts, written row by row to a
+    write-only sheet so the rows are never all in memory
     """
-    df = pd.DataFrame(data)
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet("Report")
+    sheet.append(list(columns))
+    for row in rows:
+        sheet.append([row[column] for column in columns])
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Report')
+    wb.save(output)
     output.seek(0)
     return output
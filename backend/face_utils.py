@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 import base64
 import io
+import time
 from PIL import Image
 from pathlib import Path
 
@@ -11,27 +12,38 @@ MODELS_DIR = DATA_DIR / "models"
 YUNET_PATH = MODELS_DIR / "face_detection_yunet_2023mar.onnx"
 SFACE_PATH = MODELS_DIR / "face_recognition_sface_2021dec.onnx"
 
+# Embeddings from another SFace build are not comparable; edge kiosks must report this version
+MODEL_VERSION = SFACE_PATH.stem.replace("face_recognition_", "")
+
 # Initialize detectors (Lazy load or global)
 face_detector = None
 face_recognizer = None
 
+def create_models():
+    """
+    New (detector, recognizer) pair. OpenCV model objects are not thread-safe,
+    so background threads that embed in parallel each hold their own pair.
+    """
+    # YuNet: input size can be dynamic, but init requires one. We update it per image.
+    detector = cv2.FaceDetectorYN.create(
+        str(YUNET_PATH),
+        "",
+        (320, 320),
+        0.9, # Score threshold
+        0.3, # NMS threshold
+        5000 # Top K
+    )
+    recognizer = cv2.FaceRecognizerSF.create(
+        str(SFACE_PATH),
+        ""
+    )
+    return detector, recognizer
+
 def init_models():
     global face_detector, face_recognizer
     if face_detector is None:
         try:
-             # YuNet: input size can be dynamic, but init requires one. We update it per image.
-            face_detector = cv2.FaceDetectorYN.create(
-                str(YUNET_PATH),
-                "",
-                (320, 320),
-                0.9, # Score threshold
-                0.3, # NMS threshold
-                5000 # Top K
-            )
-            face_recognizer = cv2.FaceRecognizerSF.create(
-                str(SFACE_PATH),
-                ""
-            )
+            face_detector, face_recognizer = create_models()
             print("✅ OpenCV Face Models Loaded")
         except Exception as e:
             print(f"❌ Error loading models: {e}")
@@ -66,49 +78,70 @@ def decode_image(image_file_or_base64):
         print(f"Error decoding image: {e}")
         return None
 
-def get_face_embedding(image_array):
+def downscale(image_array, max_side):
+    """Shrink so the longer side is at most max_side (cheaper detection); smaller images are returned as is"""
+    h, w = image_array.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image_array
+    return cv2.resize(image_array, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+def detect_and_align(image_array, models=None, timings=None):
+    """
+    Detects EXACTLY one face and returns the aligned 112x112 BGR crop SFace expects.
+    Returns (crop, error_message); `timings` (a dict) receives detect_ms and align_ms.
+    """
+    detector, recognizer = models or (face_detector, face_recognizer)
+    if detector is None or recognizer is None:
+        return None, "Models not initialized (missing ONNX files?)"
+
+    started = time.perf_counter()
+    # Convert to BGR for OpenCV
+    img_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+    h, w, _ = img_bgr.shape
+    
+    # Set input size
+    detector.setInputSize((w, h))
+    
+    # Detect
+    _, faces = detector.detect(img_bgr)
+    detected = time.perf_counter()
+    if timings is not None:
+        timings["detect_ms"] = (detected - started) * 1000
+    
+    if faces is None or len(faces) == 0:
+        return None, "No face detected"
+        
+    # Filter weak faces? threshold is already 0.9 in init
+    
+    if len(faces) > 1:
+        # User rule: "During registration, reject if no face or multiple faces."
+        # So let's strict check.
+        return None, f"Multiple faces detected ({len(faces)}). Please ensure only one person is in frame."
+
+    # FaceRecognizerSF requires aligned face
+    crop = recognizer.alignCrop(img_bgr, faces[0])
+    if timings is not None:
+        timings["align_ms"] = (time.perf_counter() - detected) * 1000
+    return crop, None
+
+def get_face_embedding(image_array, models=None, timings=None):
     """
     Detects EXACTLY one face and returns 128D encoding.
+    `models` is an optional (detector, recognizer) pair from create_models();
+    the module-level pair is used otherwise. `timings` (a dict) receives per-stage ms.
     Returns (encoding, error_message)
     """
     try:
-        if face_detector is None:
-            return None, "Models not initialized (missing ONNX files?)"
-
-        # Convert to BGR for OpenCV
-        img_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
-        h, w, _ = img_bgr.shape
-        
-        # Set input size
-        face_detector.setInputSize((w, h))
-        
-        # Detect
-        _, faces = face_detector.detect(img_bgr)
-        
-        if faces is None or len(faces) == 0:
-            return None, "No face detected"
-            
-        # Filter weak faces? threshold is already 0.9 in init
-        
-        if len(faces) > 1:
-            # Find the largest face
-            # Face format: x1, y1, w, h, x_re, y_re, ... confidence
-            largest_face = max(faces, key=lambda f: f[2] * f[3])
-            
-            # If strictly one face required:
-            # return None, "Multiple faces detected. Please ensure only one person is in frame."
-            
-            # For robustness, we'll use the largest face but warn? 
-            # User rule: "During registration, reject if no face or multiple faces."
-            # So let's strict check.
-            return None, f"Multiple faces detected ({len(faces)}). Please ensure only one person is in frame."
-        else:
-            largest_face = faces[0]
+        aligned_face, error = detect_and_align(image_array, models, timings)
+        if error:
+            return None, error
 
-        # Align and Recognize
-        # FaceRecognizerSF requires aligned face
-        aligned_face = face_recognizer.alignCrop(img_bgr, largest_face)
-        embedding = face_recognizer.feature(aligned_face)
+        _, recognizer = models or (face_detector, face_recognizer)
+        started = time.perf_counter()
+        embedding = recognizer.feature(aligned_face)
+        if timings is not None:
+            timings["embed_ms"] = (time.perf_counter() - started) * 1000
         
         # embedding is (1, 128) float32
         return embedding[0].tolist(), None
@@ -116,6 +149,98 @@ def get_face_embedding(image_array):
     except Exception as e:
         return None, f"Processing error: {str(e)}"
 
+# --- Pre-aligned crops (kiosks that run their own detector) ---
+
+ALIGNED_SIZE = (112, 112) # What alignCrop produces and SFace consumes
+MAX_CROP_SIDE = 512
+MAX_CROP_BYTES = 1024 * 1024 # A 512x512 PNG fits; crops are usually JPEGs of a few KB
+
+def decode_crop(data):
+    """
+    Small uploaded face crop -> BGR array, without the full-frame PIL path.
+    Size and header dimensions are checked before any pixel is decoded, so a
+    large or decompression-bomb upload is refused cheaply. Returns (crop, error_message)
+    """
+    if len(data) > MAX_CROP_BYTES:
+        return None, f"Crop larger than {MAX_CROP_BYTES // 1024} KB; send the face region only"
+    try:
+        with Image.open(io.BytesIO(data)) as image: # Reads the header only
+            width, height = image.size
+    except Exception:
+        return None, "Invalid image"
+    if max(width, height) > MAX_CROP_SIDE:
+        return None, f"Crop larger than {MAX_CROP_SIDE}px; send the face region only"
+    crop = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if crop is None:
+        return None, "Invalid image"
+    return crop, None
+
+def align_with_landmarks(crop_bgr, landmarks, models=None):
+    """
+    Align a loose face crop using 5 landmarks in YuNet order (right eye, left eye,
+    nose tip, right and left mouth corners), in crop pixels.
+    Returns (aligned_crop, error_message)
+    """
+    _, recognizer = models or (face_detector, face_recognizer)
+    if recognizer is None:
+        return None, "Models not initialized (missing ONNX files?)"
+    h, w = crop_bgr.shape[:2]
+    # alignCrop only reads the landmarks; box and score are placeholders
+    face = np.array([0, 0, w, h, *np.asarray(landmarks, dtype=np.float32).ravel(), 1.0], dtype=np.float32)
+    try:
+        return recognizer.alignCrop(crop_bgr, face), None
+    except Exception as e:
+        return None, f"Processing error: {str(e)}"
+
+def embed_aligned(crop_bgr, models=None):
+    """128D encoding of an aligned crop: one SFace forward pass. Returns (encoding, error_message)"""
+    _, recognizer = models or (face_detector, face_recognizer)
+    if recognizer is None:
+        return None, "Models not initialized (missing ONNX files?)"
+    try:
+        return recognizer.feature(crop_bgr)[0].tolist(), None
+    except Exception as e:
+        return None, f"Processing error: {str(e)}"
+
+class BatchEmbedder:
+    """
+    SFace over many aligned crops in one forward pass.
+
+    FaceRecognizerSF.feature() takes one crop at a time, so the same ONNX model
+    is also loaded as a plain cv2.dnn net and fed a blob of N crops. The first
+    batch is checked against feature(); if the model rejects batches or the
+    results differ, it falls back to one feature() call per crop.
+    """
+    def __init__(self):
+        self.net = cv2.dnn.readNetFromONNX(str(SFACE_PATH))
+        self.recognizer = cv2.FaceRecognizerSF.create(str(SFACE_PATH), "")
+        self.batched = None # None until the first batch has been checked
+
+    def _forward(self, crops):
+        # Same preprocessing as FaceRecognizerSF::feature (scale 1, no mean, BGR->RGB)
+        blob = cv2.dnn.blobFromImages(crops, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+        self.net.setInput(blob)
+        return self.net.forward().reshape(len(crops), -1)
+
+    def _one_by_one(self, crops):
+        return np.vstack([self.recognizer.feature(crop).reshape(1, -1) for crop in crops])
+
+    def embed(self, crops):
+        """(len(crops), 128) float32 embeddings"""
+        if len(crops) > 1 and self.batched is not False:
+            try:
+                embeddings = self._forward(crops)
+                if self.batched is None:
+                    self.batched = bool(np.allclose(embeddings[0], self._one_by_one(crops[:1])[0], atol=1e-3))
+                    if not self.batched:
+                        print("⚠️ Batched SFace output differs from feature(); embedding crops one by one")
+                if self.batched:
+                    return embeddings
+            except cv2.error as e:
+                print(f"⚠️ Batched SFace forward failed, embedding crops one by one: {e}")
+                self.batched = False
+        return self._one_by_one(crops)
+
 def compare_faces(known_encoding, unknown_encoding, threshold=0.4):
     """
     Compare two face encodings.
@@ -162,6 +287,11 @@ def compare_faces(known_encoding, unknown_encoding, threshold=0.4):
         print(f"Comparison error: {e}")
         return False, 1.0
 
+def encode_jpeg(image_array):
+    """JPEG bytes of an RGB numpy array, or None"""
+    ok, buffer = cv2.imencode(".jpg", cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR))
+    return buffer.tobytes() if ok else None
+
 def save_image_to_disk(image_array, path):
     """Save numpy array as image"""
     try:
@@ -0,0 +1,69 @@
+"""
+Fast JSON responses.
+
+Uses orjson when installed, then msgspec, then the stdlib json module. All
+three handle datetimes, dates and NumPy scalars/arrays natively or through
+`_default`, so routes can return query rows and embeddings without running
+them through FastAPI's jsonable_encoder first.
+"""
+import json
+from datetime import datetime, date
+from decimal import Decimal
+
+import numpy as np
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "model_dump"):  # Pydantic models
+        return obj.model_dump()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    BACKEND = "orjson"
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(content):
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    _encoder = msgspec.json.Encoder(enc_hook=_default)
+
+    def dumps(content):
+        return _encoder.encode(content)
+else:
+    BACKEND = "json"
+
+    def dumps(content):
+        return json.dumps(
+            content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """App-wide default response class; return it directly to skip jsonable_encoder"""
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,474 @@
+"""
+Face gallery shared by every worker process through a memory-mapped snapshot,
+kept current through an append-only change log in the database.
+
+Every enrolled SFace embedding is kept as an L2-normalised float32 row.
+Cosine similarity of unit vectors is a dot product, so a probe is compared
+against the whole gallery with one matrix-vector product, and a batch of
+probes with one matrix product.
+
+Change log: every enrollment appends a GalleryChange row (add, update or
+remove, with the embedding) in the same transaction as the student row. The
+latest change id is the gallery revision.
+
+Snapshot: data/gallery/gallery-<generation>.bin holds the gallery as of some
+revision:
+
+    header  64 bytes: magic, version, generation, rows, dim, revision
+    matrix  rows x dim float32
+    ids     rows int64 student ids, ascending
+
+Each process maps the newest snapshot read-only with np.memmap, so the OS page
+cache holds a single copy however many uvicorn/gunicorn workers run. "current"
+names the newest generation; it is replaced atomically after a snapshot is
+fully written, and sync() only re-reads it when its mtime changes.
+
+Workers: poll() (every GALLERY_POLL_SECONDS on a background thread) remaps a
+newer snapshot and applies the log rows after its own revision to a small
+in-memory overlay: new rows are added, replaced or removed students are masked
+out of the mapped matrix. No worker reloads the students table.
+
+Writers: refresh(db) also folds the overlay into the next snapshot generation
+under an exclusive file lock. Bulk enrollment and jobs call it after each
+batch. Single registrations only poll; maybe_refresh(), also run by the
+poller, publishes once GALLERY_PUBLISH_CHANGES log rows or
+GALLERY_PUBLISH_SECONDS have piled up in the overlay, so one enrollment does
+not rewrite the whole matrix and overlays still stay small.
+"""
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import func, insert, select, literal, or_, DateTime, String
+
+from database import SessionLocal
+from models import Student, GalleryChange
+
+try:
+    import fcntl
+except ImportError:  # Windows: publishers are not serialised, the last rename wins
+    fcntl = None
+
+EMBEDDING_DIM = 128
+GALLERY_DIR = Path(os.getenv("GALLERY_DIR", "../data/gallery"))
+GALLERY_POLL_SECONDS = float(os.getenv("GALLERY_POLL_SECONDS", "0.5"))
+GALLERY_PUBLISH_CHANGES = int(os.getenv("GALLERY_PUBLISH_CHANGES", "256"))
+GALLERY_PUBLISH_SECONDS = float(os.getenv("GALLERY_PUBLISH_SECONDS", "300"))
+
+# Change ids are handed out before commit (PostgreSQL sequences), so a later id can
+# become visible first; ids skipped over are re-checked for this long.
+GAP_RETRY_SECONDS = 10
+
+# Similarity at or above which a new enrollment is treated as an already enrolled face.
+# Attendance accepts a match at distance < 0.5 (similarity > 0.5), so anything above
+# that would make recognition ambiguous between the two records.
+DUPLICATE_SIMILARITY = float(os.getenv("ENROLL_DUPLICATE_SIMILARITY", "0.5"))
+DUPLICATE_MODE = os.getenv("ENROLL_DUPLICATE_MODE", "reject") # "reject" or "flag"
+
+MAGIC = b"FGAL"
+VERSION = 2
+HEADER = struct.Struct("<4sIQQIQ") # magic, version, generation, rows, dim, revision
+HEADER_SIZE = 64
+
+
+def normalize(vectors):
+    """(n, EMBEDDING_DIM) float32 rows scaled to unit length"""
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+def _valid(encoding):
+    return bool(encoding) and len(encoding) == EMBEDDING_DIM
+
+
+def _replace_file(path, data):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        for chunk in data:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# --- Change log ---
+
+def record_change(db, student_id, action, encoding=None):
+    """Log one change; commit it together with the student row"""
+    db.add(GalleryChange(student_id=student_id, action=action, encoding=encoding if action != "remove" else None))
+
+
+def record_added(db, registration_numbers):
+    """Log every enrolled student among `registration_numbers` (after a bulk insert) with one statement"""
+    registration_numbers = list(registration_numbers)
+    if not registration_numbers:
+        return
+    db.execute(insert(GalleryChange).from_select(
+        ["student_id", "action", "encoding", "created_at"],
+        select(Student.id, literal("add", String), Student.face_encoding, literal(datetime.now(), DateTime))
+        .where(Student.registration_number.in_(registration_numbers), Student.face_encoding.isnot(None))
+        .order_by(Student.id)
+    ))
+
+
+def ensure_change_log(db):
+    """Seed the log from the students table once (databases enrolled before the log existed)"""
+    if db.query(GalleryChange.id).first() is not None:
+        return 0
+    db.execute(insert(GalleryChange).from_select(
+        ["student_id", "action", "encoding", "created_at"],
+        select(Student.id, literal("add", String), Student.face_encoding, literal(datetime.now(), DateTime))
+        .where(Student.face_encoding.isnot(None))
+        .order_by(Student.id)
+    ))
+    db.commit()
+    return db.query(func.count(GalleryChange.id)).scalar()
+
+
+class FaceGallery:
+    def __init__(self, directory=GALLERY_DIR):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        # Mapped snapshot. Arrays are replaced, never modified in place.
+        self._base_ids = np.empty(0, dtype=np.int64)
+        self._base_matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self._base_revision = 0
+        self.generation = 0
+        self._current_mtime = None
+        self._reset_overlay()
+        self._poller = None
+
+    def _reset_overlay(self):
+        self.revision = self._base_revision
+        self._base_alive = None # bool mask over the snapshot rows once something was replaced/removed
+        self._extra = {} # student_id -> unit vector added after the snapshot
+        self._gaps = {} # change id -> first seen missing (monotonic)
+        self._overlay_since = None # monotonic time the overlay got its first change
+        self._view = None
+
+    def __len__(self):
+        alive = len(self._base_ids) if self._base_alive is None else int(self._base_alive.sum())
+        return alive + len(self._extra)
+
+    # --- Snapshot files ---
+
+    @property
+    def _current_path(self):
+        return self.directory / "current"
+
+    def _snapshot_path(self, generation):
+        return self.directory / f"gallery-{generation}.bin"
+
+    def _published_generation(self):
+        try:
+            return int(self._current_path.read_text().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _map(self, generation):
+        """Point this process at snapshot `generation` (caller holds self._lock)"""
+        path = self._snapshot_path(generation)
+        with open(path, "rb") as f:
+            magic, version, file_generation, rows, dim, revision = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or dim != EMBEDDING_DIM or file_generation != generation:
+            raise ValueError(f"{path} is not a gallery snapshot")
+        if rows:
+            self._base_matrix = np.memmap(path, dtype=np.float32, mode="r", offset=HEADER_SIZE, shape=(rows, dim))
+            self._base_ids = np.memmap(path, dtype=np.int64, mode="r", offset=HEADER_SIZE + rows * dim * 4, shape=(rows,))
+        else:
+            self._base_ids = np.empty(0, dtype=np.int64)
+            self._base_matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        self.generation = generation
+        self._base_revision = revision
+        self._reset_overlay()
+
+    def _write(self, generation, ids, matrix, revision):
+        header = HEADER.pack(MAGIC, VERSION, generation, len(ids), EMBEDDING_DIM, revision).ljust(HEADER_SIZE, b"\0")
+        _replace_file(self._snapshot_path(generation), [
+            header, np.ascontiguousarray(matrix, dtype=np.float32).tobytes(), ids.astype(np.int64).tobytes()
+        ])
+        _replace_file(self._current_path, [str(generation).encode()])
+
+    def _prune(self):
+        # Keep the previous generation for processes that have not remapped yet
+        for path in self.directory.glob("gallery-*.bin"):
+            try:
+                if int(path.stem.split("-", 1)[1]) < self.generation - 1:
+                    path.unlink()
+            except (ValueError, OSError):
+                pass # Still mapped on Windows; retried next publish
+
+    def sync(self):
+        """Cheap check for a newer published snapshot; remap if there is one"""
+        try:
+            mtime = self._current_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._current_mtime:
+            return False
+        with self._lock:
+            self._current_mtime = mtime
+            generation = self._published_generation()
+            if generation == self.generation:
+                return False
+            try:
+                self._map(generation)
+            except (OSError, ValueError, struct.error) as e:
+                print(f"⚠️ Ignoring gallery snapshot {generation}: {e}")
+                return False
+            return True
+
+    # --- Change log ---
+
+    def _apply(self, changes):
+        """Fold log rows into the overlay (caller holds self._lock)"""
+        # Searches may hold the current mask; modify a copy
+        if self._base_alive is not None:
+            self._base_alive = self._base_alive.copy()
+        for change_id, student_id, action, encoding in changes:
+            if change_id <= self.revision and change_id not in self._gaps:
+                continue # Applied by a concurrent poll, or already in a newer snapshot
+            self._gaps.pop(change_id, None)
+            if change_id > self.revision:
+                now = time.monotonic()
+                if self._overlay_since is None:
+                    self._overlay_since = now
+                for missing in range(self.revision + 1, change_id):
+                    self._gaps[missing] = now
+                self.revision = change_id
+            self._extra.pop(student_id, None)
+            row = np.searchsorted(self._base_ids, student_id)
+            if row < len(self._base_ids) and self._base_ids[row] == student_id:
+                if self._base_alive is None:
+                    self._base_alive = np.ones(len(self._base_ids), dtype=bool)
+                self._base_alive[row] = False
+            if action != "remove" and _valid(encoding):
+                self._extra[student_id] = normalize(encoding)[0]
+        self._view = None
+
+    def _pending_changes(self, db):
+        # The poller and request threads poll concurrently: read and prune under the
+        # lock, query without it; _apply() skips rows another poll applied meanwhile
+        now = time.monotonic()
+        with self._lock:
+            self._gaps = {i: seen for i, seen in self._gaps.items() if now - seen < GAP_RETRY_SECONDS}
+            revision, gaps = self.revision, list(self._gaps)
+        after = GalleryChange.id > revision
+        if gaps:
+            after = or_(after, GalleryChange.id.in_(gaps))
+        return self._change_rows(db).filter(after).order_by(GalleryChange.id).all()
+
+    def _change_rows(self, db):
+        """Query of (id, student_id, action, encoding) log rows as this gallery sees them"""
+        return db.query(GalleryChange.id, GalleryChange.student_id, GalleryChange.action, GalleryChange.encoding)
+
+    def poll(self, db):
+        """Remap a newer snapshot, then apply log rows newer than our revision; returns rows applied"""
+        self.sync()
+        changes = self._pending_changes(db)
+        if not changes:
+            return 0
+        with self._lock:
+            self._apply(changes)
+        return len(changes)
+
+    def start_polling(self, interval=GALLERY_POLL_SECONDS):
+        """Apply changes from other workers on a timer so this process converges without a request"""
+        if self._poller is not None:
+            return
+
+        def loop():
+            while True:
+                db = SessionLocal()
+                try:
+                    self.maybe_refresh(db)
+                except Exception as e:
+                    print(f"⚠️ Gallery poll failed: {e}")
+                finally:
+                    db.close()
+                time.sleep(interval)
+
+        self._poller = threading.Thread(target=loop, name="gallery-poll", daemon=True)
+        self._poller.start()
+
+    def maybe_refresh(self, db):
+        """poll(), then refresh() only if the overlay holds enough changes or has held them long enough"""
+        self.poll(db)
+        if not self._publish_due():
+            return False
+        return self.refresh(db)
+
+    def _publish_due(self):
+        with self._lock:
+            changes, since = self.revision - self._base_revision, self._overlay_since
+        if not changes:
+            return False
+        return changes >= GALLERY_PUBLISH_CHANGES or (since is not None and time.monotonic() - since >= GALLERY_PUBLISH_SECONDS)
+
+    def refresh(self, db):
+        """Bring this process up to date and publish a snapshot that includes every logged change"""
+        self.poll(db)
+        with self._lock:
+            if self.revision == self._base_revision:
+                return False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / "gallery.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have published while we waited for the lock
+            self.poll(db)
+            with self._lock:
+                if self.revision == self._base_revision:
+                    return True
+                ids, matrix = self._merged()
+                order = np.argsort(ids, kind="stable")
+                self._write(self.generation + 1, ids[order], matrix[order], self.revision)
+                overlay_revision, gaps = self.revision, self._gaps
+                self._map(self.generation + 1)
+                self._gaps = gaps # Still unseen; keep waiting for them
+                self._current_mtime = None
+                self._prune()
+            print(f"✅ Face gallery generation {self.generation}: {len(self)} embeddings (revision {overlay_revision})")
+            return True
+
+    # --- Search ---
+
+    def _parts(self):
+        """Snapshot (ids, matrix, alive mask) and overlay (ids, matrix) (caller holds self._lock)"""
+        if self._view is None:
+            extra_ids = np.fromiter(self._extra.keys(), dtype=np.int64, count=len(self._extra))
+            extra_matrix = (
+                np.stack(list(self._extra.values())) if self._extra
+                else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+            )
+            self._view = (self._base_ids, self._base_matrix, self._base_alive, extra_ids, extra_matrix)
+        return self._view
+
+    def _merged(self):
+        """Every live row as (ids, matrix); copies the mapped matrix, so only used to publish"""
+        base_ids, base_matrix, alive, extra_ids, extra_matrix = self._parts()
+        if alive is not None:
+            base_ids, base_matrix = base_ids[alive], base_matrix[alive]
+        return np.concatenate([base_ids, extra_ids]), np.vstack([base_matrix, extra_matrix])
+
+    def _similarities(self, probes):
+        """(ids, sims) with sims[i, j] = probe i . row j; replaced/removed rows score -inf"""
+        with self._lock:
+            base_ids, base_matrix, alive, extra_ids, extra_matrix = self._parts()
+        # The mapped matrix is searched in place; the overlay is a separate small product
+        sims = probes @ base_matrix.T
+        if alive is not None:
+            sims[:, ~alive] = -np.inf
+        if len(extra_ids):
+            return np.concatenate([base_ids, extra_ids]), np.hstack([sims, probes @ extra_matrix.T])
+        return base_ids, sims
+
+    def search(self, encoding, k=1):
+        """[(student_id, similarity)] of the k most similar students, best first"""
+        ids, sims = self._similarities(normalize(encoding))
+        sims = sims[0]
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        return [(int(ids[i]), float(sims[i])) for i in top]
+
+    def search_batch(self, encodings):
+        """Best (student_ids, similarities) per probe row; id -1 when the gallery is empty"""
+        probes = normalize(encodings)
+        if not len(self) or not len(probes):
+            return np.full(len(probes), -1, dtype=np.int64), np.full(len(probes), -1.0, dtype=np.float32)
+        ids, sims = self._similarities(probes)
+        best = sims.argmax(axis=1)
+        return ids[best], sims[np.arange(len(probes)), best]
+
+    def subset(self, student_ids):
+        """(ids, matrix) of the live rows of `student_ids`; a copy, meant for small scopes"""
+        wanted = np.unique(np.asarray(student_ids, dtype=np.int64))
+        with self._lock:
+            base_ids, base_matrix, alive, extra_ids, extra_matrix = self._parts()
+        rows = np.searchsorted(base_ids, wanted)
+        rows = rows[rows < len(base_ids)]
+        rows = rows[np.isin(base_ids[rows], wanted)]
+        if alive is not None:
+            rows = rows[alive[rows]]
+        extra = np.isin(extra_ids, wanted)
+        return (
+            np.concatenate([base_ids[rows], extra_ids[extra]]),
+            np.vstack([base_matrix[rows], extra_matrix[extra]])
+        )
+
+    def search_subset(self, encodings, student_ids):
+        """search_batch() restricted to `student_ids`"""
+        probes = normalize(encodings)
+        ids, matrix = self.subset(student_ids)
+        if not len(ids) or not len(probes):
+            return np.full(len(probes), -1, dtype=np.int64), np.full(len(probes), -1.0, dtype=np.float32)
+        sims = probes @ matrix.T
+        best = sims.argmax(axis=1)
+        return ids[best], sims[np.arange(len(probes)), best]
+
+
+class DuplicateChecker:
+    """
+    Finds near-duplicate faces in an upload: against the gallery and against
+    earlier faces of the same upload, one matrix product per batch.
+    """
+    def __init__(self, gallery, threshold=DUPLICATE_SIMILARITY):
+        self.gallery = gallery
+        self.threshold = threshold
+        self._labels = [] # reg nos accepted so far in this upload
+        self._accepted = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    def check_batch(self, reg_nos, encodings):
+        """
+        One entry per probe: None, or (match, similarity) where match is a student id
+        from the gallery or a registration number from earlier in the upload.
+        Probes that are not duplicates count as accepted for the rest of the upload.
+        """
+        if not reg_nos:
+            return []
+        probes = normalize(encodings)
+        gallery_ids, gallery_sims = self.gallery.search_batch(probes)
+        upload_sims = probes @ np.vstack([self._accepted, probes]).T
+        offset = len(self._labels)
+
+        matches, accepted = [], []
+        for i, reg_no in enumerate(reg_nos):
+            match = None
+            if gallery_ids[i] >= 0 and gallery_sims[i] >= self.threshold:
+                match = (int(gallery_ids[i]), float(gallery_sims[i]))
+            # Earlier accepted faces: previous batches plus accepted rows of this one
+            candidates = list(range(offset)) + [offset + j for j in accepted]
+            if candidates:
+                row = upload_sims[i, candidates]
+                best = int(row.argmax())
+                if row[best] >= self.threshold and (match is None or row[best] > match[1]):
+                    label = candidates[best]
+                    match = (self._labels[label] if label < offset else reg_nos[label - offset], float(row[best]))
+            matches.append(match)
+            if match is None:
+                accepted.append(i)
+
+        self._labels.extend(reg_nos[i] for i in accepted)
+        self._accepted = np.vstack([self._accepted, probes[accepted]])
+        return matches
+
+
+def describe(db, match):
+    """Human-readable name for a check_batch match"""
+    target, similarity = match
+    if isinstance(target, int):
+        row = db.query(Student.registration_number).filter(Student.id == target).first()
+        target = row.registration_number if row else f"student #{target}"
+    return f"Duplicate face of {target} (similarity {similarity:.2f})"
+
+
+face_gallery = FaceGallery()
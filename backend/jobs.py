@@ -0,0 +1,302 @@
+"""
+Background jobs for long-running admin work (bulk ZIP enrollment).
+
+The upload is saved to a per-job workspace (data/jobs/<id>/upload.zip) and
+split into one JobItem per image, so the HTTP request returns a job id
+immediately. A runner thread works through pending items in batches:
+
+    - item photos are decoded and embedded on JOB_WORKERS threads, each with
+      its own YuNet/SFace pair
+    - near-duplicate faces (already enrolled, or earlier in the same upload)
+      are rejected or flagged as in enrollment.enroll_zip
+    - the batch's students, item statuses and job counters are committed in
+      one transaction (enrollment.insert_batch, as for enroll_zip), so a crash
+      loses at most the batch in progress; photos are written after the commit
+
+Each batch also refreshes Job.heartbeat_at. A job left "running" with a stale
+heartbeat (the process died) or "interrupted" (clean shutdown) can be claimed
+again; it resumes from its pending items. Jobs are resumed at startup and
+through POST /api/jobs/{id}/resume.
+"""
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import update, or_, and_
+
+import bulk_load
+import enrollment
+import gallery
+import password_utils
+from database import SessionLocal
+from models import Job, JobItem
+
+JOBS_DIR = Path(os.getenv("JOBS_DIR", "../data/jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "50"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "120"))
+
+BULK_ENROLL = "bulk_enroll"
+CLAIMABLE = ("queued", "interrupted", "failed")
+
+
+class JobBusy(Exception):
+    """The job is being run by a live runner"""
+
+
+def job_progress(job):
+    finished = job.done + job.failed + job.skipped
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "total": job.total,
+        "done": job.done,
+        "failed": job.failed,
+        "skipped": job.skipped,
+        "pending": max(job.total - finished, 0),
+        "percent": round(100 * finished / job.total, 1) if job.total else 100.0,
+        "error": job.error,
+        "created_by": job.created_by,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "heartbeat_at": job.heartbeat_at,
+        "finished_at": job.finished_at,
+    }
+
+
+class JobRunner:
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+        self._runner = ThreadPoolExecutor(1, thread_name_prefix="job")  # One job at a time
+        self._workers = ThreadPoolExecutor(JOB_WORKERS, thread_name_prefix="job-item")
+        self._local = threading.local()
+        self._stopping = threading.Event()
+
+    # --- Submitting ---
+
+    def submit_bulk_enroll(self, db, fileobj, defer_passwords=False, created_by=None):
+        """Save the upload, create its items and queue the job. Blocking; run it in a worker thread."""
+        job_id = uuid.uuid4().hex
+        workspace = JOBS_DIR / job_id
+        workspace.mkdir(parents=True, exist_ok=True)
+        upload_path = workspace / "upload.zip"
+        try:
+            with open(upload_path, "wb") as out:
+                shutil.copyfileobj(fileobj, out, 1024 * 1024)
+            with zipfile.ZipFile(upload_path) as zf:
+                members = enrollment.list_image_members(zf)
+        except Exception:
+            shutil.rmtree(workspace, ignore_errors=True)
+            raise
+
+        existing = enrollment.existing_registrations(db, {reg_no for reg_no, _ in members})
+        items, seen = [], set()
+        for position, (reg_no, info) in enumerate(members):
+            error = None
+            if reg_no in existing:
+                error = "Already registered"
+            elif reg_no in seen:
+                error = "Duplicate in archive"
+            seen.add(reg_no)
+            items.append({
+                "job_id": job_id, "position": position, "reg_no": reg_no,
+                "member": info.filename, "status": "skipped" if error else "pending", "error": error
+            })
+
+        skipped = sum(1 for item in items if item["status"] == "skipped")
+        job = Job(
+            id=job_id, kind=BULK_ENROLL, status="queued",
+            options={"defer_passwords": bool(defer_passwords)},
+            workspace=str(workspace), created_by=created_by,
+            total=len(items), skipped=skipped
+        )
+        db.add(job)
+        db.flush()
+        bulk_load.bulk_insert(db, JobItem, items)
+        db.commit()
+
+        self.start(job_id)
+        return job
+
+    def start(self, job_id):
+        self._runner.submit(self._run, job_id)
+
+    def resume(self, db, job_id, retry_failed=False):
+        """Queue an unfinished job again; with retry_failed, failed items are retried too"""
+        job = db.get(Job, job_id)
+        if job is None:
+            return None
+        if job.status == "running" and not self._is_stale(job):
+            raise JobBusy(f"Job is running (last heartbeat {job.heartbeat_at})")
+
+        if retry_failed and job.failed:
+            db.execute(
+                update(JobItem)
+                .where(JobItem.job_id == job_id, JobItem.status == "failed")
+                .values(status="pending", error=None)
+            )
+            job.failed = 0
+        if job.status == "completed" and job.done + job.skipped >= job.total:
+            db.commit()
+            return job  # Nothing left to do
+
+        job.status = "queued"
+        job.error = None
+        job.finished_at = None
+        db.commit()
+        self.start(job_id)
+        return job
+
+    def resume_pending(self, db):
+        """Startup hook: pick up queued jobs and jobs whose runner died"""
+        stale = datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)
+        jobs = db.query(Job.id).filter(or_(
+            Job.status.in_(("queued", "interrupted")),
+            and_(Job.status == "running", or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < stale))
+        )).all()
+        for (job_id,) in jobs:
+            self.start(job_id)
+        return len(jobs)
+
+    def shutdown(self):
+        """Stop after the batch in progress; the job is left "interrupted" and resumes at next startup"""
+        self._stopping.set()
+        self._runner.shutdown(wait=True, cancel_futures=True)
+        self._workers.shutdown(wait=True, cancel_futures=True)
+
+    # --- Running ---
+
+    @staticmethod
+    def _is_stale(job):
+        return job.heartbeat_at is None or job.heartbeat_at < datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)
+
+    def _claim(self, db, job_id):
+        """Atomically take ownership; False if another runner holds a live heartbeat"""
+        now = datetime.now()
+        stale = now - timedelta(seconds=JOB_STALE_SECONDS)
+        claimed = db.query(Job).filter(
+            Job.id == job_id,
+            or_(
+                Job.status.in_(CLAIMABLE),
+                and_(Job.status == "running", or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < stale))
+            )
+        ).update(
+            {"status": "running", "heartbeat_at": now, "started_at": now, "error": None},
+            synchronize_session=False
+        )
+        db.commit()
+        return claimed == 1
+
+    def _run(self, job_id):
+        db = SessionLocal()
+        try:
+            if not self._claim(db, job_id):
+                return
+            job = db.get(Job, job_id)
+            print(f"⏳ Job {job_id} ({job.kind}) started: {job.total} items")
+            # Items enrolled before a resume are in the gallery by now
+            gallery.face_gallery.refresh(db)
+            duplicates = gallery.DuplicateChecker(gallery.face_gallery)
+            with zipfile.ZipFile(Path(job.workspace) / "upload.zip") as zf:
+                members = {info.filename: info for info in zf.infolist()}
+                while not self._stopping.is_set():
+                    items = (
+                        db.query(JobItem.id, JobItem.reg_no, JobItem.member)
+                        .filter(JobItem.job_id == job_id, JobItem.status == "pending")
+                        .order_by(JobItem.position)
+                        .limit(JOB_BATCH_SIZE)
+                        .all()
+                    )
+                    if not items:
+                        break
+                    self._enroll_batch(db, job, zf, members, items, duplicates)
+
+            if self._stopping.is_set():
+                job.status = "interrupted"
+                print(f"⚠️ Job {job_id} interrupted at {job.done + job.failed + job.skipped}/{job.total}")
+            else:
+                job.status = "completed"
+                job.finished_at = datetime.now()
+                print(f"✅ Job {job_id} completed: {job.done} enrolled, {job.failed} failed, {job.skipped} skipped")
+            db.commit()
+            if job.status == "completed" and not job.failed:
+                shutil.rmtree(job.workspace, ignore_errors=True)  # Upload kept only while items may be retried
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Job {job_id} failed: {e}")
+            db.query(Job).filter(Job.id == job_id).update(
+                {"status": "failed", "error": str(e), "finished_at": datetime.now()},
+                synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _models(self):
+        # Model objects are not thread-safe; every item thread loads its own pair
+        if not hasattr(self._local, "models"):
+            self._local.models = enrollment.load_models()
+        return self._local.models
+
+    def _process_item(self, zf, info):
+        """(encoding, JPEG bytes of the photo, error) for one member"""
+        if info is None:
+            return None, None, "Missing from archive"
+        try:
+            image_array = enrollment.decode_member(zf, info)
+            encoding = enrollment.embed(image_array, self._models())
+            return encoding, enrollment.encode_photo(image_array), None
+        except enrollment.EnrollmentError as e:
+            return None, None, str(e)
+        except Exception as e:
+            return None, None, f"Processing error: {e}"
+
+    def _enroll_batch(self, db, job, zf, members, items, duplicates):
+        results = list(self._workers.map(
+            lambda item: self._process_item(zf, members.get(item.member)), items
+        ))
+
+        # Someone may have registered these students since the job was created
+        taken = enrollment.existing_registrations(
+            db, {item.reg_no for item, (_, _, error) in zip(items, results) if not error}
+        )
+        candidates = [
+            (item, encoding, jpeg) for item, (encoding, jpeg, error) in zip(items, results)
+            if not error and item.reg_no not in taken
+        ]
+        batch = [(item.reg_no, encoding, jpeg) for item, encoding, jpeg in candidates]
+
+        def hash_passwords(kept):
+            if job.options.get("defer_passwords"):
+                return [password_utils.DEFERRED_PASSWORD_HASH] * len(kept)
+            return password_utils.hash_many([batch[position][0] for position in kept])
+
+        outcomes, images = enrollment.insert_batch(db, duplicates, batch, hash_passwords)
+        outcomes = {item.id: outcome for (item, _, _), outcome in zip(candidates, outcomes)}
+
+        updates = []
+        for item, (_, _, error) in zip(items, results):
+            if error:
+                updates.append({"id": item.id, "status": "failed", "error": error})
+            elif item.reg_no in taken:
+                updates.append({"id": item.id, "status": "skipped", "error": "Already registered"})
+            else:
+                status, note = outcomes[item.id]
+                # Flagged duplicates are enrolled with the note kept on the item
+                updates.append({"id": item.id, "status": "failed" if status == "duplicate" else "done", "error": note})
+        db.execute(update(JobItem), updates)
+        counts = {status: sum(1 for u in updates if u["status"] == status) for status in ("done", "failed", "skipped")}
+        job.done += counts["done"]
+        job.failed += counts["failed"]
+        job.skipped += counts["skipped"]
+        job.heartbeat_at = datetime.now()
+        db.commit()
+        enrollment.write_student_images(images, self.images_dir)
+        if images:
+            gallery.face_gallery.refresh(db)
@@ -0,0 +1,64 @@
+"""
+Edge kiosk request signing.
+
+An admin registers a kiosk and hands it a shared secret. The kiosk signs the
+raw request body with HMAC-SHA256 and sends the hex digest in the
+X-Kiosk-Signature header; the body carries kiosk_id, a unix timestamp and a
+random nonce. A request is accepted once: the timestamp must be within
+KIOSK_MAX_SKEW_SECONDS of the server clock and the nonce is stored (unique per
+kiosk) in the same transaction as the attendance it records, so a captured
+request cannot be replayed, even against another web worker.
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import Kiosk, KioskNonce
+
+KIOSK_MAX_SKEW_SECONDS = int(os.getenv("KIOSK_MAX_SKEW_SECONDS", "60"))
+KIOSK_MAX_BATCH = int(os.getenv("KIOSK_MAX_BATCH", "64")) # Embeddings per request
+SIGNATURE_HEADER = "X-Kiosk-Signature"
+
+
+class KioskAuthError(Exception):
+    """Unknown kiosk, bad signature, stale timestamp or replayed nonce"""
+
+
+def new_secret():
+    return secrets.token_urlsafe(32)
+
+
+def sign(secret, body):
+    """Hex HMAC-SHA256 of the raw request body; kiosks compute the same"""
+    return hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify_request(db, body, signature, kiosk_id, timestamp, nonce):
+    """Returns the Kiosk; the nonce is added to the session, so the caller's commit consumes it"""
+    kiosk = db.query(Kiosk).filter(Kiosk.kiosk_id == kiosk_id, Kiosk.is_active == 1).first()
+    if kiosk is None:
+        raise KioskAuthError("Unknown or inactive kiosk")
+    if not signature or not hmac.compare_digest(sign(kiosk.secret, body), signature.lower()):
+        raise KioskAuthError("Invalid signature")
+    if abs(time.time() - timestamp) > KIOSK_MAX_SKEW_SECONDS:
+        raise KioskAuthError("Request timestamp outside the allowed window; check the kiosk clock")
+
+    now = datetime.now()
+    # Anything older than the window would be rejected by the timestamp check anyway
+    db.query(KioskNonce).filter(
+        KioskNonce.kiosk_id == kiosk.id,
+        KioskNonce.created_at < now - timedelta(seconds=2 * KIOSK_MAX_SKEW_SECONDS)
+    ).delete(synchronize_session=False)
+    try:
+        with db.begin_nested():
+            db.add(KioskNonce(kiosk_id=kiosk.id, nonce=nonce, created_at=now))
+    except IntegrityError:
+        raise KioskAuthError("Nonce already used")
+
+    kiosk.last_seen_at = now
+    return kiosk
@@ -1,26 +1,47 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from typing import List, Optional
 import os
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from pathlib import Path
 import json
 import secrets
+import asyncio
 import io
+from contextlib import asynccontextmanager
+import cv2
+import numpy as np
 
-from database import engine, get_db, Base
-from models import Student, Attendance, Admin
+from database import engine, get_db, Base, STREAM_BATCH_SIZE
+from models import Student, Attendance, Admin, Job, JobItem, Kiosk, Course, Room, TimeSlot, CourseEnrollment
 import face_utils
 import qr_utils
 import excel_utils
-from passlib.context import CryptContext
-from pydantic import BaseModel
-
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+import rollup
+import bulk_load
+import archive
+from presence import presence
+import fast_json
+from fast_json import FastJSONResponse
+import enrollment
+import password_utils
+import jobs
+import gallery
+import recognition
+import kiosk_auth
+import timetable
+import shards
+from recent import recent_cache
+from admission import admission, Overloaded, ADMISSION_DEGRADED_MAX_SIDE
+import metrics
+from profiler import profiler, ProfileBusy
+from sql_analytics import analytics_engine
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
 class LoginRequest(BaseModel):
     username: str
@@ -28,23 +49,31 @@ class LoginRequest(BaseModel):
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+archive.ensure_indexes(engine)
 
-app = FastAPI(title="Student Attendance System")
+app = FastAPI(title="Student Attendance System", default_response_class=FastJSONResponse)
 
 # CORS
+ALLOWED_ORIGINS = [
+    "http://localhost:8000",
+    "http://localhost:5000",
+    "http://127.0.0.1:8000",
+    "http://127.0.0.1:5000",
+    "https://amit123103.github.io",
+]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:8000",
-        "http://localhost:5000",
-        "http://127.0.0.1:8000",
-        "http://127.0.0.1:5000",
-        "https://amit123103.github.io",
-    ],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Retry-After/X-Capture-Interval are read by scan.html to back off under load
+    expose_headers=["Retry-After", "X-Capture-Interval", "Server-Timing"],
 )
+app.add_middleware(metrics.MetricsMiddleware, timing_allow_origin=ALLOWED_ORIGINS)
+
+# Set to require "Authorization: Bearer <token>" on /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 # Directories
 DATA_DIR = Path("../data")
@@ -55,6 +84,8 @@ ATTENDANCE_IMAGES_DIR = IMAGES_DIR / "attendance"
 for d in [STUDENT_IMAGES_DIR, ATTENDANCE_IMAGES_DIR]:
     d.mkdir(parents=True, exist_ok=True)
 
+job_runner = jobs.JobRunner(STUDENT_IMAGES_DIR)
+
 # Mount static files for images
 app.mount("/images", StaticFiles(directory=str(IMAGES_DIR)), name="images")
 
@@ -77,18 +108,34 @@ async def get_current_admin(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("role") == "student":
             raise HTTPException(status_code=401, detail="Invalid credentials")
     except JWTError:
         raise HTTPException(status_code=401, detail="Could not validate credentials")
     return username
 
+def student_token(token: str = Depends(oauth2_scheme)):
+    """Claims of a student token, including one that may only set a password"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get("role") != "student" or not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+def get_current_student(payload: dict = Depends(student_token)):
+    """Registration number of the logged-in student; tokens awaiting a password are refused"""
+    if payload.get("pwd_change"):
+        raise HTTPException(status_code=403, detail="Set a password first")
+    return payload["sub"]
+
 # --- Auth & Setup ---
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_utils.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_utils.hash_password(password)
 
 @app.on_event("startup")
 def create_default_admin():
@@ -103,6 +150,49 @@ def create_default_admin():
         db.commit()
         print("✅ Default Admin Created: Amitkumar")
 
+@app.on_event("shutdown")
+def stop_password_pool():
+    password_utils.shutdown_pool()
+
+@app.on_event("startup")
+def resume_background_jobs():
+    db = next(get_db())
+    resumed = job_runner.resume_pending(db)
+    if resumed:
+        print(f"⏳ Resuming {resumed} background job(s)")
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    job_runner.shutdown()
+
+@app.on_event("startup")
+def map_face_gallery():
+    # Maps the published snapshot and publishes a new one only if the change log moved on
+    db = next(get_db())
+    if gallery.ensure_change_log(db):
+        print("✅ Face gallery change log seeded from existing students")
+    gallery.face_gallery.refresh(db)
+    gallery.face_gallery.start_polling()
+
+@app.on_event("startup")
+def start_recognition_pool():
+    recognition.pool.start()
+
+@app.on_event("shutdown")
+def stop_recognition_pool():
+    recognition.pool.stop()
+
+@app.on_event("startup")
+def warm_presence_bitmap():
+    db = next(get_db())
+    presence.warm(db)
+
+@app.on_event("startup")
+def build_attendance_rollup():
+    db = next(get_db())
+    if rollup.ensure_built(db):
+        print("✅ Attendance rollup built from existing records")
+
 @app.post("/api/admin/login")
 def login_admin(creds: LoginRequest, db: Session = Depends(get_db)):
     admin = db.query(Admin).filter(Admin.username == creds.username).first()
@@ -135,6 +225,42 @@ class ForgotPasswordRequest(BaseModel):
     email: str
     new_password: str
 
+class SetPasswordRequest(BaseModel):
+    new_password: str
+
+# --- Response Schemas ---
+# Only what clients use; never the face encoding, QR secret, password hash or OTP fields.
+class StudentSummary(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    registration_number: str
+    name: str
+    department: Optional[str] = None
+    year: Optional[str] = None
+    face_image_path: Optional[str] = None
+
+class StudentProfile(StudentSummary):
+    email: Optional[str] = None
+    phone_number: Optional[str] = None
+    is_verified: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+class AttendanceResult(BaseModel):
+    status: str
+    message: str
+    student: Optional[StudentSummary] = None # None for unrecognised kiosk scans
+    confidence: Optional[int] = None
+    timings: Optional[dict] = None # Stage -> ms, with ?debug=1
+
+STUDENT_SUMMARY_COLUMNS = (
+    Student.id, Student.registration_number, Student.name,
+    Student.department, Student.year, Student.face_image_path
+)
+STUDENT_PROFILE_COLUMNS = STUDENT_SUMMARY_COLUMNS + (
+    Student.email, Student.phone_number, Student.is_verified, Student.created_at
+)
+
 def rotate_student_qr(student: Student, db: Session):
     """Generates a NEW QR token for the student"""
     new_token = qr_utils.generate_qr_token()
@@ -183,22 +309,45 @@ def login_student(req: StudentLoginRequest, db: Session = Depends(get_db)):
     if not student:
         raise HTTPException(status_code=401, detail="Invalid credentials")
         
-    if not verify_password(req.password, student.password_hash):
+    # Bulk-enrolled with a deferred password: the registration number logs in once, then a password must be set
+    must_change_password = password_utils.is_deferred(student.password_hash)
+    if must_change_password:
+        if req.password != student.registration_number:
+            raise HTTPException(status_code=401, detail="Invalid credentials")
+    elif not verify_password(req.password, student.password_hash):
         raise HTTPException(status_code=401, detail="Invalid credentials")
         
     # ROTATE QR CODE ON LOGIN (Security Feature)
     rotate_student_qr(student, db)
     
-    # Create Token
-    access_token = create_access_token(data={"sub": student.registration_number, "role": "student"})
+    # Create Token; a deferred password only buys a short-lived token for set-password
+    claims = {"sub": student.registration_number, "role": "student"}
+    if must_change_password:
+        claims.update(pwd_change=True, exp=datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    access_token = create_access_token(data=claims)
     
     return {
         "access_token": access_token,
         "token_type": "bearer",
         "name": student.name,
-        "reg_no": student.registration_number
+        "reg_no": student.registration_number,
+        "must_change_password": must_change_password
     }
 
+@app.post("/api/auth/student/set-password")
+def set_student_password(req: SetPasswordRequest, payload: dict = Depends(student_token), db: Session = Depends(get_db)):
+    student = db.query(Student).filter(Student.registration_number == payload["sub"]).first()
+    if not student:
+        raise HTTPException(status_code=404, detail="Student not found")
+    if req.new_password == student.registration_number:
+        raise HTTPException(status_code=400, detail="Choose a password other than your registration number")
+
+    student.password_hash = get_password_hash(req.new_password)
+    db.commit()
+    # A full token replaces the set-password-only one
+    access_token = create_access_token(data={"sub": student.registration_number, "role": "student"})
+    return {"message": "Password set successfully.", "access_token": access_token, "token_type": "bearer"}
+
 @app.post("/api/auth/student/reset-password")
 def reset_student_password(req: ForgotPasswordRequest, db: Session = Depends(get_db)):
     # Find student by email
@@ -212,20 +361,13 @@ def reset_student_password(req: ForgotPasswordRequest, db: Session = Depends(get
     
     return {"message": "Password reset successfully. Please login with new password."}
 
-@app.get("/api/student/me")
-def get_current_student_profile(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        reg_no = payload.get("sub")
-        # Ensure it's a student token if distinguishing roles
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-        
-    student = db.query(Student).filter(Student.registration_number == reg_no).first()
+@app.get("/api/student/me", response_model=StudentProfile)
+def get_current_student_profile(reg_no: str = Depends(get_current_student), db: Session = Depends(get_db)):
+    student = db.query(*STUDENT_PROFILE_COLUMNS).filter(Student.registration_number == reg_no).first()
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
         
-    return student
+    return StudentProfile.model_validate(student)
 
 
 @app.post("/api/students/register")
@@ -253,6 +395,15 @@ async def register_student(
     if error:
         raise HTTPException(status_code=400, detail=error)
 
+    # Same face under another registration number?
+    gallery.face_gallery.poll(db)
+    possible_duplicate = None
+    nearest = gallery.face_gallery.search(encoding)
+    if nearest and nearest[0][1] >= gallery.DUPLICATE_SIMILARITY:
+        possible_duplicate = gallery.describe(db, nearest[0])
+        if gallery.DUPLICATE_MODE != "flag":
+            raise HTTPException(status_code=409, detail=possible_duplicate)
+
     # Save Image
     filename = f"{registration_number}_{int(datetime.now().timestamp())}.jpg"
     image_path = STUDENT_IMAGES_DIR / filename
@@ -273,10 +424,17 @@ async def register_student(
         qr_payload=qr_payload
     )
     db.add(student)
+    db.flush()
+    gallery.record_change(db, student.id, "add", encoding)
     db.commit()
     db.refresh(student)
-    
-    return {"message": "Student registered successfully", "student_id": student.id}
+    # Visible here at once through the overlay; a snapshot is published once enough changes pile up
+    gallery.face_gallery.maybe_refresh(db)
+
+    result = {"message": "Student registered successfully", "student_id": student.id}
+    if possible_duplicate:
+        result["possible_duplicate"] = possible_duplicate
+    return result
 
 @app.get("/api/students/{reg_no}/qr")
 def get_student_qr(reg_no: str, db: Session = Depends(get_db)):
@@ -287,98 +445,525 @@ def get_student_qr(reg_no: str, db: Session = Depends(get_db)):
     img_bytes = qr_utils.create_qr_code(student.qr_payload)
     return StreamingResponse(img_bytes, media_type="image/png")
 
-@app.get("/api/students/{reg_no}")
+@app.get("/api/students/{reg_no}", response_model=StudentSummary)
 def get_student_details(reg_no: str, db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.registration_number == reg_no).first()
+    student = db.query(*STUDENT_SUMMARY_COLUMNS).filter(Student.registration_number == reg_no).first()
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
-    return student
+    return StudentSummary.model_validate(student)
 
 # --- Attendance ---
 
-@app.post("/api/attendance/face")
+def already_marked_today(db: Session, student_id: int, today_str: str, method: str = None):
+    """Duplicate check: answered from the presence bitmap when possible, else from the DB"""
+    if presence.is_marked(student_id, method):
+        return True
+
+    query = db.query(Attendance.method).filter(
+        Attendance.student_id == student_id,
+        Attendance.date == today_str
+    )
+    if method:
+        query = query.filter(Attendance.method == method)
+    row = query.first()
+    if row:
+        presence.mark(student_id, row.method)
+        return True
+    return False
+
+@app.post("/api/attendance/face", response_model=AttendanceResult, response_model_exclude_none=True)
 async def mark_face_attendance(
     image: UploadFile = File(None), 
+    kiosk_id: Optional[str] = Form(None),
+    shard_keys: Optional[str] = Form(None, alias="shards"),
+    debug: bool = False,
     db: Session = Depends(get_db)
 ):
+    """
+    kiosk_id (optional) names the room's kiosk: its current session's students are matched first,
+    and repeat scans of students it recognized recently are answered from the recent cache.
+    shards (optional, comma-separated keys such as "CSE") limits the search to those gallery shards.
+    ?debug=1 adds the Server-Timing stage breakdown to the body as "timings".
+    """
     if not image:
         raise HTTPException(status_code=400, detail="No image provided")
         
     content = await image.read()
-    input_image = face_utils.decode_image(io.BytesIO(content))
-    
-    if input_image is None:
-        raise HTTPException(status_code=400, detail="Invalid image")
-        
-    start_time = datetime.now()
-    
-    # Get encoding of input face
-    unknown_encoding, error = face_utils.get_face_embedding(input_image)
+    scope = recognition_scope(db, kiosk_id, shard_keys)
+
+    async with recognition_slot() as degraded:
+        # Decoding a camera frame takes milliseconds: keep it off the event loop
+        with metrics.stage("decode"):
+            input_image = await run_in_threadpool(face_utils.decode_image, io.BytesIO(content))
+        if input_image is None:
+            raise HTTPException(status_code=400, detail="Invalid image")
+        if degraded:
+            input_image = await run_in_threadpool(face_utils.downscale, input_image, ADMISSION_DEGRADED_MAX_SIDE)
+
+        # Embed and search the gallery (in a recognition worker process when enabled)
+        match = await run_recognition(recognition.recognize, input_image, scope)
+    return with_timings(attend_face_match(db, match, input_image, kiosk_id), debug)
+
+@app.post("/api/attendance/face-crop", response_model=AttendanceResult, response_model_exclude_none=True)
+async def mark_face_crop_attendance(
+    crop: UploadFile = File(...),
+    landmarks: Optional[str] = Form(None),
+    kiosk_id: Optional[str] = Form(None),
+    shard_keys: Optional[str] = Form(None, alias="shards"),
+    debug: bool = False,
+    db: Session = Depends(get_db)
+):
+    """
+    For kiosks that run a face detector: upload the face crop instead of the frame.
+    Without landmarks the crop must already be aligned (112x112, as from alignCrop);
+    with landmarks (JSON, 5 [x, y] points in YuNet order, crop pixels) it is aligned here.
+    Either way the server runs one SFace forward pass and no detection.
+    """
+    # One byte over the limit is enough to refuse it without reading the rest
+    content = await crop.read(face_utils.MAX_CROP_BYTES + 1)
+    with metrics.stage("decode"):
+        crop_bgr, error = face_utils.decode_crop(content)
     if error:
-        # If no face or multiple faces
         raise HTTPException(status_code=400, detail=error)
-    
-    # Compare with all students (Basic approach - can be optimized with FAISS for millions)
-    students = db.query(Student).filter(Student.face_encoding.isnot(None)).all()
-    
-    best_match = None
-    best_distance = 1.0
-    threshold = 0.5 # Strict threshold
-    
-    for student in students:
-        if not student.face_encoding: continue
-        
-        is_match, dist = face_utils.compare_faces(student.face_encoding, unknown_encoding, threshold)
-        if is_match and dist < best_distance:
-            best_distance = dist
-            best_match = student
-            
+
+    height, width = crop_bgr.shape[:2]
+    if landmarks:
+        try:
+            points = np.array(json.loads(landmarks), dtype=np.float32).reshape(5, 2)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="landmarks must be 5 [x, y] points")
+        crop_bgr, error = face_utils.align_with_landmarks(crop_bgr, points)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+    elif (width, height) != face_utils.ALIGNED_SIZE:
+        raise HTTPException(status_code=400, detail="Aligned crops must be 112x112; send landmarks to have the crop aligned")
+
+    scope = recognition_scope(db, kiosk_id, shard_keys)
+    async with recognition_slot():
+        match = await run_recognition(recognition.recognize_crop, crop_bgr, scope)
+    return with_timings(attend_face_match(db, match, cv2.cvtColor(crop_bgr, cv2.COLOR_BGR2RGB), kiosk_id), debug)
+
+def with_timings(result: dict, debug: bool):
+    """The result with this request's stage timings (ms) when ?debug=1"""
+    if not debug:
+        return result
+    return dict(result, timings={name: round(ms, 2) for name, ms in metrics.request_timings().items()})
+
+def recognition_scope(db: Session, kiosk_id: Optional[str], shard_keys):
+    """The kiosk's recent students, current session and declared gallery shards; 400 for unknown shards"""
+    shard_keys = shards.parse_shards(shard_keys)
+    unknown = shards.shard_set.unknown(shard_keys, db)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown gallery shards: {', '.join(unknown)}")
+    # Only an explicit kiosk id keys the recent cache: kiosks behind one NAT share an address
+    return recognition.Scope(timetable.scope_for(db, kiosk_id), shard_keys, recent_cache.candidates(kiosk_id))
+
+@asynccontextmanager
+async def recognition_slot():
+    """Admission-controlled recognition; yields whether to run degraded. Sheds load with 503."""
+    try:
+        async with admission.admit() as degraded:
+            yield degraded
+    except Overloaded as e:
+        metrics.RECOGNITIONS.labels("none", "shed").inc()
+        raise HTTPException(status_code=503, detail=str(e), headers=e.headers())
+
+async def run_recognition(recognize, image, scope=None):
+    try:
+        match = await recognize(image, scope)
+    except recognition.RecognitionBusy:
+        raise admission.busy()
+    except (TimeoutError, asyncio.TimeoutError):
+        metrics.RECOGNITIONS.labels("none", "timeout").inc()
+        raise HTTPException(status_code=504, detail="Recognition timed out")
+    metrics.observe_timings(match["timings"])
+    outcome = "error" if match["error"] else "matched" if match["student_id"] is not None else "unknown"
+    metrics.RECOGNITIONS.labels(match["scope"] or "none", outcome).inc()
+    if match["error"]:
+        # If no face or multiple faces
+        raise HTTPException(status_code=400, detail=match["error"])
+    return match
+
+def recent_duplicate(kiosk: Optional[str], match: dict, today_str: str):
+    """Duplicate response for a repeat frame of a student this kiosk already marked today, else None"""
+    if match["scope"] != "recent":
+        return None
+    entry = recent_cache.get(kiosk, match["student_id"])
+    if entry is None or entry["marked_on"] != today_str:
+        return None
+    return {
+        "status": "duplicate",
+        "message": f"Already marked for {entry['student'].name}",
+        "student": StudentSummary.model_validate(entry["student"]),
+        "confidence": max(int(match["similarity"] * 100), 0)
+    }
+
+def attend_face_match(db: Session, match: dict, proof_image, kiosk: Optional[str] = None):
+    """Attendance response for a recognition result; 400 when no student matched"""
+    today_str = date.today().isoformat()
+    repeat = recent_duplicate(kiosk, match, today_str)
+    if repeat:
+        return repeat # No database round trip for a student still standing at the kiosk
+
+    best_match = match["student_id"]
+    best_distance = 1.0 - match["similarity"] if best_match else 1.0
+
+    if best_match:
+        with metrics.stage("db_read"):
+            best_match = db.query(*STUDENT_SUMMARY_COLUMNS).filter(Student.id == best_match).first()
+
     if best_match:
-        # Check duplicate for today
-        today_str = date.today().isoformat()
-        exists = db.query(Attendance).filter(
-            Attendance.student_id == best_match.id,
-            Attendance.date == today_str,
-            Attendance.method == "FACE"
-        ).first()
-        
         confidence = int((1 - best_distance) * 100)
-        
-        if exists:
-             return {
-                "status": "duplicate",
-                "message": f"Already marked for {best_match.name}",
-                "student": best_match,
-                "confidence": confidence
-            }
-            
+        result = record_face_attendance(db, best_match, confidence, proof_image)
+        if result["status"] == "success":
+            with metrics.stage("db_commit"):
+                db.commit()
+            presence.mark(best_match.id, "FACE")
+        # Success or duplicate, the student is marked today
+        recent_cache.remember(kiosk, best_match.id, match.get("embedding"), best_match, today_str)
+        return result
+    
+    raise HTTPException(status_code=400, detail="Face not recognized")
+
+def record_face_attendance(db: Session, student, confidence: int, proof_image=None):
+    """
+    Add today's FACE attendance for a recognised student (summary row) unless already marked.
+    The caller commits and then marks presence on "success".
+    """
+    today_str = date.today().isoformat()
+    with metrics.stage("db_read"):
+        marked = already_marked_today(db, student.id, today_str, "FACE")
+    if marked:
+        return {
+            "status": "duplicate",
+            "message": f"Already marked for {student.name}",
+            "student": StudentSummary.model_validate(student),
+            "confidence": confidence
+        }
+
+    proof_image_path = None
+    if proof_image is not None:
         # Save proof image
         timestamp_val = int(datetime.now().timestamp())
-        filename = f"attend_{best_match.registration_number}_{timestamp_val}.jpg"
-        face_utils.save_image_to_disk(input_image, ATTENDANCE_IMAGES_DIR / filename)
+        filename = f"attend_{student.registration_number}_{timestamp_val}.jpg"
+        with metrics.stage("proof_image"):
+            face_utils.save_image_to_disk(proof_image, ATTENDANCE_IMAGES_DIR / filename)
+        proof_image_path = f"/images/attendance/{filename}"
 
-        # Mark Attendance
-        att = Attendance(
-            student_id=best_match.id,
-            method="FACE",
-            date=today_str,
-            status="PRESENT",
-            proof_image_path=f"/images/attendance/{filename}"
+    # Mark Attendance
+    att = Attendance(
+        student_id=student.id,
+        method="FACE",
+        date=today_str,
+        status="PRESENT",
+        proof_image_path=proof_image_path
+    )
+    db.add(att)
+    rollup.bump(db, today_str, student.department, "FACE")
+    return {
+        "status": "success",
+        "message": f"Welcome, {student.name}!",
+        "student": StudentSummary.model_validate(student),
+        "confidence": confidence
+    }
+
+# --- Edge Kiosks ---
+
+class KioskScan(BaseModel):
+    embedding: List[float]
+    captured_at: Optional[datetime] = None
+
+class KioskEmbeddingRequest(BaseModel):
+    kiosk_id: str
+    timestamp: int # Unix seconds
+    nonce: str = Field(min_length=8, max_length=64)
+    model_version: str
+    scans: List[KioskScan] = Field(min_length=1, max_length=kiosk_auth.KIOSK_MAX_BATCH)
+    shards: List[str] = [] # Gallery shards to search, e.g. ["CSE"]; empty = everyone
+    metadata: dict = {} # App version, camera, etc. (informational)
+
+class KioskCreateRequest(BaseModel):
+    kiosk_id: str
+    name: str
+    location: Optional[str] = None
+
+@app.post("/api/attendance/kiosk/embeddings")
+async def mark_kiosk_embeddings(request: Request, db: Session = Depends(get_db)):
+    """
+    Attendance from kiosks that run YuNet/SFace themselves: one or more 128-d
+    embeddings go straight to gallery matching. The raw body must be signed with
+    the kiosk secret (header X-Kiosk-Signature, see kiosk_auth.py).
+    """
+    body = await request.body()
+    try:
+        req = KioskEmbeddingRequest.model_validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+
+    try:
+        kiosk = kiosk_auth.verify_request(
+            db, body, request.headers.get(kiosk_auth.SIGNATURE_HEADER), req.kiosk_id, req.timestamp, req.nonce
         )
-        db.add(att)
-        db.commit()
-        
-        return {
-            "status": "success",
-            "message": f"Welcome, {best_match.name}!",
-            "student": best_match,
-            "confidence": confidence
+    except kiosk_auth.KioskAuthError as e:
+        db.rollback()
+        raise HTTPException(status_code=401, detail=str(e))
+
+    if req.model_version != face_utils.MODEL_VERSION:
+        db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Incompatible model version '{req.model_version}'; server expects '{face_utils.MODEL_VERSION}'"
+        )
+
+    bad = [i for i, scan in enumerate(req.scans)
+           if len(scan.embedding) != gallery.EMBEDDING_DIM or not np.all(np.isfinite(scan.embedding))]
+    if bad:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Scans {bad} are not finite {gallery.EMBEDDING_DIM}-d embeddings")
+
+    try:
+        scope = recognition_scope(db, req.kiosk_id, req.shards)
+    except HTTPException:
+        db.rollback()
+        raise
+
+    # One matrix product for the whole batch (plus one for the room's current session)
+    embeddings = np.array([scan.embedding for scan in req.scans], dtype=np.float32)
+    matches = recognition.match_embeddings(embeddings, scope)
+    today_str = date.today().isoformat()
+    repeats = [recent_duplicate(req.kiosk_id, match, today_str) for match in matches]
+    matched = {
+        match["student_id"] for match, repeat in zip(matches, repeats)
+        if match["student_id"] is not None and repeat is None
+    }
+    students = {
+        row.id: row for row in db.query(*STUDENT_SUMMARY_COLUMNS).filter(Student.id.in_(matched))
+    } if matched else {}
+
+    results, marked = [], []
+    for match, repeat in zip(matches, repeats):
+        confidence = max(int((match["similarity"] or 0) * 100), 0)
+        student = students.get(match["student_id"])
+        if repeat:
+            result = repeat
+        elif student is None:
+            result = {"status": "unknown", "message": "Face not recognized", "confidence": confidence}
+        elif student.id in marked:
+            result = {
+                "status": "duplicate", "message": f"Already marked for {student.name}",
+                "student": StudentSummary.model_validate(student), "confidence": confidence
+            }
+        else:
+            result = record_face_attendance(db, student, confidence)
+            if result["status"] == "success":
+                marked.append(student.id)
+            recent_cache.remember(req.kiosk_id, student.id, match["embedding"], student, today_str)
+        results.append(AttendanceResult(**result).model_dump(exclude_none=True))
+
+    with metrics.stage("db_commit"):
+        db.commit() # Attendance, nonce and last_seen_at together
+    for student_id in marked:
+        presence.mark(student_id, "FACE")
+
+    return {"kiosk_id": kiosk.kiosk_id, "model_version": face_utils.MODEL_VERSION, "results": results}
+
+@app.post("/api/admin/kiosks")
+def register_kiosk(req: KioskCreateRequest, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    """Register an edge kiosk; the secret is only shown in this response"""
+    if db.query(Kiosk).filter(Kiosk.kiosk_id == req.kiosk_id).first():
+        raise HTTPException(status_code=400, detail="Kiosk already registered")
+    kiosk = Kiosk(kiosk_id=req.kiosk_id, name=req.name, location=req.location, secret=kiosk_auth.new_secret())
+    db.add(kiosk)
+    db.commit()
+    return {
+        "kiosk_id": kiosk.kiosk_id,
+        "secret": kiosk.secret,
+        "model_version": face_utils.MODEL_VERSION,
+        "embedding_dim": gallery.EMBEDDING_DIM
+    }
+
+@app.get("/api/admin/kiosks")
+def list_kiosks(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    kiosks = db.query(
+        Kiosk.kiosk_id, Kiosk.name, Kiosk.location, Kiosk.is_active, Kiosk.created_at, Kiosk.last_seen_at
+    ).order_by(Kiosk.kiosk_id)
+    return [dict(row._mapping) for row in kiosks]
+
+@app.delete("/api/admin/kiosks/{kiosk_id}")
+def deactivate_kiosk(kiosk_id: str, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    kiosk = db.query(Kiosk).filter(Kiosk.kiosk_id == kiosk_id).first()
+    if not kiosk:
+        raise HTTPException(status_code=404, detail="Kiosk not found")
+    kiosk.is_active = 0
+    db.commit()
+    return {"message": "Kiosk deactivated"}
+
+# --- Timetable ---
+
+class CourseCreateRequest(BaseModel):
+    code: str
+    name: str
+    department: Optional[str] = None
+
+class CourseEnrollRequest(BaseModel):
+    registration_numbers: List[str]
+
+class RoomCreateRequest(BaseModel):
+    name: str
+    kiosk_id: Optional[str] = None
+
+class TimeSlotCreateRequest(BaseModel):
+    course_code: str
+    room: str
+    weekday: int = Field(ge=0, le=6) # 0 = Monday
+    start_time: str # HH:MM
+    end_time: str
+
+@app.post("/api/admin/courses")
+def create_course(req: CourseCreateRequest, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    if db.query(Course.id).filter(Course.code == req.code).first():
+        raise HTTPException(status_code=400, detail="Course already exists")
+    course = Course(code=req.code, name=req.name, department=req.department)
+    db.add(course)
+    db.commit()
+    return {"id": course.id, "code": course.code, "name": course.name, "department": course.department}
+
+@app.get("/api/admin/courses")
+def list_courses(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    enrolled = (
+        db.query(CourseEnrollment.course_id, func.count(CourseEnrollment.id).label("students"))
+        .group_by(CourseEnrollment.course_id)
+        .subquery()
+    )
+    rows = (
+        db.query(Course.id, Course.code, Course.name, Course.department, func.coalesce(enrolled.c.students, 0).label("students"))
+        .outerjoin(enrolled, enrolled.c.course_id == Course.id)
+        .order_by(Course.code)
+    )
+    return [dict(row._mapping) for row in rows]
+
+@app.post("/api/admin/courses/{code}/enrollments")
+def enroll_course_students(
+    code: str, req: CourseEnrollRequest, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)
+):
+    """Add students to a course by registration number; already enrolled students are left as they are"""
+    course = db.query(Course.id).filter(Course.code == code).first()
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    students = dict(
+        db.query(Student.registration_number, Student.id)
+        .filter(Student.registration_number.in_(set(req.registration_numbers)))
+        .all()
+    )
+    already = {
+        student_id for (student_id,) in db.query(CourseEnrollment.student_id)
+        .filter(CourseEnrollment.course_id == course.id, CourseEnrollment.student_id.in_(students.values()))
+    }
+    new_ids = [student_id for student_id in set(students.values()) if student_id not in already]
+    bulk_load.bulk_insert(db, CourseEnrollment, [{"course_id": course.id, "student_id": i} for i in new_ids])
+    db.commit()
+    timetable.invalidate()
+    return {
+        "enrolled": len(new_ids),
+        "already_enrolled": len(already),
+        "unknown": sorted(set(req.registration_numbers) - students.keys())
+    }
+
+@app.delete("/api/admin/courses/{code}/enrollments/{reg_no}")
+def unenroll_course_student(code: str, reg_no: str, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    enrollment_row = (
+        db.query(CourseEnrollment)
+        .join(Course, Course.id == CourseEnrollment.course_id)
+        .join(Student, Student.id == CourseEnrollment.student_id)
+        .filter(Course.code == code, Student.registration_number == reg_no)
+        .first()
+    )
+    if not enrollment_row:
+        raise HTTPException(status_code=404, detail="Enrollment not found")
+    db.delete(enrollment_row)
+    db.commit()
+    timetable.invalidate()
+    return {"message": "Student removed from course"}
+
+@app.post("/api/admin/rooms")
+def create_room(req: RoomCreateRequest, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    if db.query(Room.id).filter(Room.name == req.name).first():
+        raise HTTPException(status_code=400, detail="Room already exists")
+    if req.kiosk_id and db.query(Room.id).filter(Room.kiosk_id == req.kiosk_id).first():
+        raise HTTPException(status_code=400, detail="Kiosk is already assigned to a room")
+    room = Room(name=req.name, kiosk_id=req.kiosk_id)
+    db.add(room)
+    db.commit()
+    timetable.invalidate()
+    return {"id": room.id, "name": room.name, "kiosk_id": room.kiosk_id}
+
+@app.get("/api/admin/rooms")
+def list_rooms(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return [dict(row._mapping) for row in db.query(Room.id, Room.name, Room.kiosk_id).order_by(Room.name)]
+
+@app.post("/api/admin/timetable")
+def create_time_slot(req: TimeSlotCreateRequest, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    course = db.query(Course.id).filter(Course.code == req.course_code).first()
+    room = db.query(Room.id).filter(Room.name == req.room).first()
+    if not course or not room:
+        raise HTTPException(status_code=404, detail="Course not found" if not course else "Room not found")
+    try:
+        start_time, end_time = timetable.parse_hhmm(req.start_time), timetable.parse_hhmm(req.end_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Times must be HH:MM")
+    if start_time == end_time:
+        raise HTTPException(status_code=400, detail="start_time and end_time must differ")
+    # An end_time before the start_time runs past midnight
+    if timetable.clashing_slot(db, room.id, req.weekday, start_time, end_time):
+        raise HTTPException(status_code=400, detail="Room is already booked at that time")
+    slot = TimeSlot(course_id=course.id, room_id=room.id, weekday=req.weekday, start_time=start_time, end_time=end_time)
+    db.add(slot)
+    db.commit()
+    timetable.invalidate()
+    return {"id": slot.id}
+
+@app.get("/api/admin/timetable")
+def list_time_slots(room: Optional[str] = None, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    query = (
+        db.query(
+            TimeSlot.id, TimeSlot.weekday, TimeSlot.start_time, TimeSlot.end_time,
+            Course.code.label("course_code"), Room.name.label("room"), Room.kiosk_id
+        )
+        .join(Course, Course.id == TimeSlot.course_id)
+        .join(Room, Room.id == TimeSlot.room_id)
+    )
+    if room:
+        query = query.filter(Room.name == room)
+    return [dict(row._mapping) for row in query.order_by(TimeSlot.weekday, TimeSlot.start_time, Room.name)]
+
+@app.delete("/api/admin/timetable/{slot_id}")
+def delete_time_slot(slot_id: int, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    slot = db.get(TimeSlot, slot_id)
+    if not slot:
+        raise HTTPException(status_code=404, detail="Time slot not found")
+    db.delete(slot)
+    db.commit()
+    timetable.invalidate()
+    return {"message": "Time slot deleted"}
+
+@app.get("/api/admin/kiosks/{kiosk_id}/session")
+def get_kiosk_session(kiosk_id: str, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    """The session a kiosk's scans are currently scoped to, if any"""
+    slot = timetable.current_slot(db, kiosk_id)
+    if slot is None:
+        return {"kiosk_id": kiosk_id, "session": None}
+    course = db.get(Course, slot.course_id)
+    students = db.query(func.count(CourseEnrollment.id)).filter(CourseEnrollment.course_id == slot.course_id).scalar()
+    return {
+        "kiosk_id": kiosk_id,
+        "session": {
+            "slot_id": slot.id, "course_code": course.code, "course_name": course.name,
+            "start_time": slot.start_time, "end_time": slot.end_time, "students": students
         }
-    
-    raise HTTPException(status_code=400, detail="Face not recognized")
+    }
 
-@app.post("/api/attendance/qr")
-def mark_qr_attendance(qr_payload: str = Form(...), db: Session = Depends(get_db)):
+@app.post("/api/attendance/qr", response_model=AttendanceResult, response_model_exclude_none=True)
+def mark_qr_attendance(qr_payload: str = Form(...), debug: bool = False, db: Session = Depends(get_db)):
     # Payload format: ATTENDANCE:REG_NO:TOKEN
     try:
         parts = qr_payload.split(":")
@@ -388,7 +973,12 @@ def mark_qr_attendance(qr_payload: str = Form(...), db: Session = Depends(get_db
         reg_no = parts[1]
         token = parts[2]
         
-        student = db.query(Student).filter(Student.registration_number == reg_no).first()
+        with metrics.stage("db_read"):
+            student = (
+                db.query(*STUDENT_SUMMARY_COLUMNS, Student.qr_token)
+                .filter(Student.registration_number == reg_no)
+                .first()
+            )
         if not student:
             raise HTTPException(status_code=404, detail="Student not found")
             
@@ -397,13 +987,14 @@ def mark_qr_attendance(qr_payload: str = Form(...), db: Session = Depends(get_db
             
         # Mark
         today_str = date.today().isoformat()
-        exists = db.query(Attendance).filter(
-            Attendance.student_id == student.id,
-            Attendance.date == today_str
-        ).first() # Any method counts
+        with metrics.stage("db_read"):
+            exists = already_marked_today(db, student.id, today_str) # Any method counts
         
         if exists:
-             return {"status": "duplicate", "message": f"Already marked for {student.name}", "student": student}
+             return with_timings(
+                 {"status": "duplicate", "message": f"Already marked for {student.name}", "student": StudentSummary.model_validate(student)},
+                 debug
+             )
              
         att = Attendance(
             student_id=student.id,
@@ -411,10 +1002,16 @@ def mark_qr_attendance(qr_payload: str = Form(...), db: Session = Depends(get_db
             date=today_str,
             status="PRESENT"
         )
-        db.add(att)
-        db.commit()
+        with metrics.stage("db_commit"):
+            db.add(att)
+            rollup.bump(db, today_str, student.department, "QR")
+            db.commit()
+        presence.mark(student.id, "QR")
         
-        return {"status": "success", "message": "Attendance Marked via QR", "student": student}
+        return with_timings(
+            {"status": "success", "message": "Attendance Marked via QR", "student": StudentSummary.model_validate(student)},
+            debug
+        )
         
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -433,6 +1030,8 @@ async def offset_excel_attendance(
         
     results = {"marked": [], "not_found": [], "duplicates": []}
     today_str = date.today().isoformat()
+    new_rows = []
+    rollup_keys = []
     
     for reg_no in reg_numbers:
         student = db.query(Student).filter(Student.registration_number == str(reg_no)).first()
@@ -440,54 +1039,83 @@ async def offset_excel_attendance(
             results["not_found"].append(reg_no)
             continue
             
-        exists = db.query(Attendance).filter(
-            Attendance.student_id == student.id,
-            Attendance.date == today_str
-        ).first()
+        exists = already_marked_today(db, student.id, today_str)
         
         if exists:
             results["duplicates"].append(reg_no)
         else:
-            att = Attendance(
-                student_id=student.id,
-                method="EXCEL",
-                date=today_str,
-                status="PRESENT"
-            )
-            db.add(att)
+            new_rows.append({
+                "student_id": student.id,
+                "method": "EXCEL",
+                "date": today_str,
+                "status": "PRESENT"
+            })
+            rollup_keys.append((today_str, student.department, "EXCEL"))
             results["marked"].append(reg_no)
             
+    bulk_load.copy_attendance(db, new_rows)
+    rollup.bump_many(db, rollup_keys)
     db.commit()
+    for row in new_rows:
+        presence.mark(row["student_id"], "EXCEL")
     return results
 
+REPORT_COLUMNS = ("Registration No", "Name", "Dept", "Date", "Time", "Method")
+
+def report_rows(date_str: str, db: Session):
+    """Report rows for one day, streamed from the DB (server-side cursor on PostgreSQL)"""
+    attendance = archive.attendance_source(db, date_str, date_str)
+    rows = (
+        db.query(
+            Student.registration_number, Student.name, Student.department,
+            attendance.c.date, attendance.c.timestamp, attendance.c.method
+        )
+        .join(Student, Student.id == attendance.c.student_id)
+        .order_by(attendance.c.timestamp)
+        .yield_per(STREAM_BATCH_SIZE)
+    )
+    for reg_no, name, dept, day, timestamp, method in rows:
+        yield dict(zip(REPORT_COLUMNS, (reg_no, name, dept, day, timestamp.strftime("%H:%M:%S"), method)))
+
+def report_json(rows):
+    """A JSON array, one chunk per STREAM_BATCH_SIZE rows"""
+    yield b"["
+    chunk, first = [], True
+    for row in rows:
+        chunk.append(fast_json.dumps(row))
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield (b"" if first else b",") + b",".join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield (b"" if first else b",") + b",".join(chunk)
+    yield b"]"
+
 @app.get("/api/reports")
 def get_report(
     date_str: str = None, 
+    debug: bool = False,
     db: Session = Depends(get_db),
     admin: str = Depends(get_current_admin)
 ):
+    """?debug=1 wraps the rows as {"rows": [...], "timings": {stage: ms}}"""
     if not date_str:
         date_str = date.today().isoformat()
         
-    attendances = db.query(Attendance).filter(Attendance.date == date_str).all()
-    
-    data = []
-    for att in attendances:
-        data.append({
-            "Registration No": att.student.registration_number,
-            "Name": att.student.name,
-            "Dept": att.student.department,
-            "Date": att.date,
-            "Time": att.timestamp.strftime("%H:%M:%S"),
-            "Method": att.method
-        })
-        
-    return data
+    if debug:
+        # Report stages are kept out of the recognition stage histogram (observe=False)
+        with metrics.stage("db_read", observe=False):
+            rows = list(report_rows(date_str, db))
+        return FastJSONResponse(with_timings({"rows": rows}, debug))
+    # Streamed as the cursor yields, so a day is never held in memory; `db` stays
+    # open until the response is sent
+    return StreamingResponse(report_json(report_rows(date_str, db)), media_type="application/json")
 
 @app.get("/api/reports/download")
 def download_report(date_str: str = None, db: Session = Depends(get_db)):
-    data = get_report(date_str, db)
-    excel_io = excel_utils.generate_report_excel(data)
+    if not date_str:
+        date_str = date.today().isoformat()
+    with metrics.stage("excel", observe=False):
+        excel_io = excel_utils.write_report_excel(REPORT_COLUMNS, report_rows(date_str, db))
     
     return StreamingResponse(
         excel_io,
@@ -495,12 +1123,113 @@ def download_report(date_str: str = None, db: Session = Depends(get_db)):
         headers={"Content-Disposition": f"attachment; filename=attendance_{date_str}.xlsx"}
     )
 
+# --- Analytics ---
+
+@app.get("/api/admin/analytics/summary")
+def get_analytics_summary(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return FastJSONResponse({"success": True, "data": analytics_engine.get_summary_stats(db)})
+
+@app.get("/api/admin/analytics/daily")
+def get_daily_analytics(days: int = 7, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return FastJSONResponse({"success": True, "data": analytics_engine.get_daily_attendance(db, days)})
+
+@app.get("/api/admin/analytics/weekly")
+def get_weekly_analytics(weeks: int = 4, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return FastJSONResponse({"success": True, "data": analytics_engine.get_weekly_trends(db, weeks)})
+
+@app.get("/api/admin/analytics/monthly")
+def get_monthly_analytics(months: int = 6, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return FastJSONResponse({"success": True, "data": analytics_engine.get_monthly_overview(db, months)})
+
+@app.get("/api/admin/analytics/student-percentages")
+def get_student_percentages(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    return FastJSONResponse({"success": True, "data": analytics_engine.get_student_attendance_percentage(db)})
+
+# --- Metrics ---
+
+def _db_pool_usage():
+    pool = engine.pool
+    return {("checked_out",): pool.checkedout(), ("size",): pool.size()}
+
+metrics.gauge("gallery_embeddings", "Enrolled face embeddings in this process's gallery", lambda: len(gallery.face_gallery))
+metrics.gauge("recognition_pending", "Frames queued for recognition worker processes", lambda: recognition.pool.stats()["pending"])
+metrics.gauge(
+    "admission_requests", "Recognition requests holding or waiting for a slot",
+    lambda: {("in_flight",): admission.in_flight, ("waiting",): admission.waiting}, ("state",)
+)
+metrics.gauge("db_pool_connections", "Database connection pool usage", _db_pool_usage, ("state",))
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    """Prometheus scrape endpoint"""
+    if METRICS_TOKEN and not secrets.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/admin/recognition/stats")
+def get_recognition_stats(admin: str = Depends(get_current_admin)):
+    return {"success": True, "data": dict(recognition.stats(), recent=recent_cache.stats(), admission=admission.stats())}
+
+@app.get("/api/admin/gallery/shards")
+def get_gallery_shards(db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    """Shard keys kiosks can declare, with their sizes, and the shards this worker has loaded"""
+    return dict(shards.shard_set.stats(), shards=shards.shard_set.known_keys(db))
+
+# --- Profiling ---
+
+def profiler_call(method, *args, **kwargs):
+    try:
+        return method(*args, **kwargs)
+    except ProfileBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/admin/profile/cpu")
+def profile_cpu(
+    seconds: float = 5, interval_ms: float = 10, idle: bool = False, sampler: str = "builtin",
+    admin: str = Depends(get_current_admin)
+):
+    """
+    Sample this worker's threads for `seconds`; collapsed stacks for flamegraph.pl/speedscope.
+    idle=true keeps parked threads; sampler=py-spy uses py-spy when installed.
+    """
+    stacks = profiler_call(profiler.sample, seconds, interval_ms, idle, sampler)
+    return Response(stacks, media_type="text/plain; charset=utf-8")
+
+@app.post("/api/admin/profile/memory/start")
+def start_memory_tracing(frames: int = 25, admin: str = Depends(get_current_admin)):
+    profiler_call(profiler.start_tracing, frames)
+    return {"success": True, "data": profiler.stats()}
+
+@app.get("/api/admin/profile/memory")
+def get_memory_snapshot(
+    diff: bool = False, format: str = "json", limit: int = 50,
+    admin: str = Depends(get_current_admin)
+):
+    """Top allocations by line (format=json) or allocation stacks weighted by bytes (format=collapsed); diff=true: growth since start"""
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail='format must be "json" or "collapsed"')
+    result = profiler_call(profiler.memory_snapshot, diff, format == "collapsed", limit)
+    if format == "collapsed":
+        return Response(result, media_type="text/plain; charset=utf-8")
+    return {"success": True, "data": result}
+
+@app.post("/api/admin/profile/memory/stop")
+def stop_memory_tracing(admin: str = Depends(get_current_admin)):
+    profiler.stop_tracing()
+    return {"success": True, "data": profiler.stats()}
+
 import zipfile
-import shutil
 
 @app.post("/api/students/bulk-register")
 async def bulk_register_students(
     file: UploadFile = File(...),
+    defer_passwords: bool = Form(False),
     db: Session = Depends(get_db),
     admin: str = Depends(get_current_admin)
 ):
@@ -508,81 +1237,89 @@ async def bulk_register_students(
     Upload a ZIP file containing student images.
     Filename should be: REGISTRATION_NUMBER.jpg (or png/jpeg)
     Example: S101.jpg -> Registers student with ID S101.
+    Default password = registration number, hashed in a process pool while faces are embedded.
+    Members over ENROLL_MAX_IMAGE_BYTES are rejected individually.
+    With defer_passwords, nothing is hashed at import and the student sets a password on first login.
     """
     if not file.filename.endswith('.zip'):
         raise HTTPException(status_code=400, detail="Only .zip files allowed")
 
-    temp_dir = DATA_DIR / "temp_upload"
-    if temp_dir.exists():
-        shutil.rmtree(temp_dir)
-    temp_dir.mkdir(parents=True)
+    try:
+        # Members stream from the spooled upload; decode/embed/insert run off the event loop
+        return await run_in_threadpool(
+            enrollment.enroll_zip, file.file, db, STUDENT_IMAGES_DIR, defer_passwords
+        )
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid .zip file")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- Background Jobs ---
+
+@app.post("/api/jobs/bulk-enroll", status_code=202)
+async def submit_bulk_enroll_job(
+    file: UploadFile = File(...),
+    defer_passwords: bool = Form(False),
+    db: Session = Depends(get_db),
+    admin: str = Depends(get_current_admin)
+):
+    """
+    Same input as /api/students/bulk-register, processed in the background.
+    Returns a job id straight away; poll /api/jobs/{job_id} for progress.
+    """
+    if not file.filename.endswith('.zip'):
+        raise HTTPException(status_code=400, detail="Only .zip files allowed")
 
     try:
-        content = await file.read()
-        zip_path = temp_dir / "upload.zip"
-        with open(zip_path, "wb") as f:
-            f.write(content)
-
-        results = {"success": [], "failed": [], "skipped": []}
-
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-
-        # Process each image in the temp folder
-        for img_file in temp_dir.glob("**/*"):
-            if img_file.is_file() and img_file.suffix.lower() in ['.jpg', '.jpeg', '.png']:
-                reg_no = img_file.stem  # Filename without extension
-                
-                # Check if student exists
-                if db.query(Student).filter(Student.registration_number == reg_no).first():
-                    results["skipped"].append(reg_no)
-                    continue
-
-                # Process Image
-                image_array = face_utils.decode_image(open(img_file, "rb"))
-                if image_array is None:
-                    results["failed"].append(f"{reg_no} (Invalid Image)")
-                    continue
-
-                encoding, error = face_utils.get_face_embedding(image_array)
-                if error:
-                    results["failed"].append(f"{reg_no} ({error})")
-                    continue
-
-                # Save Release Image
-                save_filename = f"{reg_no}_{int(datetime.now().timestamp())}.jpg"
-                final_path = STUDENT_IMAGES_DIR / save_filename
-                face_utils.save_image_to_disk(image_array, final_path)
-
-                # Generate QR
-                qr_token = qr_utils.generate_qr_token()
-                qr_payload = f"ATTENDANCE:{reg_no}:{qr_token}"
-
-                # Create Student Record (Default Name = Reg No, Dept = General)
-                student = Student(
-                    registration_number=reg_no,
-                    name=reg_no, # Default name is ID, admin can update later
-                    department="General",
-                    year="1",
-                    face_encoding=encoding,
-                    face_image_path=f"/images/students/{save_filename}",
-                    password_hash=get_password_hash(reg_no), # Default pwd = ID
-                    qr_token=qr_token,
-                    qr_payload=qr_payload,
-                    is_verified=1
-                )
-                db.add(student)
-                results["success"].append(reg_no)
+        job = await run_in_threadpool(job_runner.submit_bulk_enroll, db, file.file, defer_passwords, admin)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Invalid .zip file")
+    return {"job_id": job.id, "status": job.status, "total": job.total, "skipped": job.skipped}
 
-        db.commit()
-        return results
+@app.get("/api/jobs")
+def list_jobs(limit: int = 20, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    recent = db.query(Job).order_by(Job.created_at.desc()).limit(min(limit, 100))
+    return [jobs.job_progress(job) for job in recent]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Cleanup
-        if temp_dir.exists():
-            shutil.rmtree(temp_dir)
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str, db: Session = Depends(get_db), admin: str = Depends(get_current_admin)):
+    job = db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return jobs.job_progress(job)
+
+@app.get("/api/jobs/{job_id}/failures")
+def get_job_failures(
+    job_id: str, limit: int = 100, offset: int = 0,
+    db: Session = Depends(get_db), admin: str = Depends(get_current_admin)
+):
+    if not db.get(Job, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    items = (
+        db.query(JobItem.reg_no, JobItem.member, JobItem.error, JobItem.updated_at)
+        .filter(JobItem.job_id == job_id, JobItem.status == "failed")
+        .order_by(JobItem.position)
+        .offset(offset)
+        .limit(min(limit, 1000))
+    )
+    return [
+        {"registration_number": reg_no, "member": member, "error": error, "updated_at": updated_at}
+        for reg_no, member, error, updated_at in items
+    ]
+
+@app.post("/api/jobs/{job_id}/resume")
+def resume_job(
+    job_id: str, retry_failed: bool = False,
+    db: Session = Depends(get_db), admin: str = Depends(get_current_admin)
+):
+    """Continue an interrupted or failed job from its pending items; retry_failed re-queues failed items"""
+    try:
+        job = job_runner.resume(db, job_id, retry_failed)
+    except jobs.JobBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return jobs.job_progress(job)
 
 
 # --- Frontend Static Files (Must be last) ---
@@ -0,0 +1,312 @@
+"""
+Prometheus metrics, exposed at GET /metrics in the text exposition format.
+
+A small in-house registry instead of prometheus_client: counters, gauges
+(set directly or read from a callback at scrape time) and fixed-bucket
+histograms. Recording is a dict lookup, a bisect and a lock, so it stays on
+in production.
+
+Recognition stage timings ("detect", "align", "embed", "match", ...) are
+collected by face_utils/recognition into each result's "timings" dict, which
+also comes back from worker processes, and observed here once per request in
+the web process. Metrics are per process: with several uvicorn workers each
+scrape sees the worker that answered it.
+
+The same stage times are also summed per request: the middleware answers
+with a Server-Timing header (visible in browser devtools) and routes can echo
+request_timings() in their body for ?debug=1.
+"""
+import contextvars
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds: a 1 ms gallery search up to a 10 s queued recognition
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """A fresh child for one set of label values"""
+
+    @abstractmethod
+    def _samples(self):
+        """[(suffix, label values, extra label, value)]"""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Name it with the _total suffix: the TYPE line and the samples share that name"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [("", values, "", child.value) for values, child in sorted(self._children.items())]
+
+
+class Gauge(_Metric):
+    """Set directly, or give `read` to compute the value(s) at scrape time: a number, or {label values: number}"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), read=None):
+        super().__init__(name, documentation, labelnames)
+        self.read = read
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self.read is None:
+            return [("", values, "", child.value) for values, child in sorted(self._children.items())]
+        try:
+            value = self.read()
+        except Exception:
+            return [] # A broken reader must not break the scrape
+        if isinstance(value, dict):
+            return [("", tuple(str(v) for v in key), "", v) for key, v in sorted(value.items())]
+        return [("", (), "", value)]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        for values, child in sorted(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", values, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(("_sum", values, "", total))
+            samples.append(("_count", values, "", cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "http_requests_total", "HTTP requests by route template and status", ("method", "route", "status")
+))
+HTTP_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route")
+))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge("http_requests_in_flight", "HTTP requests being served"))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "recognition_stage_seconds", "Time per face attendance stage", ("stage",)
+))
+RECOGNITIONS = REGISTRY.register(Counter(
+    "recognitions_total", "Recognition outcomes by where the match was found", ("scope", "outcome")
+))
+
+# Stage -> ms for the request being served, or None outside a request
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Result "timings" keys -> stage label
+TIMING_STAGES = {
+    "decode_ms": "decode",
+    "detect_ms": "detect",
+    "align_ms": "align",
+    "embed_ms": "embed",
+    "search_ms": "match",
+    "batch_wait_ms": "batch_wait",
+}
+
+
+def request_timings():
+    """{stage: ms} of the current request so far, or None outside a request"""
+    return _request_timings.get()
+
+
+def _add_request_time(name, ms):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + ms
+
+
+def observe_timings(timings):
+    """Observe a recognition result's stage timings (milliseconds)"""
+    for key, ms in timings.items():
+        stage = TIMING_STAGES.get(key)
+        if stage is not None:
+            STAGE_SECONDS.labels(stage).observe(ms / 1000)
+            _add_request_time(stage, ms)
+
+
+@contextmanager
+def stage(name, observe=True):
+    """Time a block into the request's breakdown and, with observe, the stage histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if observe:
+            STAGE_SECONDS.labels(name).observe(elapsed)
+        _add_request_time(name, elapsed * 1000)
+
+
+def server_timing(timings, total_ms):
+    """Server-Timing header value, e.g. "detect;dur=12.3, embed;dur=4.1, total;dur=20.0" """
+    entries = [f"{name};dur={ms:.1f}" for name, ms in timings.items()]
+    entries.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(entries)
+
+
+def gauge(name, documentation, read, labelnames=()):
+    """Register a gauge computed at scrape time"""
+    return REGISTRY.register(Gauge(name, documentation, labelnames, read=read))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests by route template (not raw path, to bound
+    label cardinality) and adding the Server-Timing header. `timing_allow_origin`
+    lets those origins' pages read it (Timing-Allow-Origin).
+    """
+    def __init__(self, app, timing_allow_origin=()):
+        self.app = app
+        self.timing_allow_origin = ", ".join(timing_allow_origin).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        timings = {}
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                total_ms = (time.perf_counter() - started) * 1000
+                headers.append((b"server-timing", server_timing(timings, total_ms).encode()))
+                if self.timing_allow_origin:
+                    headers.append((b"timing-allow-origin", self.timing_allow_origin))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_timings.reset(token)
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUESTS.labels(scope["method"], path, status).inc()
+            HTTP_DURATION.labels(scope["method"], path).observe(time.perf_counter() - started)
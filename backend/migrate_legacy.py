@@ -0,0 +1,345 @@
+"""
+Migrate the legacy Excel stores into the SQL database.
+
+Reads data/admins.xlsx, students.xlsx, attendance.xlsx and support_tickets.xlsx
+(managed by MultiAdminHandler, ExcelHandler and SupportHandler) in openpyxl
+read-only mode, one row at a time, and writes them to the models.py tables
+with chunked bulk inserts (COPY on PostgreSQL). Each chunk is committed
+together with its MigrationCheckpoint row, so an interrupted run resumes
+after the last committed chunk.
+
+Face embeddings for legacy student images are recomputed in a pool of
+worker processes, each with its own YuNet/SFace instances.
+
+Usage (from the backend folder):
+    python migrate_legacy.py
+    python migrate_legacy.py --workers 8 --chunk-size 2000
+    python migrate_legacy.py --restart        # ignore checkpoints
+"""
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, time as dt_time
+from itertools import islice
+from pathlib import Path
+
+from openpyxl import load_workbook
+
+from database import SessionLocal, engine, Base
+from models import Admin, Student, Attendance, SupportTicket, MigrationCheckpoint
+import qr_utils
+import rollup
+import bulk_load
+import gallery
+
+DATA_DIR = Path("../data")
+DEFAULT_CHUNK_SIZE = 1000
+
+
+# --- Row helpers ---
+
+def iter_sheet_rows(path, skip=0):
+    """
+    Yield (row number, row dict keyed by header) for each data row of the first
+    sheet after the first `skip`, streaming. Row numbers count blank rows too,
+    so they can be checkpointed and passed back as `skip`.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(h).strip() if h is not None else "" for h in header]
+        for number, values in enumerate(islice(rows, skip, None), start=skip + 1):
+            if values is None or all(v is None for v in values):
+                continue
+            yield number, dict(zip(header, values))
+    finally:
+        wb.close()
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def as_text(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Excel stores numeric registration numbers as floats
+    text = str(value).strip()
+    return text or None
+
+def as_date_str(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%Y-%m-%d")
+    text = as_text(value)
+    return text[:10] if text else None
+
+def as_datetime(value, time_value=None):
+    if isinstance(value, datetime) and time_value is None:
+        return value
+    day = as_date_str(value)
+    if not day:
+        return None
+    if isinstance(time_value, dt_time):
+        clock = time_value.strftime("%H:%M:%S")
+    elif isinstance(time_value, datetime):
+        clock = time_value.strftime("%H:%M:%S")
+    else:
+        clock = as_text(time_value) or "00:00:00"
+    try:
+        return datetime.strptime(f"{day} {clock[:8]}", "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        try:
+            return datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            return None
+
+def public_image_path(legacy_path):
+    """Legacy paths are relative to data/ (images/students/x.jpg); the API serves /images/..."""
+    text = as_text(legacy_path)
+    if not text:
+        return None
+    text = text.replace("\\", "/")
+    marker = text.find("images/")
+    return "/" + text[marker:] if marker >= 0 else None
+
+def legacy_method(mode):
+    mode = (as_text(mode) or "").upper()
+    return "QR" if "QR" in mode else "FACE"
+
+
+# --- Face embeddings (run in worker processes) ---
+
+def compute_embedding(image_path):
+    """Return the SFace embedding for a legacy image, or None"""
+    import face_utils  # Loaded per worker process
+    try:
+        with open(image_path, "rb") as f:
+            image_array = face_utils.decode_image(f)
+    except OSError:
+        return None
+    if image_array is None:
+        return None
+    encoding, error = face_utils.get_face_embedding(image_array)
+    return None if error else encoding
+
+
+# --- Migration ---
+
+class LegacyMigrator:
+    def __init__(self, data_dir=DATA_DIR, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                 embeddings=True, restart=False):
+        self.data_dir = Path(data_dir)
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 1
+        self.embeddings = embeddings
+        self.restart = restart
+        self.pool = None
+
+    def run(self):
+        Base.metadata.create_all(bind=engine)
+        if self.embeddings:
+            # spawn: face models must not be inherited across fork
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            self.migrate("admins.xlsx", self.admin_rows)
+            self.migrate("students.xlsx", self.student_rows)
+            self.migrate("attendance.xlsx", self.attendance_rows)
+            self.migrate("support_tickets.xlsx", self.ticket_rows)
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+
+        db = SessionLocal()
+        try:
+            buckets = rollup.rebuild(db)
+            print(f"✅ Attendance rollup rebuilt ({buckets} buckets)")
+            gallery.face_gallery.refresh(db)
+        finally:
+            db.close()
+
+    def migrate(self, source, convert):
+        path = self.data_dir / source
+        if not path.exists():
+            print(f"⚠️ {source} not found, skipping")
+            return
+
+        db = SessionLocal()
+        try:
+            checkpoint = db.get(MigrationCheckpoint, source)
+            if checkpoint is None:
+                checkpoint = MigrationCheckpoint(source=source, rows_done=0)
+                db.add(checkpoint)
+            elif self.restart:
+                checkpoint.rows_done = 0
+            db.commit()
+
+            start_rows = checkpoint.rows_done
+            if start_rows:
+                print(f"↪️ {source}: resuming after row {start_rows}")
+
+            started = time.monotonic()
+            inserted = 0
+            for chunk in chunked(iter_sheet_rows(path, skip=start_rows), self.chunk_size):
+                model, mappings = convert(db, [row for _, row in chunk])
+                bulk_load.bulk_insert(db, model, mappings)
+                if model is Student:
+                    gallery.record_added(db, [m["registration_number"] for m in mappings if m["face_encoding"]])
+                checkpoint.rows_done = chunk[-1][0] # Sheet row number, blank rows included
+                db.commit()
+
+                inserted += len(mappings)
+                done = checkpoint.rows_done - start_rows
+                rate = done / max(time.monotonic() - started, 1e-6)
+                print(f"   {source}: {checkpoint.rows_done} rows read, {inserted} inserted ({rate:.0f} rows/s)")
+
+            elapsed = time.monotonic() - started
+            print(f"✅ {source}: {inserted} rows inserted in {elapsed:.1f}s")
+        finally:
+            db.close()
+
+    def _existing(self, db, column, values):
+        values = [v for v in values if v]
+        if not values:
+            return set()
+        return {v for (v,) in db.query(column).filter(column.in_(values))}
+
+    def admin_rows(self, db, chunk):
+        rows = [r for r in chunk if as_text(r.get("Username"))]
+        existing = self._existing(db, Admin.username, [as_text(r["Username"]) for r in rows])
+        mappings, seen = [], set()
+        for row in rows:
+            username = as_text(row["Username"])
+            status = (as_text(row.get("Status")) or "active").lower()
+            if username in existing or username in seen or status != "active":
+                continue
+            seen.add(username)
+            # Werkzeug hashes are kept as-is; main.verify_password understands them
+            mappings.append({"username": username, "password_hash": as_text(row.get("Password Hash"))})
+        return Admin, mappings
+
+    def student_rows(self, db, chunk):
+        rows = [r for r in chunk if as_text(r.get("Registration No"))]
+        existing = self._existing(db, Student.registration_number, [as_text(r["Registration No"]) for r in rows])
+
+        new_rows, seen = [], set()
+        for row in rows:
+            reg_no = as_text(row["Registration No"])
+            if reg_no in existing or reg_no in seen:
+                continue
+            seen.add(reg_no)
+            new_rows.append(row)
+
+        image_paths = [public_image_path(r.get("Image Path")) for r in new_rows]
+        encodings = [None] * len(new_rows)
+        if self.pool:
+            todo = [(i, self.data_dir / p.lstrip("/")) for i, p in enumerate(image_paths) if p]
+            results = self.pool.map(compute_embedding, [str(p) for _, p in todo],
+                                    chunksize=max(1, len(todo) // (self.workers * 4)))
+            for (i, _), encoding in zip(todo, results):
+                encodings[i] = encoding
+
+        mappings = []
+        for row, image_path, encoding in zip(new_rows, image_paths, encodings):
+            reg_no = as_text(row["Registration No"])
+            qr_token = qr_utils.generate_qr_token()
+            mappings.append({
+                "registration_number": reg_no,
+                "name": as_text(row.get("Name")) or reg_no,
+                "department": as_text(row.get("Department")) or "General",
+                "year": as_text(row.get("Year")) or "1",
+                "face_encoding": encoding,
+                "face_image_path": image_path,
+                "qr_token": qr_token,
+                "qr_payload": f"ATTENDANCE:{reg_no}:{qr_token}",
+                "is_verified": 1,
+                "created_at": as_datetime(row.get("Enrollment Date")) or datetime.now(),
+            })
+        return Student, mappings
+
+    def attendance_rows(self, db, chunk):
+        reg_nos = {as_text(r.get("Registration No")) for r in chunk}
+        reg_nos.discard(None)
+        student_ids = dict(
+            db.query(Student.registration_number, Student.id)
+            .filter(Student.registration_number.in_(reg_nos))
+        ) if reg_nos else {}
+
+        # One mark per student, day and method, so a re-run (--restart, lost
+        # checkpoint) does not insert the sheet a second time
+        days = {as_date_str(r.get("Date")) for r in chunk}
+        days.discard(None)
+        existing = set(
+            db.query(Attendance.student_id, Attendance.date, Attendance.method)
+            .filter(Attendance.student_id.in_(student_ids.values()), Attendance.date.in_(days))
+        ) if student_ids and days else set()
+
+        mappings, seen = [], set()
+        for row in chunk:
+            student_id = student_ids.get(as_text(row.get("Registration No")))
+            day = as_date_str(row.get("Date"))
+            if student_id is None or not day:
+                continue
+            method = legacy_method(row.get("Mode"))
+            key = (student_id, day, method)
+            if key in existing or key in seen:
+                continue
+            seen.add(key)
+            mappings.append({
+                "student_id": student_id,
+                "method": method,
+                "timestamp": as_datetime(row.get("Date"), row.get("Time")),
+                "date": day,
+                "status": "PRESENT",
+                "proof_image_path": public_image_path(row.get("Image Path")),
+            })
+        return Attendance, mappings
+
+    def ticket_rows(self, db, chunk):
+        rows = [r for r in chunk if as_text(r.get("Ticket ID"))]
+        existing = self._existing(db, SupportTicket.ticket_id, [as_text(r["Ticket ID"]) for r in rows])
+        mappings, seen = [], set()
+        for row in rows:
+            ticket_id = as_text(row["Ticket ID"])
+            if ticket_id in existing or ticket_id in seen:
+                continue
+            seen.add(ticket_id)
+            mappings.append({
+                "ticket_id": ticket_id,
+                "student_name": as_text(row.get("Student Name")),
+                "registration_number": as_text(row.get("Registration No")),
+                "email": as_text(row.get("Email")),
+                "subject": as_text(row.get("Subject")),
+                "message": as_text(row.get("Message")),
+                "status": as_text(row.get("Status")) or "Open",
+                "created_at": as_datetime(row.get("Created At")),
+                "resolved_at": as_datetime(row.get("Resolved At")),
+                "admin_notes": as_text(row.get("Admin Notes")) or "",
+            })
+        return SupportTicket, mappings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate legacy Excel data into the SQL database")
+    parser.add_argument("--data-dir", default=str(DATA_DIR))
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="Embedding worker processes (default: CPU count)")
+    parser.add_argument("--no-embeddings", action="store_true", help="Import students without recomputing face embeddings")
+    parser.add_argument("--restart", action="store_true", help="Ignore saved checkpoints and start from the first row")
+    args = parser.parse_args()
+
+    LegacyMigrator(
+        data_dir=args.data_dir,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        embeddings=not args.no_embeddings,
+        restart=args.restart,
+    ).run()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, LargeBinary, JSON
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, LargeBinary, JSON, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -42,6 +42,10 @@ class Student(Base):
 
 class Attendance(Base):
     __tablename__ = "attendance"
+    __table_args__ = (
+        # Serves the per-scan "already marked today" lookup
+        Index("ix_attendance_student_date", "student_id", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, ForeignKey("students.id"))
@@ -54,3 +58,158 @@ class Attendance(Base):
     proof_image_path = Column(String, nullable=True)
 
     student = relationship("Student", back_populates="attendances")
+
+class AttendanceArchive(Base):
+    """Cold attendance rows moved out of the hot table by archive.py"""
+    __tablename__ = "attendance_archive"
+
+    archive_id = Column(Integer, primary_key=True)
+    # Original attendance.id; not unique, SQLite may reuse ids once the hot table is emptied
+    id = Column(Integer, index=True)
+    student_id = Column(Integer, ForeignKey("students.id"), index=True)
+    method = Column(String)
+    timestamp = Column(DateTime)
+    date = Column(String, index=True)
+    status = Column(String)
+    proof_image_path = Column(String, nullable=True)
+
+class AttendanceRollup(Base):
+    """Pre-aggregated attendance counts, one row per (date, department, method)"""
+    __tablename__ = "attendance_daily_rollup"
+    __table_args__ = (
+        UniqueConstraint("date", "department", "method", name="uq_rollup_date_dept_method"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    date = Column(String, index=True, nullable=False) # YYYY-MM-DD, same as Attendance.date
+    department = Column(String, nullable=False, default="")
+    method = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+class SupportTicket(Base):
+    __tablename__ = "support_tickets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    ticket_id = Column(String, unique=True, index=True, nullable=False)
+    student_name = Column(String)
+    registration_number = Column(String, index=True)
+    email = Column(String)
+    subject = Column(String)
+    message = Column(Text)
+    status = Column(String, default="Open")
+    created_at = Column(DateTime, default=datetime.now)
+    resolved_at = Column(DateTime, nullable=True)
+    admin_notes = Column(Text, default="")
+
+class MigrationCheckpoint(Base):
+    """Rows already imported per legacy source, committed together with each batch"""
+    __tablename__ = "migration_checkpoints"
+
+    source = Column(String, primary_key=True) # e.g. "students.xlsx"
+    rows_done = Column(Integer, nullable=False, default=0) # Sheet data rows, blank ones included
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class Job(Base):
+    """Background job run by jobs.py; progress counters are updated with each committed batch"""
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True) # uuid4 hex
+    kind = Column(String, nullable=False) # e.g. "bulk_enroll"
+    status = Column(String, nullable=False, default="queued", index=True) # queued, running, completed, failed, interrupted
+    options = Column(JSON, default=dict)
+    workspace = Column(String) # Folder holding the job's input (data/jobs/<id>)
+    created_by = Column(String)
+
+    total = Column(Integer, nullable=False, default=0)
+    done = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True) # Refreshed per batch; stale means the runner died
+    finished_at = Column(DateTime, nullable=True)
+
+class JobItem(Base):
+    """One unit of work in a Job (a ZIP member for bulk enrollment)"""
+    __tablename__ = "job_items"
+    __table_args__ = (Index("ix_job_items_job_status", "job_id", "status"),)
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, ForeignKey("jobs.id"), nullable=False)
+    position = Column(Integer, nullable=False)
+    reg_no = Column(String)
+    member = Column(String) # ZIP member name
+    status = Column(String, nullable=False, default="pending") # pending, done, failed, skipped
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+class GalleryChange(Base):
+    """Append-only log of face gallery changes; the latest id is the gallery revision"""
+    __tablename__ = "gallery_changes"
+
+    id = Column(Integer, primary_key=True)
+    student_id = Column(Integer, index=True, nullable=False)
+    action = Column(String, nullable=False) # add, update, remove
+    encoding = Column(JSON, nullable=True) # None for remove
+    created_at = Column(DateTime, default=datetime.now)
+
+class Kiosk(Base):
+    """Edge kiosk allowed to post embeddings; requests are signed with `secret` (see kiosk_auth.py)"""
+    __tablename__ = "kiosks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kiosk_id = Column(String, unique=True, index=True, nullable=False)
+    name = Column(String)
+    location = Column(String, nullable=True)
+    secret = Column(String, nullable=False) # HMAC key; must stay recoverable, so not hashed
+    is_active = Column(Integer, default=1)
+    created_at = Column(DateTime, default=datetime.now)
+    last_seen_at = Column(DateTime, nullable=True)
+
+class KioskNonce(Base):
+    """Nonces seen recently per kiosk; the unique constraint rejects replays"""
+    __tablename__ = "kiosk_nonces"
+    __table_args__ = (UniqueConstraint("kiosk_id", "nonce", name="uq_kiosk_nonce"),)
+
+    id = Column(Integer, primary_key=True)
+    kiosk_id = Column(Integer, ForeignKey("kiosks.id"), nullable=False)
+    nonce = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+class Course(Base):
+    __tablename__ = "courses"
+
+    id = Column(Integer, primary_key=True, index=True)
+    code = Column(String, unique=True, index=True, nullable=False)
+    name = Column(String)
+    department = Column(String)
+
+class Room(Base):
+    """Classroom; kiosk_id is the id the room's kiosk sends with its scans"""
+    __tablename__ = "rooms"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    kiosk_id = Column(String, unique=True, index=True, nullable=True)
+
+class TimeSlot(Base):
+    """Weekly session of a course in a room"""
+    __tablename__ = "time_slots"
+    __table_args__ = (Index("ix_time_slots_room_weekday", "room_id", "weekday"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    course_id = Column(Integer, ForeignKey("courses.id"), nullable=False)
+    room_id = Column(Integer, ForeignKey("rooms.id"), nullable=False)
+    weekday = Column(Integer, nullable=False) # 0 = Monday, like date.weekday()
+    start_time = Column(String, nullable=False) # HH:MM
+    end_time = Column(String, nullable=False) # HH:MM
+
+class CourseEnrollment(Base):
+    __tablename__ = "course_enrollments"
+    __table_args__ = (UniqueConstraint("course_id", "student_id", name="uq_course_student"),)
+
+    id = Column(Integer, primary_key=True)
+    course_id = Column(Integer, ForeignKey("courses.id"), nullable=False, index=True)
+    student_id = Column(Integer, ForeignKey("students.id"), nullable=False)
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+
+# Stored instead of a hash for bulk-enrolled students whose password is set on first login.
+# Not a valid hash of anything, so normal verification always fails.
+DEFERRED_PASSWORD_HASH = "!deferred"
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or os.cpu_count() or 1
+HASH_CHUNK_SIZE = 32
+
+# Hashes written by werkzeug.security.generate_password_hash in the legacy Flask app,
+# e.g. "pbkdf2:sha256:600000$<salt>$<hex>" or "scrypt:32768:8:1$<salt>$<hex>"
+WERKZEUG_PREFIXES = ("pbkdf2:", "scrypt:")
+WERKZEUG_DEFAULT_PBKDF2_ITERATIONS = 260000
+
+def is_legacy_hash(hashed_password):
+    return bool(hashed_password) and hashed_password.startswith(WERKZEUG_PREFIXES)
+
+def verify_legacy_hash(plain_password, hashed_password):
+    """
+    Verify a werkzeug-format hash without depending on werkzeug,
+    so admins migrated from the Excel store can still log in.
+    """
+    try:
+        method, salt, expected = hashed_password.split("$", 2)
+        parts = method.split(":")
+        password = plain_password.encode("utf-8")
+
+        if parts[0] == "pbkdf2":
+            hash_name = parts[1] if len(parts) > 1 else "sha256"
+            iterations = int(parts[2]) if len(parts) > 2 else WERKZEUG_DEFAULT_PBKDF2_ITERATIONS
+            actual = hashlib.pbkdf2_hmac(hash_name, password, salt.encode("utf-8"), iterations).hex()
+        elif parts[0] == "scrypt":
+            n, r, p = (int(x) for x in parts[1:4])
+            actual = hashlib.scrypt(
+                password, salt=salt.encode("utf-8"), n=n, r=r, p=p, maxmem=132 * n * r * p
+            ).hex()
+        else:
+            return False
+
+        return hmac.compare_digest(actual, expected)
+    except (ValueError, TypeError):
+        return False
+
+def hash_password(password):
+    return pwd_context.hash(password)
+
+def verify_password(plain_password, hashed_password):
+    if not hashed_password or hashed_password == DEFERRED_PASSWORD_HASH:
+        return False
+    if is_legacy_hash(hashed_password):
+        return verify_legacy_hash(plain_password, hashed_password)
+    return pwd_context.verify(plain_password, hashed_password)
+
+def is_deferred(hashed_password):
+    return hashed_password == DEFERRED_PASSWORD_HASH
+
+# --- Bulk hashing in a process pool ---
+# pbkdf2 is deliberately slow; a process pool scales with cores whichever passlib
+# backend is active, and keeps that CPU off the web worker.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _hash_batch(passwords):
+    return [pwd_context.hash(p) for p in passwords]
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: workers must not inherit the web process's OpenCV/DB state
+            _pool = ProcessPoolExecutor(HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+class PendingHashes:
+    """Hashes being computed in the pool, in input order"""
+    def __init__(self, futures, chunk_size):
+        self.futures = futures
+        self.chunk_size = chunk_size
+
+    def get(self, index):
+        """Hash of passwords[index], waiting only for its own chunk"""
+        return self.futures[index // self.chunk_size].result()[index % self.chunk_size]
+
+    def result(self):
+        return [h for future in self.futures for h in future.result()]
+
+    async def wait(self):
+        batches = await asyncio.gather(*(asyncio.wrap_future(f) for f in self.futures))
+        return [h for batch in batches for h in batch]
+
+def hash_many_async(passwords, chunk_size=HASH_CHUNK_SIZE):
+    """Start hashing `passwords` in parallel and return immediately"""
+    passwords = list(passwords)
+    # Small uploads still spread across every worker
+    chunk_size = max(1, min(chunk_size, -(-len(passwords) // HASH_WORKERS)))
+    pool = get_pool()
+    futures = [
+        pool.submit(_hash_batch, passwords[i:i + chunk_size])
+        for i in range(0, len(passwords), chunk_size)
+    ]
+    return PendingHashes(futures, chunk_size)
+
+def hash_many(passwords, chunk_size=HASH_CHUNK_SIZE):
+    return hash_many_async(passwords, chunk_size).result()
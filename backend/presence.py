@@ -0,0 +1,86 @@
+"""
+Per-day "present today" bitmap.
+
+One bit per student id and attendance method for the current day. A set bit
+means the student is certainly marked today, so duplicate scans are answered
+without a DB round trip. A clear bit is not proof of absence (another worker
+may have inserted the row), so callers fall back to the DB check and set the
+bit if the row exists.
+
+The bitmap is warmed from today's attendance at startup and cleared when the
+date changes; the first scans after midnight simply start from an empty day.
+"""
+import threading
+from datetime import date
+
+from models import Attendance
+
+
+class PresenceBitmap:
+    def __init__(self):
+        self.day = None
+        self._lock = threading.Lock()
+        self._bits = {}          # method -> bytearray
+        self._any = bytearray()  # Union over all methods
+
+    @staticmethod
+    def _test(bits, student_id):
+        index = student_id >> 3
+        return index < len(bits) and bool(bits[index] & (1 << (student_id & 7)))
+
+    @staticmethod
+    def _set(bits, student_id):
+        index = student_id >> 3
+        if index >= len(bits):
+            bits.extend(bytes(index + 1 - len(bits) + 64))  # Grow with some slack
+        bits[index] |= 1 << (student_id & 7)
+
+    def _rollover(self):
+        today = date.today().isoformat()
+        if self.day != today:
+            self.day = today
+            self._bits = {}
+            self._any = bytearray()
+        return today
+
+    def warm(self, db):
+        """Load today's attendance into the bitmap"""
+        with self._lock:
+            today = self._rollover()
+            rows = (
+                db.query(Attendance.student_id, Attendance.method)
+                .filter(Attendance.date == today)
+                .distinct()
+            )
+            count = 0
+            for student_id, method in rows:
+                if student_id is None:
+                    continue
+                self._set(self._bits.setdefault(method, bytearray()), student_id)
+                self._set(self._any, student_id)
+                count += 1
+            return count
+
+    def is_marked(self, student_id, method=None):
+        """True if the student is known to be marked today (by `method`, or by any method)"""
+        with self._lock:
+            self._rollover()
+            bits = self._any if method is None else self._bits.get(method)
+            return bits is not None and self._test(bits, student_id)
+
+    def mark(self, student_id, method):
+        with self._lock:
+            self._rollover()
+            self._set(self._bits.setdefault(method, bytearray()), student_id)
+            self._set(self._any, student_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "day": self.day,
+                "present": sum(bin(b).count("1") for b in self._any),
+                "bytes": len(self._any) + sum(len(b) for b in self._bits.values())
+            }
+
+
+presence = PresenceBitmap()
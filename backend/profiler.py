@@ -0,0 +1,215 @@
+"""
+On-demand CPU and memory profiling of a live web worker.
+
+CPU: sample() wakes every interval for a bounded number of seconds and reads
+the stack of every thread with sys._current_frames(), from a thread of its
+own, so the event loop and the request threads are observed, not paused.
+With sampler="py-spy" (when the py-spy binary is installed and may ptrace this
+process) py-spy records instead, native frames and recognition worker
+processes included. Both return collapsed stacks ("thread;outer;inner count"
+per line), the input of flamegraph.pl, speedscope and inferno.
+
+Memory: start_tracing() turns tracemalloc on and keeps a baseline snapshot;
+memory_snapshot() reports what is allocated now, or what grew since the
+baseline. Tracing slows allocation down noticeably, so it stops by itself
+after TRACEMALLOC_MAX_SECONDS.
+
+Only one CPU profile runs at a time per process; with several uvicorn workers
+the profile is of the worker that answered.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+TRACEMALLOC_MAX_SECONDS = float(os.getenv("TRACEMALLOC_MAX_SECONDS", "300"))
+MIN_INTERVAL_MS = 1
+MAX_STACK_DEPTH = 128
+
+# Innermost Python frames of threads that are parked, not working. Listed by file
+# and function, not by the name of the C call they make: a thread stalled in, say,
+# session.get() or a socket select is exactly what a profile should show.
+IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"), ("selectors.py", "select"), # Thread pools, event loop, multiprocessing queues
+    ("thread.py", "_worker"), # Idle ThreadPoolExecutor worker (SimpleQueue.get is C)
+    ("gallery.py", "loop"), # Gallery poller between polls (time.sleep is C)
+}
+TRACE_EXCLUDE = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+class ProfileBusy(Exception):
+    """A CPU profile is already running in this process"""
+
+
+def _short_path(filename):
+    # site-packages/fastapi/routing.py -> fastapi/routing.py; the app's own modules keep their name
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+def _frame_name(code):
+    # Per function rather than per line, so samples of one function add up
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class Profiler:
+    def __init__(self, max_seconds=PROFILE_MAX_SECONDS):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._trace_timer = None
+        self._baseline = None
+        self.profiles = 0
+
+    def _check(self, seconds, interval_ms):
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"seconds must be between 0 and {self.max_seconds:g}")
+        if interval_ms < MIN_INTERVAL_MS:
+            raise ValueError(f"interval_ms must be at least {MIN_INTERVAL_MS}")
+
+    def sample(self, seconds, interval_ms=10, include_idle=False, sampler="builtin"):
+        """Collapsed stacks of every thread over `seconds`, one sample per `interval_ms`"""
+        self._check(seconds, interval_ms)
+        if sampler not in ("builtin", "py-spy"):
+            raise ValueError('sampler must be "builtin" or "py-spy"')
+        if not self._lock.acquire(blocking=False):
+            raise ProfileBusy("A profile is already running")
+        try:
+            self.profiles += 1
+            if sampler == "py-spy":
+                return self._py_spy(seconds, interval_ms, include_idle)
+            return self._sample(seconds, interval_ms / 1000, include_idle)
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds, interval, include_idle):
+        stacks = Counter()
+        names = {}
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if not include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                frames = []
+                while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                    frames.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                frames.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(frames))] += 1
+            frame = None # Frames hold their locals alive
+            time.sleep(interval)
+        return _collapse(stacks)
+
+    def _py_spy(self, seconds, interval_ms, include_idle):
+        binary = shutil.which("py-spy")
+        if binary is None:
+            raise ValueError("py-spy is not installed; use sampler=builtin")
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "profile.txt")
+            command = [
+                binary, "record", "--pid", str(os.getpid()), "--format", "raw", "--output", output,
+                "--duration", str(max(1, round(seconds))), "--rate", str(max(1, round(1000 / interval_ms))),
+                "--subprocesses", "--nonblocking",
+            ]
+            if include_idle:
+                command.append("--idle")
+            try:
+                result = subprocess.run(command, capture_output=True, text=True, timeout=seconds + 30)
+            except subprocess.TimeoutExpired:
+                raise RuntimeError("py-spy did not finish in time")
+            if result.returncode != 0 or not os.path.exists(output):
+                raise RuntimeError(f"py-spy failed: {(result.stderr or result.stdout).strip()[-500:]}")
+            with open(output) as f:
+                return f.read()
+
+    # --- Allocations ---
+
+    def start_tracing(self, frames=25):
+        """Trace allocations with `frames` deep tracebacks; the snapshot now is the baseline for diffs"""
+        if not 1 <= frames <= 100:
+            raise ValueError("frames must be between 1 and 100")
+        self.stop_tracing()
+        tracemalloc.start(frames)
+        self._baseline = tracemalloc.take_snapshot().filter_traces(TRACE_EXCLUDE)
+        self._trace_timer = threading.Timer(TRACEMALLOC_MAX_SECONDS, self.stop_tracing)
+        self._trace_timer.daemon = True
+        self._trace_timer.start()
+        print(f"🔬 Allocation tracing on for up to {TRACEMALLOC_MAX_SECONDS:g}s")
+
+    def stop_tracing(self):
+        if self._trace_timer is not None:
+            self._trace_timer.cancel()
+            self._trace_timer = None
+        self._baseline = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            print("🔬 Allocation tracing off")
+
+    def memory_snapshot(self, diff=False, collapsed=False, limit=50):
+        """
+        Live allocations by source line (top `limit`), or their growth since
+        start_tracing() with diff. collapsed: one "outer;inner bytes" line per
+        allocating traceback instead, for a memory flamegraph.
+        """
+        baseline = self._baseline
+        if not tracemalloc.is_tracing() or baseline is None:
+            raise ValueError("Allocation tracing is off; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_EXCLUDE)
+        key = "traceback" if collapsed else "lineno"
+        if diff:
+            stats = snapshot.compare_to(baseline, key)
+        else:
+            stats = snapshot.statistics(key)
+
+        if collapsed:
+            stacks = Counter()
+            for stat in stats:
+                size = stat.size_diff if diff else stat.size
+                if size > 0: # Flamegraphs take positive weights; shrinkage is left out
+                    # Traceback frames run oldest first, as collapsed stacks do
+                    stacks[";".join(f"{_short_path(f.filename)}:{f.lineno}" for f in stat.traceback)] += size
+            return _collapse(stacks)
+
+        current, peak = tracemalloc.get_traced_memory()
+        top = []
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            entry = {"file": _short_path(frame.filename), "line": frame.lineno, "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+            if diff:
+                entry.update(size_diff_kb=round(stat.size_diff / 1024, 1), count_diff=stat.count_diff)
+            top.append(entry)
+        return {"traced_kb": round(current / 1024, 1), "peak_kb": round(peak / 1024, 1), "diff": diff, "top": top}
+
+    def stats(self):
+        return {
+            "max_seconds": self.max_seconds,
+            "running": self._lock.locked(),
+            "profiles": self.profiles,
+            "tracing": tracemalloc.is_tracing(),
+        }
+
+
+profiler = Profiler()
@@ -0,0 +1,103 @@
+"""
+Per-kiosk cache of recently recognized students.
+
+scan.html posts a frame every 2 seconds, so a student standing at a kiosk is
+recognized over and over. The last RECENT_CACHE_SIZE students recognized at a
+kiosk are kept for RECENT_CACHE_TTL_SECONDS with the probe embedding that
+matched them. candidates() travels with the recognition Scope: a new probe is
+compared with those few rows before any gallery search, and a hit for a
+student already marked today is answered without touching the database.
+
+The cache lives in each web process and is keyed by kiosk_id (the signed
+kiosk id on the embeddings route). Kiosks that send none get no cache: an
+address would be shared by every kiosk behind the same NAT or proxy.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+RECENT_CACHE_SIZE = int(os.getenv("RECENT_CACHE_SIZE", "8"))
+RECENT_CACHE_TTL_SECONDS = float(os.getenv("RECENT_CACHE_TTL_SECONDS", "30"))
+RECENT_CACHE_MAX_KIOSKS = int(os.getenv("RECENT_CACHE_MAX_KIOSKS", "1000"))
+
+
+class RecentCache:
+    def __init__(self, size=RECENT_CACHE_SIZE, ttl=RECENT_CACHE_TTL_SECONDS, max_kiosks=RECENT_CACHE_MAX_KIOSKS):
+        self.size = size
+        self.ttl = ttl
+        self.max_kiosks = max_kiosks
+        self._kiosks = OrderedDict() # kiosk -> OrderedDict(student_id -> entry), oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def _entries(self, kiosk):
+        """Live entries of `kiosk`, expired ones dropped (caller holds self._lock)"""
+        entries = self._kiosks.get(kiosk)
+        if entries is None:
+            return None
+        now = time.monotonic()
+        for student_id in [s for s, entry in entries.items() if entry["expires"] <= now]:
+            del entries[student_id]
+        if not entries:
+            del self._kiosks[kiosk]
+            return None
+        return entries
+
+    def candidates(self, kiosk):
+        """(student ids, unit embeddings) to try before the gallery, or None"""
+        if not kiosk or self.size <= 0:
+            return None
+        with self._lock:
+            entries = self._entries(kiosk)
+            if entries is None:
+                return None
+            return (
+                np.fromiter(entries.keys(), dtype=np.int64, count=len(entries)),
+                np.stack([entry["embedding"] for entry in entries.values()])
+            )
+
+    def get(self, kiosk, student_id):
+        """The entry a "recent" match came from: {"student", "marked_on", ...}, or None if it expired"""
+        with self._lock:
+            entries = self._entries(kiosk) if kiosk else None
+            entry = entries.get(student_id) if entries else None
+            if entry is not None:
+                self.hits += 1
+            return entry
+
+    def remember(self, kiosk, student_id, embedding, student, marked_on=None):
+        """Keep `student` (a summary row) as recognized at `kiosk` from `embedding`"""
+        if not kiosk or embedding is None or self.size <= 0:
+            return
+        with self._lock:
+            entries = self._entries(kiosk)
+            if entries is None:
+                entries = self._kiosks[kiosk] = OrderedDict()
+                while len(self._kiosks) > self.max_kiosks:
+                    self._kiosks.popitem(last=False)
+            self._kiosks.move_to_end(kiosk)
+            entries.pop(student_id, None)
+            entries[student_id] = {
+                "embedding": np.asarray(embedding, dtype=np.float32),
+                "student": student,
+                "marked_on": marked_on,
+                "expires": time.monotonic() + self.ttl,
+            }
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "ttl_seconds": self.ttl,
+                "kiosks": len(self._kiosks),
+                "entries": sum(len(entries) for entries in self._kiosks.values()),
+                "hits": self.hits,
+            }
+
+
+recent_cache = RecentCache()
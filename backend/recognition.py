@@ -0,0 +1,529 @@
+"""
+Face recognition off the web workers.
+
+With RECOGNITION_WORKERS > 0, decoded frames are handed to that many
+recognition processes over a multiprocessing queue. Each process loads its own
+YuNet/SFace pair and maps the shared gallery snapshot (gallery.py), so web
+concurrency and inference concurrency are sized independently and a burst of
+kiosk frames cannot starve admin or QR requests.
+
+Backpressure: at most RECOGNITION_QUEUE_SIZE frames are in flight; beyond
+that submit() raises RecognitionBusy and the route answers 503 with
+Retry-After instead of queueing without bound. Frames that get no answer
+within RECOGNITION_TIMEOUT seconds (e.g. the worker died) fail with
+TimeoutError and dead workers are restarted.
+
+With RECOGNITION_WORKERS=0 (the default) recognition runs in the web process,
+off the event loop: detection and alignment on up to RECOGNITION_THREADS
+threads, each with its own YuNet/SFace pair (OpenCV models are not
+thread-safe), so concurrent requests detect in parallel and admission control
+keeps answering while they do.
+
+Micro-batching: under a burst, aligned crops from concurrent frames are
+collected for up to RECOGNITION_BATCH_WAIT_MS or RECOGNITION_BATCH_SIZE crops,
+then embedded with one batched SFace pass and searched with one matrix-matrix
+product. A worker process batches the frames it drains from its queue; in the
+web process a MicroBatcher thread batches crops from concurrent requests.
+A lone frame waits at most RECOGNITION_BATCH_WAIT_MS longer than before;
+RECOGNITION_BATCH_SIZE=1 turns batching off.
+
+Scoped search: a request may carry a Scope. Its recent rows (students just
+recognized at the same kiosk, recent.py) are compared first, at the stricter
+RECENT_MATCH_SIMILARITY, then its
+student_ids (the session running at the kiosk, timetable.py); without a match
+the probe is searched in the kiosk's declared gallery shards (shards.py), or
+in the full gallery when it declared none. result["scope"] says which answered
+and result["embedding"] holds the unit probe for the recent cache.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+import face_utils
+import gallery
+import shards
+
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", "0"))
+RECOGNITION_QUEUE_SIZE = int(os.getenv("RECOGNITION_QUEUE_SIZE", "0")) or max(RECOGNITION_WORKERS, 1) * 4
+RECOGNITION_TIMEOUT = float(os.getenv("RECOGNITION_TIMEOUT", "10"))
+# In-process detection threads; each loads a model pair on first use
+RECOGNITION_THREADS = int(os.getenv("RECOGNITION_THREADS", "0")) or min(os.cpu_count() or 1, 4)
+
+RECOGNITION_BATCH_SIZE = int(os.getenv("RECOGNITION_BATCH_SIZE", "16"))
+RECOGNITION_BATCH_WAIT_MS = float(os.getenv("RECOGNITION_BATCH_WAIT_MS", "5"))
+
+# Same acceptance as the old per-student loop: cosine distance <= 0.5
+MATCH_SIMILARITY = float(os.getenv("RECOGNITION_MATCH_SIMILARITY", "0.5"))
+# A recent hit skips the gallery, so it must mean "same person", not merely "close enough":
+# a different student at the same kiosk can sit above MATCH_SIMILARITY
+RECENT_MATCH_SIMILARITY = float(os.getenv("RECOGNITION_RECENT_SIMILARITY", "0.8"))
+
+
+class RecognitionBusy(Exception):
+    """Too many frames in flight; the caller should retry shortly"""
+
+
+class Scope(NamedTuple):
+    """Where to look: recent (ids, unit embeddings), then these students, then these shards (all when empty)"""
+    student_ids: Optional[np.ndarray] = None
+    shards: tuple = ()
+    recent: Optional[tuple] = None
+
+
+def _result(error=None, **timings):
+    return {
+        "student_id": None, "similarity": None, "scope": None, "error": error,
+        "batch_size": 1, "timings": timings
+    }
+
+
+def _apply_matches(results, embeddings, face_gallery, scopes=None):
+    """
+    Fill student_id/similarity of `results` from `embeddings`: a few dot products
+    with each scope's recent rows, one sub-gallery search per distinct session
+    scope, then one search per distinct shard list (or of the full gallery) for
+    everything still unmatched.
+    """
+    started = time.perf_counter()
+    probes = gallery.normalize(embeddings)
+    scopes = scopes or [None] * len(results)
+    matched = set()
+
+    for i, (result, scope) in enumerate(zip(results, scopes)):
+        result["embedding"] = probes[i]
+        if scope is not None and scope.recent is not None:
+            ids, matrix = scope.recent
+            sims = matrix @ probes[i]
+            best = int(sims.argmax())
+            if sims[best] >= RECENT_MATCH_SIMILARITY:
+                result.update(student_id=int(ids[best]), similarity=float(sims[best]), scope="recent")
+                matched.add(i)
+    if len(matched) < len(results):
+        face_gallery.sync()
+
+    sessions = {}
+    for i, scope in enumerate(scopes):
+        if i not in matched and scope is not None and scope.student_ids is not None and len(scope.student_ids):
+            key = np.asarray(scope.student_ids, dtype=np.int64).tobytes()
+            sessions.setdefault(key, (scope.student_ids, []))[1].append(i)
+    for student_ids, rows in sessions.values():
+        ids, sims = face_gallery.search_subset(probes[rows], student_ids)
+        for i, student_id, similarity in zip(rows, ids, sims):
+            if student_id >= 0 and similarity >= MATCH_SIMILARITY:
+                results[i].update(student_id=int(student_id), similarity=float(similarity), scope="session")
+                matched.add(i)
+
+    fallbacks = {}
+    for i, scope in enumerate(scopes):
+        if i not in matched:
+            fallbacks.setdefault(scope.shards if scope is not None else (), []).append(i)
+    for shard_keys, rows in fallbacks.items():
+        if shard_keys:
+            ids, sims = shards.shard_set.search_batch(probes[rows], shard_keys)
+        else:
+            ids, sims = face_gallery.search_batch(probes[rows])
+        for i, student_id, similarity in zip(rows, ids, sims):
+            result = results[i]
+            result["scope"] = "shards" if shard_keys else "all"
+            if student_id >= 0:
+                result["similarity"] = float(similarity)
+                if similarity >= MATCH_SIMILARITY:
+                    result["student_id"] = int(student_id)
+    search_ms = (time.perf_counter() - started) * 1000
+    for result in results:
+        result["timings"]["search_ms"] = search_ms
+        result["batch_size"] = len(results)
+
+
+def match_embeddings(embeddings, scope=None, face_gallery=None):
+    """Results for ready-made embeddings (e.g. computed on a kiosk), all sharing one scope"""
+    results = [_result() for _ in embeddings]
+    if results:
+        _apply_matches(results, embeddings, face_gallery or gallery.face_gallery, [scope] * len(results))
+    return results
+
+
+def recognize_frame(image_array, face_gallery, models=None, scope=None):
+    """
+    Embed one decoded RGB frame and search the gallery.
+    Returns {"student_id", "similarity", "error", "batch_size", "timings"}; student_id is None without a match.
+    """
+    timings = {}
+    encoding, error = face_utils.get_face_embedding(image_array, models, timings)
+    result = _result(error, **timings)
+    if not error:
+        _apply_matches([result], [encoding], face_gallery, [scope])
+    return result
+
+
+def recognize_items(items, face_gallery, embedder, models=None):
+    """
+    Recognize several (kind, array, scope) items: "frame" is a decoded RGB frame
+    that is detected and aligned first, "crop" an already aligned 112x112 BGR
+    face crop; scope is None or a Scope.
+    One SFace pass and one gallery search cover the whole batch.
+    """
+    results, crops, found, scopes = [], [], [], []
+    for kind, image_array, scope in items:
+        timings = {}
+        try:
+            if kind == "crop":
+                crop, error = image_array, None
+            else:
+                crop, error = face_utils.detect_and_align(image_array, models, timings)
+        except Exception as e:
+            crop, error = None, f"Processing error: {e}"
+        if crop is not None and embedder is None:
+            crop, error = None, "Models not initialized (missing ONNX files?)"
+        results.append(_result(error, **timings))
+        if crop is not None:
+            crops.append(crop)
+            found.append(results[-1])
+            scopes.append(scope)
+
+    if crops:
+        started = time.perf_counter()
+        try:
+            embeddings = embedder.embed(crops)
+        except Exception as e:
+            for result in found:
+                result["error"] = f"Processing error: {e}"
+            return results
+        embed_ms = (time.perf_counter() - started) * 1000
+        for result in found:
+            result["timings"]["embed_ms"] = embed_ms
+        _apply_matches(found, embeddings, face_gallery, scopes)
+    return results
+
+
+def load_embedder():
+    try:
+        return face_utils.BatchEmbedder()
+    except Exception as e:
+        print(f"❌ Error loading models: {e}")
+        return None
+
+
+def _drain(tasks, first, max_batch, max_wait_ms):
+    """`first` plus whatever else arrives within the batching window; a None sentinel ends it"""
+    batch, stop = [first], False
+    deadline = time.perf_counter() + max_wait_ms / 1000
+    while len(batch) < max_batch:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            task = tasks.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if task is None:
+            stop = True
+            break
+        batch.append(task)
+    return batch, stop
+
+
+def _worker_main(index, tasks, results):
+    # Runs in a spawned process: face_utils loaded this process's own models on import
+    face_gallery = gallery.FaceGallery()
+    face_gallery.start_polling()
+    embedder = load_embedder()
+    results.put(("ready", index, os.getpid(), None))
+    stop = False
+    while not stop:
+        task = tasks.get()
+        if task is None:
+            break
+        batch, stop = _drain(tasks, task, RECOGNITION_BATCH_SIZE, RECOGNITION_BATCH_WAIT_MS)
+        try:
+            outcomes = recognize_items([item for _, *item in batch], face_gallery, embedder)
+        except Exception as e:
+            outcomes = [_result(f"Processing error: {e}") for _ in batch]
+        for (task_id, *_), result in zip(batch, outcomes):
+            results.put(("result", index, task_id, result))
+
+
+class MicroBatcher:
+    """
+    In-process batching: requests detect and align their own face, then hand the
+    crop to one thread that embeds and searches whole batches.
+    """
+    def __init__(self, face_gallery, max_batch=RECOGNITION_BATCH_SIZE, max_wait_ms=RECOGNITION_BATCH_WAIT_MS):
+        self.face_gallery = face_gallery
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.crops = 0
+
+    def submit(self, crop, result, scope=None):
+        """Future of `result` completed with the crop's match"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="recognition-batcher", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((crop, result, future, time.perf_counter(), scope))
+        return future
+
+    def _loop(self):
+        embedder = load_embedder()
+        while True:
+            first = self._queue.get()
+            batch, _ = _drain(self._queue, first, self.max_batch, self.max_wait_ms)
+            started = time.perf_counter()
+            results = [result for _, result, _, _, _ in batch]
+            for _, result, _, queued_at, _ in batch:
+                result["timings"]["batch_wait_ms"] = (started - queued_at) * 1000
+            try:
+                if embedder is None:
+                    raise RuntimeError("Models not initialized (missing ONNX files?)")
+                embeddings = embedder.embed([crop for crop, _, _, _, _ in batch])
+                embed_ms = (time.perf_counter() - started) * 1000
+                for result in results:
+                    result["timings"]["embed_ms"] = embed_ms
+                _apply_matches(results, embeddings, self.face_gallery, [scope for *_, scope in batch])
+            except Exception as e:
+                for result in results:
+                    result["error"] = f"Processing error: {e}"
+            self.batches += 1
+            self.crops += len(batch)
+            for _, result, future, _, _ in batch:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait_ms,
+            "batches": self.batches,
+            "mean_batch_size": round(self.crops / self.batches, 2) if self.batches else 0,
+        }
+
+
+class RecognitionPool:
+    def __init__(self, workers=RECOGNITION_WORKERS, max_pending=RECOGNITION_QUEUE_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending = {} # task_id -> (Future, submitted at)
+        self._processes = {}
+        self._stats = {}
+        self._stopping = threading.Event()
+        self._tasks = None
+        self._results = None
+        self._collector = None
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def running(self):
+        return self._collector is not None
+
+    def start(self):
+        if self.running or self.workers <= 0:
+            return
+        self._tasks = self._ctx.Queue(self.max_pending)
+        self._results = self._ctx.Queue()
+        for index in range(self.workers):
+            self._spawn(index)
+        self._collector = threading.Thread(target=self._collect, name="recognition-results", daemon=True)
+        self._collector.start()
+        print(f"✅ Recognition pool started: {self.workers} worker process(es)")
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopping.set()
+        for _ in self._processes:
+            try:
+                self._tasks.put_nowait(None)
+            except queue.Full:
+                break
+        for process in self._processes.values():
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self._collector.join(timeout=2)
+        self._collector = None
+        with self._lock:
+            for future, _ in self._pending.values():
+                future.set_exception(RuntimeError("Recognition pool stopped"))
+            self._pending.clear()
+
+    def _spawn(self, index):
+        process = self._ctx.Process(
+            target=_worker_main, args=(index, self._tasks, self._results),
+            name=f"recognition-{index}", daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+        stats = self._stats.setdefault(index, {
+            "pid": None, "ready": False, "processed": 0, "errors": 0,
+            "busy_ms": 0.0, "last_result_at": None, "restarts": -1
+        })
+        stats.update(pid=process.pid, ready=False, restarts=stats["restarts"] + 1)
+
+    def submit(self, image_array, kind="frame", scope=None):
+        """Queue a decoded frame (or an aligned "crop"); returns a Future of its recognize_items() result"""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                raise RecognitionBusy(f"{len(self._pending)} frames already queued")
+            task_id = next(self._ids)
+            future = Future()
+            self._pending[task_id] = (future, time.monotonic())
+        # Called from the event loop, so never wait for room: expired tasks of a hung
+        # or dead worker can still fill the IPC queue after leaving self._pending
+        try:
+            self._tasks.put_nowait((task_id, kind, image_array, scope))
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(task_id, None)
+                self.rejected += 1
+            raise RecognitionBusy("Recognition worker queue is full")
+        return future
+
+    def _collect(self):
+        while not self._stopping.is_set():
+            try:
+                kind, index, a, b = self._results.get(timeout=1)
+            except queue.Empty:
+                kind = None
+            if kind == "ready":
+                self._stats[index].update(pid=a, ready=True)
+            elif kind == "result":
+                self._resolve(index, a, b)
+            self._check_workers()
+            self._expire()
+
+    def _resolve(self, index, task_id, result):
+        stats = self._stats[index]
+        stats["processed"] += 1
+        stats["errors"] += bool(result["error"])
+        # Batch-wide stages are shared between the frames of the batch
+        timings = result["timings"]
+        stats["busy_ms"] += timings.get("detect_ms", 0) + timings.get("align_ms", 0) + (
+            timings.get("embed_ms", 0) + timings.get("search_ms", 0)
+        ) / result["batch_size"]
+        stats["last_result_at"] = time.time()
+        with self._lock:
+            entry = self._pending.pop(task_id, None)
+        if entry:  # None if it already timed out
+            entry[0].set_result(result)
+
+    def _check_workers(self):
+        for index, process in list(self._processes.items()):
+            if not process.is_alive() and not self._stopping.is_set():
+                print(f"⚠️ Recognition worker {index} (pid {process.pid}) exited with {process.exitcode}; restarting")
+                self._spawn(index)
+
+    def _expire(self):
+        deadline = time.monotonic() - RECOGNITION_TIMEOUT
+        with self._lock:
+            expired = [task_id for task_id, (_, submitted) in self._pending.items() if submitted < deadline]
+            for task_id in expired:
+                self._pending.pop(task_id)[0].set_exception(TimeoutError("Recognition timed out"))
+            self.timed_out += len(expired)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "enabled": self.running,
+            "workers": self.workers,
+            "queue_size": self.max_pending,
+            "pending": pending,
+            "rejected": self.rejected,
+            "batch_size": RECOGNITION_BATCH_SIZE,
+            "batch_wait_ms": RECOGNITION_BATCH_WAIT_MS,
+            "timed_out": self.timed_out,
+            "per_worker": [
+                dict(stats, worker=index, alive=self._processes[index].is_alive())
+                for index, stats in sorted(self._stats.items())
+            ],
+        }
+
+
+pool = RecognitionPool()
+batcher = MicroBatcher(gallery.face_gallery)
+
+_threads = ThreadPoolExecutor(RECOGNITION_THREADS, thread_name_prefix="recognition")
+_local = threading.local()
+
+
+def _thread_models():
+    """This recognition thread's own (detector, recognizer)"""
+    if not hasattr(_local, "models"):
+        try:
+            _local.models = face_utils.create_models()
+        except Exception as e:
+            print(f"❌ Error loading models: {e}")
+            _local.models = (None, None) # Reported per frame as "Models not initialized"
+    return _local.models
+
+
+def _in_thread(function, *args):
+    return asyncio.wrap_future(_threads.submit(function, *args))
+
+
+def _recognize_frame_here(image_array, scope):
+    return recognize_frame(image_array, gallery.face_gallery, _thread_models(), scope)
+
+
+def _detect_here(image_array):
+    timings = {}
+    try:
+        crop, error = face_utils.detect_and_align(image_array, _thread_models(), timings)
+    except Exception as e:
+        crop, error = None, f"Processing error: {e}"
+    return crop, _result(error, **timings)
+
+
+def _recognize_crop_here(crop, scope):
+    started = time.perf_counter()
+    encoding, error = face_utils.embed_aligned(crop, _thread_models())
+    result = _result(error, embed_ms=(time.perf_counter() - started) * 1000)
+    if not error:
+        _apply_matches([result], [encoding], gallery.face_gallery, [scope])
+    return result
+
+
+async def recognize(image_array, scope=None):
+    """Recognize a decoded frame in the worker pool when it runs, on a recognition thread otherwise"""
+    if pool.running:
+        future = pool.submit(image_array, scope=scope)
+        return await asyncio.wait_for(asyncio.wrap_future(future), RECOGNITION_TIMEOUT)
+    if RECOGNITION_BATCH_SIZE <= 1:
+        return await _in_thread(_recognize_frame_here, image_array, scope)
+
+    # Detect on a recognition thread; the crop joins whatever batch other requests are forming
+    crop, result = await _in_thread(_detect_here, image_array)
+    if result["error"]:
+        return result
+    return await asyncio.wrap_future(batcher.submit(crop, result, scope))
+
+
+async def recognize_crop(crop, scope=None):
+    """Recognize an aligned 112x112 BGR face crop: no decode, detection or alignment"""
+    if pool.running:
+        future = pool.submit(crop, kind="crop", scope=scope)
+        return await asyncio.wait_for(asyncio.wrap_future(future), RECOGNITION_TIMEOUT)
+    if RECOGNITION_BATCH_SIZE <= 1:
+        return await _in_thread(_recognize_crop_here, crop, scope)
+    return await asyncio.wrap_future(batcher.submit(crop, _result(), scope))
+
+
+def stats():
+    return dict(pool.stats(), batching=batcher.stats(), shards=shards.shard_set.stats())
@@ -0,0 +1,135 @@
+"""
+Daily attendance rollup.
+
+Keeps per (date, department, method) counters next to the attendance table so
+dashboards read one row per day instead of scanning every attendance record.
+Counters are bumped in the same transaction as the attendance insert and can
+be rebuilt from scratch at any time:
+
+    python rollup.py
+"""
+from collections import Counter
+from sqlalchemy import func, update, delete, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models import Attendance, AttendanceRollup, Student
+import archive
+
+# Set in Session.info whenever counters change, so read caches can be dropped on commit
+DIRTY_FLAG = "attendance_rollup_dirty"
+
+
+def _key_filter(date_str, department, method):
+    return (
+        AttendanceRollup.date == date_str,
+        AttendanceRollup.department == department,
+        AttendanceRollup.method == method,
+    )
+
+
+def bump(db, date_str, department, method, n=1):
+    """
+    Increment the counter for one (date, department, method) bucket.
+    Runs inside the caller's transaction; the caller commits.
+    """
+    department = department or ""
+    db.info[DIRTY_FLAG] = True
+    result = db.execute(
+        update(AttendanceRollup)
+        .where(*_key_filter(date_str, department, method))
+        .values(count=AttendanceRollup.count + n)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        return
+
+    try:
+        # Savepoint so a concurrent insert of the same bucket only retries the update
+        with db.begin_nested():
+            db.add(AttendanceRollup(date=date_str, department=department, method=method, count=n))
+    except IntegrityError:
+        db.execute(
+            update(AttendanceRollup)
+            .where(*_key_filter(date_str, department, method))
+            .values(count=AttendanceRollup.count + n)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def bump_many(db, keys):
+    """Bump a batch of (date, department, method) keys, one statement per bucket"""
+    for (date_str, department, method), n in Counter(keys).items():
+        bump(db, date_str, department, method, n)
+
+
+def rebuild(db, dates=None):
+    """
+    Recompute the rollup from the attendance and archive tables.
+    If `dates` is given only those days are rebuilt. Commits.
+    """
+    start = end = None
+    if dates is not None:
+        dates = sorted(dates)
+        if not dates:
+            return 0
+        start, end = dates[0], dates[-1]
+
+    # Archived days keep their counters, so rebuilds read hot and cold rows alike
+    attendance = archive.attendance_source(db, start, end)
+    department = func.coalesce(Student.department, "")
+    source = (
+        select(attendance.c.date, department, attendance.c.method, func.count(attendance.c.id))
+        .select_from(attendance)
+        .outerjoin(Student, Student.id == attendance.c.student_id)
+        .where(attendance.c.date.isnot(None))
+        .group_by(attendance.c.date, department, attendance.c.method)
+    )
+    clear = delete(AttendanceRollup)
+
+    if dates is not None:
+        source = source.where(attendance.c.date.in_(dates))
+        clear = clear.where(AttendanceRollup.date.in_(dates))
+
+    db.info[DIRTY_FLAG] = True
+    db.execute(clear)
+    db.execute(
+        insert(AttendanceRollup).from_select(
+            ["date", "department", "method", "count"], source
+        )
+    )
+    db.commit()
+    return db.query(func.count(AttendanceRollup.id)).scalar()
+
+
+def ensure_built(db):
+    """Build the rollup once for databases that predate it"""
+    if db.query(AttendanceRollup.id).first() is not None:
+        return False
+    if db.query(Attendance.id).first() is None:
+        return False
+    rebuild(db)
+    return True
+
+
+def daily_counts(db, start=None, end=None, department=None):
+    """Return [(date, count)] ordered by date, read from the rollup"""
+    query = db.query(AttendanceRollup.date, func.sum(AttendanceRollup.count))
+    if start:
+        query = query.filter(AttendanceRollup.date >= start)
+    if end:
+        query = query.filter(AttendanceRollup.date <= end)
+    if department is not None:
+        query = query.filter(AttendanceRollup.department == department)
+    return [(d, int(c)) for d, c in query.group_by(AttendanceRollup.date).order_by(AttendanceRollup.date)]
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, engine, Base
+
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        buckets = rebuild(db)
+        print(f"✅ Attendance rollup rebuilt ({buckets} buckets)")
+    finally:
+        db.close()
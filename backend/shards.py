@@ -0,0 +1,223 @@
+"""
+Gallery shards: the face gallery split by student attributes.
+
+GALLERY_SHARD_BY names the Student columns that key a shard ("department" by
+default, "department,year" for finer shards, or any column a deployment adds,
+e.g. campus). A shard key is their values joined by "/", e.g. "CSE" or "CSE/2".
+
+Each shard is a FaceGallery of its own under data/gallery/shards/<key>/: same
+snapshot format, same change log. A shard reads the whole log but sees changes
+of students outside the shard as removals, so a student whose department
+changes moves between shards without extra bookkeeping.
+
+Kiosks that declare shards are matched against those shards only, so a scan
+costs a product with a few thousand rows however large the full gallery grows.
+Shards are built or mapped on first use and kept in an LRU bounded by
+GALLERY_SHARD_MEMORY_MB; evicted shards are simply mapped again when needed.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import and_, case, func, literal, null, String
+
+import gallery
+from database import SessionLocal
+from models import GalleryChange, Student
+
+GALLERY_SHARD_BY = tuple(c.strip() for c in os.getenv("GALLERY_SHARD_BY", "department").split(",") if c.strip())
+GALLERY_SHARD_MEMORY_MB = float(os.getenv("GALLERY_SHARD_MEMORY_MB", "512"))
+SHARD_KEYS_CACHE_SECONDS = 60
+# Log rows of other shards leave a shard unchanged; republish for them only once this many piled up
+SHARD_REPUBLISH_CHANGES = 1000
+SHARD_SEPARATOR = "/"
+
+ROW_BYTES = gallery.EMBEDDING_DIM * 4 + 8 # float32 row + int64 id
+
+
+def shard_columns():
+    return [getattr(Student, column) for column in GALLERY_SHARD_BY]
+
+
+def shard_filter(key):
+    """SQL condition for the students of shard `key`"""
+    values = key.split(SHARD_SEPARATOR, len(GALLERY_SHARD_BY) - 1)
+    if len(values) != len(GALLERY_SHARD_BY):
+        return literal(False)
+    return and_(*(column == value for column, value in zip(shard_columns(), values)))
+
+
+def parse_shards(value):
+    """Shard keys from a comma-separated form field or a list; () means the full gallery"""
+    if not value:
+        return ()
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(sorted({key.strip() for key in value if key and key.strip()}))
+
+
+def _directory_name(key):
+    # Department names are free text; keep the directory portable and collision-free
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", key)[:40]
+    return f"{safe}-{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+
+
+class ShardGallery(gallery.FaceGallery):
+    def __init__(self, key, directory=None):
+        super().__init__(directory or gallery.GALLERY_DIR / "shards" / _directory_name(key))
+        self.key = key
+
+    def _change_rows(self, db):
+        in_shard = shard_filter(self.key)
+        return (
+            db.query(
+                GalleryChange.id, GalleryChange.student_id,
+                case((in_shard, GalleryChange.action), else_=literal("remove", String)),
+                case((in_shard, GalleryChange.encoding), else_=null())
+            )
+            .outerjoin(Student, Student.id == GalleryChange.student_id)
+        )
+
+    def _publish_due(self):
+        # Same size/time threshold as the full gallery for changes to the shard itself
+        with self._lock:
+            unchanged = not self._extra and self._base_alive is None
+            changes = self.revision - self._base_revision
+        if unchanged:
+            return changes >= SHARD_REPUBLISH_CHANGES
+        return super()._publish_due()
+
+    @property
+    def nbytes(self):
+        return (len(self._base_ids) + len(self._extra)) * ROW_BYTES
+
+
+class ShardSet:
+    """Lazily loaded shards of one process, least recently used evicted past the memory limit"""
+    def __init__(self, memory_mb=GALLERY_SHARD_MEMORY_MB, poll_seconds=gallery.GALLERY_POLL_SECONDS):
+        self.memory_limit = int(memory_mb * 1024 * 1024)
+        self.poll_seconds = poll_seconds
+        self._shards = OrderedDict() # key -> ShardGallery
+        self._polled_at = {} # key -> monotonic time of the last poll
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._keys = None
+        self._keys_at = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def known_keys(self, db=None):
+        """{key: students} of every non-empty shard; cached for SHARD_KEYS_CACHE_SECONDS"""
+        if self._keys is not None and time.monotonic() - self._keys_at < SHARD_KEYS_CACHE_SECONDS:
+            return self._keys
+        own = db is None
+        db = db or SessionLocal()
+        try:
+            rows = (
+                db.query(*shard_columns(), func.count(Student.id))
+                .filter(Student.face_encoding.isnot(None))
+                .group_by(*shard_columns())
+                .all()
+            )
+        finally:
+            if own:
+                db.close()
+        self._keys = {
+            SHARD_SEPARATOR.join(str(value) for value in row[:-1]): row[-1]
+            for row in rows if all(value is not None for value in row[:-1])
+        }
+        self._keys_at = time.monotonic()
+        return self._keys
+
+    def get(self, key):
+        """The shard's gallery, current to within poll_seconds; None for an unknown key"""
+        with self._lock:
+            shard = self._shards.get(key)
+            if shard is not None:
+                self._shards.move_to_end(key)
+        if shard is None:
+            return self._load(key)
+        if time.monotonic() - self._polled_at.get(key, 0) >= self.poll_seconds:
+            self._poll(shard)
+        return shard
+
+    def _poll(self, shard):
+        self._polled_at[shard.key] = time.monotonic()
+        db = SessionLocal()
+        try:
+            shard.maybe_refresh(db)
+        except Exception as e:
+            print(f"⚠️ Gallery shard {shard.key} poll failed: {e}")
+        finally:
+            db.close()
+
+    def _load(self, key):
+        with self._load_lock:
+            with self._lock:
+                if key in self._shards:
+                    return self._shards[key]
+            if self.unknown([key]):
+                return None
+            shard = ShardGallery(key)
+            shard.sync() # Published snapshot, if another process built one
+            self._poll(shard) # Changes since; published once enough piled up
+            with self._lock:
+                self._shards[key] = shard
+                self.loads += 1
+                self._evict(keep=key)
+            print(f"✅ Gallery shard {key} loaded: {len(shard)} embeddings")
+            return shard
+
+    def unknown(self, keys, db=None):
+        """The keys that name no shard"""
+        missing = [key for key in keys if key not in self.known_keys(db)]
+        if missing:
+            # A department enrolled within the cache window would otherwise be unknown for a minute
+            self._keys = None
+            missing = [key for key in missing if key not in self.known_keys(db)]
+        return missing
+
+    def _evict(self, keep):
+        """Drop least recently used shards past the memory limit (caller holds self._lock)"""
+        total = sum(shard.nbytes for shard in self._shards.values())
+        for key in list(self._shards):
+            if total <= self.memory_limit:
+                break
+            if key == keep:
+                continue
+            total -= self._shards.pop(key).nbytes
+            self._polled_at.pop(key, None)
+            self.evictions += 1
+
+    def search_batch(self, encodings, keys):
+        """Best (student_ids, similarities) per probe across the shards `keys`"""
+        probes = gallery.normalize(encodings)
+        best_ids = np.full(len(probes), -1, dtype=np.int64)
+        best_sims = np.full(len(probes), -1.0, dtype=np.float32)
+        for key in keys:
+            shard = self.get(key)
+            if shard is None or not len(shard):
+                continue
+            ids, sims = shard.search_batch(probes)
+            better = sims > best_sims
+            best_ids[better], best_sims[better] = ids[better], sims[better]
+        return best_ids, best_sims
+
+    def stats(self):
+        with self._lock:
+            loaded = {key: {"embeddings": len(shard), "bytes": shard.nbytes} for key, shard in self._shards.items()}
+        return {
+            "shard_by": list(GALLERY_SHARD_BY),
+            "memory_limit_bytes": self.memory_limit,
+            "memory_bytes": sum(shard["bytes"] for shard in loaded.values()),
+            "loaded": loaded,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+
+shard_set = ShardSet()
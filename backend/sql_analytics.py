@@ -0,0 +1,174 @@
+"""
+Analytics over the SQL database.
+
+Same views as the legacy `analytics.AnalyticsEngine` (which reads the Excel
+stores), computed with GROUP BY aggregates. Date series are read from the
+daily rollup table, so they cost O(days) rather than O(attendance records).
+
+Results are cached per process for a short TTL. Any session commit that
+touched the rollup (see `rollup.bump`) clears the cache of the worker that
+made it; other workers pick the change up when their TTL expires.
+"""
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime
+
+from sqlalchemy import event, func, distinct
+
+from database import SessionLocal
+from models import AttendanceRollup, Student
+import rollup
+import archive
+
+CACHE_TTL_SECONDS = 30
+
+
+class AnalyticsCache:
+    def __init__(self, ttl=CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = AnalyticsCache()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_on_attendance_change(session):
+    if session.info.pop(rollup.DIRTY_FLAG, False):
+        cache.invalidate()
+
+
+class SQLAnalyticsEngine:
+    def __init__(self, cache=cache):
+        self.cache = cache
+
+    def _cached(self, key, compute):
+        return self.cache.get_or_compute(key, compute)
+
+    def get_daily_attendance(self, db, days=7):
+        """Get daily attendance counts for the last N days that have attendance"""
+        def compute():
+            rows = (
+                db.query(AttendanceRollup.date, func.sum(AttendanceRollup.count))
+                .group_by(AttendanceRollup.date)
+                .order_by(AttendanceRollup.date.desc())
+                .limit(days)
+                .all()
+            )
+            rows.reverse()  # Oldest first
+            return {
+                'labels': [d for d, _ in rows],
+                'data': [int(c) for _, c in rows]
+            }
+        return self._cached(('daily', days), compute)
+
+    def get_weekly_trends(self, db, weeks=4):
+        """Get weekly attendance trends (Year-Week labels, as in the legacy engine)"""
+        def compute():
+            weekly_counts = defaultdict(int)
+            for day, count in rollup.daily_counts(db):
+                try:
+                    week = datetime.strptime(day, '%Y-%m-%d').strftime('%Y-W%U')
+                except ValueError:
+                    continue
+                weekly_counts[week] += count
+
+            sorted_weeks = sorted(weekly_counts.keys())[-weeks:]
+            return {
+                'labels': sorted_weeks,
+                'data': [weekly_counts[week] for week in sorted_weeks]
+            }
+        return self._cached(('weekly', weeks), compute)
+
+    def get_monthly_overview(self, db, months=6):
+        """Get monthly attendance overview"""
+        def compute():
+            month = func.substr(AttendanceRollup.date, 1, 7)
+            rows = (
+                db.query(month, func.sum(AttendanceRollup.count))
+                .group_by(month)
+                .order_by(month.desc())
+                .limit(months)
+                .all()
+            )
+            rows.reverse()
+            return {
+                'labels': [m for m, _ in rows],
+                'data': [int(c) for _, c in rows]
+            }
+        return self._cached(('monthly', months), compute)
+
+    def get_summary_stats(self, db):
+        """Get overall summary statistics"""
+        def compute():
+            today = date.today().isoformat()
+            total_students = db.query(func.count(Student.id)).scalar() or 0
+            total_records, working_days = db.query(
+                func.coalesce(func.sum(AttendanceRollup.count), 0),
+                func.count(distinct(AttendanceRollup.date))
+            ).one()
+            today_attendance = (
+                db.query(func.coalesce(func.sum(AttendanceRollup.count), 0))
+                .filter(AttendanceRollup.date == today)
+                .scalar()
+            )
+            avg_daily = total_records / working_days if working_days else 0
+            return {
+                'total_students': total_students,
+                'total_attendance_records': int(total_records),
+                'today_attendance': int(today_attendance),
+                'total_working_days': working_days,
+                'average_daily_attendance': round(avg_daily, 2)
+            }
+        return self._cached(('summary', date.today().isoformat()), compute)
+
+    def get_student_attendance_percentage(self, db):
+        """Get attendance percentage for each student, highest first"""
+        def compute():
+            total_days = db.query(func.count(distinct(AttendanceRollup.date))).scalar() or 0
+
+            attendance = archive.attendance_source(db)
+            present_days = (
+                db.query(
+                    attendance.c.student_id.label('student_id'),
+                    func.count(distinct(attendance.c.date)).label('days')
+                )
+                .group_by(attendance.c.student_id)
+                .subquery()
+            )
+            rows = (
+                db.query(Student.name, Student.registration_number, func.coalesce(present_days.c.days, 0))
+                .outerjoin(present_days, present_days.c.student_id == Student.id)
+                .order_by(func.coalesce(present_days.c.days, 0).desc(), Student.registration_number)
+                .all()
+            )
+
+            divisor = total_days or 1
+            return [{
+                'name': name,
+                'registration_no': reg_no,
+                'attendance_count': int(count),
+                'total_days': divisor,
+                'percentage': round(count / divisor * 100, 2)
+            } for name, reg_no, count in rows]
+        return self._cached(('student_percentages',), compute)
+
+
+analytics_engine = SQLAnalyticsEngine()
@@ -0,0 +1,66 @@
+"""
+The /metrics text must follow exposition format 0.0.4: every sample belongs to
+the family named on the # TYPE line before it, or scrapers treat it as untyped.
+
+    python -m pytest -q test_metrics.py
+"""
+import re
+
+from fastapi import FastAPI
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+
+import metrics
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+HISTOGRAM_SUFFIXES = ("_bucket", "_sum", "_count")
+
+
+def parse(text):
+    """{family: (type, [sample names])}; fails on samples outside their family"""
+    families = {}
+    family = kind = None
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            family, kind = line.split()[2:4]
+            families[family] = (kind, [])
+        elif line and not line.startswith("#"):
+            name = SAMPLE.match(line).group(1)
+            allowed = {family} | ({family + suffix for suffix in HISTOGRAM_SUFFIXES} if kind == "histogram" else set())
+            assert name in allowed, f"{name} is not in the {family} ({kind}) family"
+            families[family][1].append(name)
+    return families
+
+
+def scrape():
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get("/ping")
+    def ping():
+        return {"ok": True}
+
+    @app.get("/metrics")
+    def get_metrics():
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+    client = TestClient(app)
+    assert client.get("/ping").status_code == 200
+    return client.get("/metrics").text
+
+
+def test_type_lines_name_their_samples():
+    metrics.RECOGNITIONS.labels("gallery", "matched").inc()
+    metrics.STAGE_SECONDS.labels("detect").observe(0.02)
+    families = parse(scrape())
+
+    assert families["http_requests_total"][0] == "counter"
+    assert "http_requests_total" in families["http_requests_total"][1]
+    assert families["recognitions_total"] == ("counter", ["recognitions_total"])
+    assert families["recognition_stage_seconds"][0] == "histogram"
+
+
+def test_counters_are_named_total():
+    for metric in metrics.REGISTRY._metrics:
+        if metric.kind == "counter":
+            assert metric.name.endswith("_total"), metric.name
@@ -0,0 +1,69 @@
+"""
+Legacy Excel migration: re-running it must not duplicate rows.
+
+Runs against a throwaway SQLite file, whatever DATABASE_URL says:
+
+    python -m pytest -q test_migrate_legacy.py
+"""
+import pytest
+from openpyxl import Workbook
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import bulk_load
+import gallery
+import migrate_legacy
+from models import Attendance, Student
+
+
+def write_sheet(path, header, rows):
+    wb = Workbook()
+    sheet = wb.active
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    wb.save(path)
+
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrated.db'}")
+    monkeypatch.setattr(migrate_legacy, "engine", engine)
+    monkeypatch.setattr(migrate_legacy, "SessionLocal", sessionmaker(bind=engine))
+    monkeypatch.setattr(bulk_load, "IS_POSTGRES", False) # No COPY into the SQLite scratch file
+    monkeypatch.setattr(gallery, "face_gallery", gallery.FaceGallery(tmp_path / "gallery"))
+
+    data = tmp_path / "data"
+    data.mkdir()
+    write_sheet(data / "students.xlsx", ["Registration No", "Name", "Department", "Year"], [
+        ["R1", "One", "CSE", "2"],
+        ["R2", "Two", "ECE", "3"],
+    ])
+    write_sheet(data / "attendance.xlsx", ["Registration No", "Name", "Date", "Time", "Mode"], [
+        ["R1", "One", "2024-01-08", "09:00:00", "Face"],
+        ["R1", "One", "2024-01-08", "09:05:00", "QR"],
+        ["R2", "Two", "2024-01-08", "09:01:00", "Face"],
+        [None, None, None, None, None],
+        ["R1", "One", "2024-01-09", "09:00:00", "Face"],
+        ["R1", "One", "2024-01-09", "09:30:00", "Face"], # Same student, day and method
+    ])
+    yield data, sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def counts(Session):
+    db = Session()
+    try:
+        return db.query(func.count(Student.id)).scalar(), db.query(func.count(Attendance.id)).scalar()
+    finally:
+        db.close()
+
+
+def test_restart_does_not_duplicate_attendance(legacy):
+    data, Session = legacy
+    migrate_legacy.LegacyMigrator(data_dir=data, embeddings=False, chunk_size=2).run()
+    assert counts(Session) == (2, 4)
+
+    migrate_legacy.LegacyMigrator(data_dir=data, embeddings=False, chunk_size=2, restart=True).run()
+    assert counts(Session) == (2, 4)
+
@@ -0,0 +1,46 @@
+"""
+Gallery matching with a Scope, on a scratch gallery directory:
+
+    python -m pytest -q test_recognition.py
+"""
+import numpy as np
+import pytest
+
+import gallery
+import recognition
+
+
+def similar_pair(similarity, seed=0):
+    """Two distinct unit embeddings with the given cosine similarity"""
+    rng = np.random.default_rng(seed)
+    a, noise = rng.standard_normal((2, gallery.EMBEDDING_DIM))
+    a /= np.linalg.norm(a)
+    noise -= (noise @ a) * a
+    noise /= np.linalg.norm(noise)
+    return a, similarity * a + np.sqrt(1 - similarity ** 2) * noise
+
+
+@pytest.fixture
+def face_gallery(tmp_path):
+    return gallery.FaceGallery(tmp_path)
+
+
+def enroll(face_gallery, encodings):
+    with face_gallery._lock:
+        face_gallery._apply([(i, i, "add", list(e)) for i, e in enumerate(encodings, start=1)])
+
+
+def test_recent_hit_needs_same_person(face_gallery):
+    first, classmate = similar_pair(0.6)
+    assert recognition.MATCH_SIMILARITY <= 0.6 < recognition.RECENT_MATCH_SIMILARITY
+    enroll(face_gallery, [first, classmate])
+    scope = recognition.Scope(recent=(np.array([1]), gallery.normalize(first)))
+
+    # The classmate is close enough to the last student to pass MATCH_SIMILARITY,
+    # but must be searched in the gallery and found as themselves
+    result, = recognition.match_embeddings([classmate], scope, face_gallery)
+    assert (result["student_id"], result["scope"]) == (2, "all")
+
+    same, _ = similar_pair(0.6)
+    result, = recognition.match_embeddings([same], scope, face_gallery)
+    assert (result["student_id"], result["scope"]) == (1, "recent")
@@ -0,0 +1,69 @@
+"""
+Session lookup around midnight and the end of the week, on in-memory SQLite:
+
+    python -m pytest -q test_timetable.py
+"""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import timetable
+from database import Base
+from models import Course, Room, TimeSlot
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([Course(id=1, code="C1"), Room(id=1, name="R1", kiosk_id="k1")])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def add_slot(db, weekday, start_time, end_time):
+    slot = TimeSlot(course_id=1, room_id=1, weekday=weekday, start_time=start_time, end_time=end_time)
+    db.add(slot)
+    db.commit()
+    return slot.id
+
+
+def slot_at(db, when):
+    slot = timetable.current_slot(db, "k1", datetime.strptime(when, "%Y-%m-%d %H:%M"))
+    return slot.id if slot else None
+
+
+# 2024-01-01 is a Monday
+def test_early_window_crosses_midnight(db):
+    tuesday = add_slot(db, 1, "00:05", "01:00")
+    assert slot_at(db, "2024-01-01 23:50") is None
+    assert slot_at(db, "2024-01-01 23:58") == tuesday
+    assert slot_at(db, "2024-01-02 00:30") == tuesday
+
+
+def test_slot_running_past_midnight(db):
+    night = add_slot(db, 0, "23:00", "01:00")
+    assert slot_at(db, "2024-01-01 23:30") == night
+    assert slot_at(db, "2024-01-02 00:59") == night
+    assert slot_at(db, "2024-01-02 01:00") is None
+
+
+def test_sunday_night_into_monday(db):
+    sunday = add_slot(db, 6, "23:30", "00:30")
+    assert slot_at(db, "2024-01-08 00:10") == sunday # Monday of the next week
+    assert timetable.clashing_slot(db, 1, 0, "00:00", "01:00").id == sunday
+    assert timetable.clashing_slot(db, 1, 0, "00:30", "01:00") is None
+
+
+def test_scope_cache_is_bounded(db, monkeypatch):
+    monkeypatch.setattr(timetable, "SCOPE_CACHE_MAX_KIOSKS", 3)
+    timetable.invalidate()
+    for i in range(10):
+        timetable.scope_for(db, f"unknown-{i}")
+    assert list(timetable._cache) == ["unknown-7", "unknown-8", "unknown-9"]
+    timetable.invalidate()
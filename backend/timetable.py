@@ -0,0 +1,117 @@
+"""
+Timetable scoping for recognition.
+
+Rooms name the kiosk installed in them, time slots place a course in a room
+for a weekly period, and course enrollments list its students. scope_for()
+turns a kiosk id into the student ids enrolled in the session running in that
+room right now (or starting within TIMETABLE_EARLY_MINUTES), so recognition can
+search that small sub-gallery before the whole student body.
+
+Slots are compared as minutes since Monday 00:00, so a session may start
+just after midnight or run past it (end_time <= start_time ends the next day).
+
+Scopes are cached per kiosk for SCOPE_CACHE_SECONDS, for at most
+SCOPE_CACHE_MAX_KIOSKS kiosks (least recently used dropped first: kiosk ids are
+client-supplied); timetable edits clear the cache of the process that made
+them and reach other workers on expiry.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from models import Room, TimeSlot, CourseEnrollment
+
+TIMETABLE_EARLY_MINUTES = int(os.getenv("TIMETABLE_EARLY_MINUTES", "10"))
+SCOPE_CACHE_SECONDS = int(os.getenv("TIMETABLE_SCOPE_CACHE_SECONDS", "60"))
+SCOPE_CACHE_MAX_KIOSKS = int(os.getenv("TIMETABLE_SCOPE_CACHE_KIOSKS", "1000"))
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+
+_cache = OrderedDict() # kiosk_id -> (expires_at, slot_id, student ids or None), oldest first
+_cache_lock = threading.Lock()
+
+
+def parse_hhmm(value):
+    """Normalise "9:05" / "09:05" to "09:05"; raises ValueError otherwise"""
+    return datetime.strptime(value.strip(), "%H:%M").strftime("%H:%M")
+
+
+def week_interval(weekday, start_time, end_time):
+    """[start, end) of a weekly slot in minutes since Monday 00:00; an end at or before the start is the next day"""
+    start_hour, start_minute = map(int, start_time.split(":"))
+    end_hour, end_minute = map(int, end_time.split(":"))
+    start = weekday * DAY_MINUTES + start_hour * 60 + start_minute
+    end = weekday * DAY_MINUTES + end_hour * 60 + end_minute
+    if end <= start:
+        end += DAY_MINUTES
+    return start, end
+
+
+def overlaps(a, b):
+    """Whether two week intervals overlap, Sunday night running into Monday included"""
+    return any(a[0] < b[1] + shift and b[0] + shift < a[1] for shift in (-WEEK_MINUTES, 0, WEEK_MINUTES))
+
+
+def clashing_slot(db, room_id, weekday, start_time, end_time):
+    """A slot of the room overlapping the given one, or None"""
+    interval = week_interval(weekday, start_time, end_time)
+    for slot in db.query(TimeSlot).filter(TimeSlot.room_id == room_id):
+        if overlaps(interval, week_interval(slot.weekday, slot.start_time, slot.end_time)):
+            return slot
+    return None
+
+
+def current_slot(db, kiosk_id, now=None):
+    """The TimeSlot running (or about to start) in the kiosk's room, or None"""
+    now = now or datetime.now()
+    room = db.query(Room.id).filter(Room.kiosk_id == kiosk_id).first()
+    if room is None:
+        return None
+    today = now.weekday()
+    minute = today * DAY_MINUTES + now.hour * 60 + now.minute + now.second / 60
+    # Yesterday's slot may still run past midnight; tomorrow's may start within the early window
+    days = {(today - 1) % 7, today, (today + 1) % 7}
+    running = []
+    for slot in db.query(TimeSlot).filter(TimeSlot.room_id == room.id, TimeSlot.weekday.in_(days)):
+        start, end = week_interval(slot.weekday, slot.start_time, slot.end_time)
+        for shift in (-WEEK_MINUTES, 0, WEEK_MINUTES):
+            if start + shift - TIMETABLE_EARLY_MINUTES <= minute < end + shift:
+                running.append((start + shift, slot.id, slot))
+    # The session that started first, as before: a running one over the next
+    return min(running)[2] if running else None
+
+
+def scope_for(db, kiosk_id):
+    """Sorted int64 student ids of the kiosk's current session, or None to search everyone"""
+    if not kiosk_id:
+        return None
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(kiosk_id)
+        if cached and cached[0] > now:
+            _cache.move_to_end(kiosk_id)
+            return cached[2]
+
+    slot = current_slot(db, kiosk_id)
+    ids = None
+    if slot is not None:
+        rows = db.query(CourseEnrollment.student_id).filter(CourseEnrollment.course_id == slot.course_id)
+        ids = np.array(sorted(student_id for (student_id,) in rows), dtype=np.int64)
+        if not len(ids):
+            ids = None
+    with _cache_lock:
+        _cache[kiosk_id] = (now + SCOPE_CACHE_SECONDS, slot.id if slot else None, ids)
+        _cache.move_to_end(kiosk_id)
+        while len(_cache) > SCOPE_CACHE_MAX_KIOSKS:
+            _cache.popitem(last=False)
+    return ids
+
+
+def invalidate():
+    with _cache_lock:
+        _cache.clear()